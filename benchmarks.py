@@ -0,0 +1,894 @@
+# coding: utf-8
+# Module: benchmarks
+
+import os
+import sys
+import time
+import random
+import multiprocessing
+import resource
+import shutil
+import subprocess
+import sqlite3
+import tempfile
+
+cwd = os.path.dirname(os.path.abspath(__file__))
+
+plugin_name = 'plugin.video.zona.mobi'
+
+# Import our module being measured
+sys.path.append(os.path.join(cwd, plugin_name))
+from resources.lib.zonamobi import ZonaMobi, ZonaMobiCache, ZonaMobiPlayer
+from stubserver import ZonaMobiStub
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+def _measure( func, repeat=5 ):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def _measure_average( func, repeat=20 ):
+    start = time.time()
+    for i in xrange(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+def _make_document( name_id, season=0 ):
+    item = {'name_id': name_id,
+            'name_rus': u'Название %s' % name_id,
+            'name_original': 'Title %s' % name_id,
+            'serial': season > 0,
+            'year': 2010,
+            'image': 'https://example.com/%s/image.jpg' % name_id,
+            'description': u'Описание ' * 50,
+            'runtime': {'value': 95, 'text': u'95 мин.'},
+            'release_date_int': u'1 января 2010',
+            'rating': '7.5',
+            'rating_count': 1500,
+            'seo_title': u'Смотреть онлайн %s' % name_id,
+            'seo_description': u'Смотреть онлайн бесплатно ' * 10,
+            }
+    persons = []
+    for i in xrange(20):
+        persons.append({'name': u'Актер %d' % i,
+                        'name_eng': 'Actor %d' % i,
+                        'cover': 'https://example.com/person/%d.jpg' % i,
+                        'translit': 'actor-%d' % i,
+                        'biography': u'Биография ' * 10,
+                        })
+    similar = []
+    for i in xrange(12):
+        similar.append({'name_id': '%s-similar-%d' % (name_id, i),
+                        'name_rus': u'Похожий %d' % i,
+                        'cover': 'https://example.com/similar/%d.jpg' % i,
+                        'rating': '6.1',
+                        })
+    return {'serial' if season else 'movie': item,
+            'backdrops': {'image_1280': 'https://example.com/%s.jpg' % name_id,
+                          'image_1920': 'https://example.com/%s-hd.jpg' % name_id},
+            'genres': [{'name': u'драма', 'translit': 'drama', 'id': 1}],
+            'countries': [{'name': u'США', 'translit': 'usa', 'id': 2}],
+            'persons': {'actors': persons,
+                        'director': persons[:1],
+                        'scenarist': persons[1:3]},
+            'similar': similar,
+            'breadcrumbs': [{'title': u'Фильмы', 'url': '/movies'}],
+            }
+
+def _fill_cache( cache, count ):
+    items = []
+    for i in xrange(count):
+        items.append({'name_id': 'title-%d' % i,
+                      'season': 0,
+                      'time': time.time(),
+                      'data': _make_document('title-%d' % i),
+                      })
+    cache.set_details_list(items)
+    cache.flush()
+
+def _get_details_per_key( cache, keys ):
+    #Lookup before get_details_many: one query per key, as the original
+    #get_details did
+    c = cache.conn.cursor()
+    c.row_factory = None
+
+    min_time = time.time() - cache._time_delta
+
+    result = {}
+    accessed = []
+    for name_id, season in keys:
+        c.execute('SELECT data, last_access FROM details WHERE name_id = ? AND season = ? AND time >= ? LIMIT 1', (name_id, season, min_time))
+        row = c.fetchone()
+        if row is not None:
+            result[(name_id, season)] = cache._decode(row[0])
+            accessed.append((name_id, season, row[1]))
+
+    cache._touch_details(accessed)
+
+    return result
+
+def bench_details_lookup():
+    print('\n#bench_details_lookup')
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ZonaMobiCache(cache_dir)
+        _fill_cache(cache, 5000)
+
+        for count in [20, 100, 1000]:
+            keys = [('title-%d' % (i * 3), 0) for i in xrange(count)]
+
+            def per_key():
+                _get_details_per_key(cache, keys)
+
+            def bulk():
+                cache.get_details_many(keys)
+
+            assert _get_details_per_key(cache, keys) == cache.get_details_many(keys)
+
+            before = _measure(per_key, 20)
+            after = _measure(bulk, 20)
+
+            #Both lookups decode the same documents, without decoding only
+            #the queries are compared
+            cache._decode = lambda data: data
+            try:
+                before_queries = _measure(per_key, 20)
+                after_queries = _measure(bulk, 20)
+            finally:
+                del cache._decode
+
+            print('%5d keys: per key %8.2f ms, get_details_many %8.2f ms (x%.2f); queries only %6.2f -> %6.2f ms (x%.2f)' \
+                  % (count, before * 1000, after * 1000, before / after,
+                     before_queries * 1000, after_queries * 1000, before_queries / after_queries))
+
+            #The single query must be faster, end to end the decoding of
+            #the documents takes most of the time and hides the gain
+            if after_queries >= before_queries:
+                print('%5d keys: get_details_many queries are not faster than per key ones' % count)
+                options['failed'] = True
+            elif after >= before:
+                print('%5d keys: warning: get_details_many is not faster end to end' % count)
+    finally:
+        shutil.rmtree(cache_dir, True)
+
+def bench_details_storage():
+    print('\n#bench_details_storage')
+
+    count = 2000
+    cache_dir = tempfile.mkdtemp()
+    try:
+        #Version 1 format: raw page text
+        raw_path = os.path.join(cache_dir, 'raw.db')
+        conn = sqlite3.connect(raw_path)
+        conn.execute('CREATE TABLE details (name_id text, season integer, data text, time integer)')
+        conn.execute('CREATE UNIQUE INDEX details_idx ON details(name_id, season)')
+        rows = [('title-%d' % i, 0, json.dumps(_make_document('title-%d' % i)), time.time()) for i in xrange(count)]
+        conn.executemany('INSERT INTO details VALUES (?, ?, ?, ?)', rows)
+        conn.commit()
+
+        def decode_raw():
+            for row in conn.execute('SELECT data FROM details'):
+                json.loads(row[0])
+
+        cache = ZonaMobiCache(os.path.join(cache_dir, 'compact'))
+        _fill_cache(cache, count)
+        keys = [('title-%d' % i, 0) for i in xrange(count)]
+
+        def decode_compact():
+            cache.get_details_many(keys)
+
+        raw_size = os.path.getsize(raw_path)
+        compact_size = os.path.getsize(os.path.join(cache_dir, 'compact', 'cache.db'))
+        raw_time = _measure(decode_raw)
+        compact_time = _measure(decode_compact)
+
+        print('%d documents' % count)
+        print('raw text:  %8.1f KB, decode %8.2f ms' % (raw_size / 1024.0, raw_time * 1000))
+        print('compact:   %8.1f KB, decode %8.2f ms' % (compact_size / 1024.0, compact_time * 1000))
+
+        conn.close()
+    finally:
+        shutil.rmtree(cache_dir, True)
+
+def _make_season_document( name_id, season, count ):
+    document = _make_document(name_id, season)
+    document['serial'].update({'cover': 'https://example.com/%s/cover.jpg' % name_id,
+                               'runtime': None,
+                               })
+
+    episodes = {}
+    images = {}
+    for i in xrange(count, 0, -1):
+        mobi_link_id = season * 100000 + i
+        episodes[str(mobi_link_id)] = {'season': season,
+                                       'episode': i,
+                                       'episode_key': '%02d-%04d' % (season, i),
+                                       'mobi_link_id': mobi_link_id,
+                                       'release_date': '2015-01-01 00:00:00',
+                                       'title': u'Серия %d' % i,
+                                       }
+        images[str(mobi_link_id)] = 'https://example.com/%d.jpg' % mobi_link_id
+
+    document.update({'seasons': {'count': season},
+                     'episodes': {'count_all': count, 'items': episodes},
+                     'images': images,
+                     })
+    return document
+
+def bench_episodes_listing():
+    print('\n#bench_episodes_listing')
+
+    api = ZonaMobi('localhost')
+
+    for count in [100, 250, 500, 1000]:
+        data = _make_season_document('title', 1, count)
+
+        def make_list():
+            #Fresh copy, so no per-document data is reused between runs
+            document = json.loads(json.dumps(data))
+            items = api._make_eposode_list(document)
+            for video in api._make_list('episodes', document, items, document['serial']):
+                pass
+
+        elapsed = _measure(make_list, 3)
+        print('%5d episodes: %9.2f ms, %6.3f ms per episode' % (count, elapsed * 1000, elapsed * 1000 / count))
+
+    api.close()
+
+def _get_deep_size( obj, seen=None ):
+    #Size of the object with everything it refers to, shared objects
+    #are counted once
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += _get_deep_size(key, seen) + _get_deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for value in obj:
+            size += _get_deep_size(value, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            size += _get_deep_size(getattr(obj, name, None), seen)
+    return size
+
+def bench_item_model():
+    print('\n#bench_item_model')
+
+    api = ZonaMobi('localhost')
+    count = 1000
+
+    movies = [_make_document('title-%d' % i) for i in xrange(count)]
+    for document in movies:
+        document['movie']['cover'] = document['movie']['image']
+
+    season = _make_season_document('title', 1, count)
+    episodes = api._make_eposode_list(season)
+
+    listings = [('movies', lambda: [api._get_item_info(document, document['movie']) for document in movies]),
+                ('movies basic', lambda: [api._get_item_info(None, document['movie'], False) for document in movies]),
+                ('episodes', lambda: [api._get_item_info(season, season['serial'], params={'season': 1, 'episode': episode['episode']}) for episode in episodes]),
+                ]
+
+    for name, build in listings:
+        build_time = _measure(build, 3)
+        items = build()
+        dump_time = _measure(lambda: [item.get_dict() for item in items], 3)
+
+        #Memory held by the listing until it is handed to Kodi
+        size = _get_deep_size(items)
+        listitem_size = _get_deep_size([item.get_dict() for item in items])
+
+        print('%-12s %d items: build %7.2f ms (%6d items/s), get_dict %7.2f ms, items %7.1f KB, Kodi dicts %7.1f KB' \
+              % (name, count, build_time * 1000, count / build_time, dump_time * 1000, size / 1024.0, listitem_size / 1024.0))
+
+    api.close()
+
+def bench_built_items():
+    print('\n#bench_built_items')
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        api = ZonaMobi('localhost', {'cache_dir': cache_dir, 'load_details': True})
+        cache = api._cache
+        _fill_cache(cache, 1000)
+
+        for count in [20, 100, 1000]:
+            keys = [('title-%d' % i, 0) for i in xrange(count)]
+
+            def build():
+                details = cache.get_details_many(keys)
+                for key in keys:
+                    document = details[key]
+                    api._get_item_info(document, document['movie'])
+
+            for key in keys:
+                document = cache.get_details_many([key])[key]
+                api._save_built_item(key, {'type': 'movies', 'name_id': key[0]}, api._get_item_info(document, document['movie']))
+            cache.flush()
+
+            def load():
+                for record in api._get_built_items('movies', keys).itervalues():
+                    api._load_built_item(record)
+
+            before = _measure(build)
+            after = _measure(load)
+            print('%5d items: build from details %8.2f ms, load built %8.2f ms (x%.1f)' \
+                  % (count, before * 1000, after * 1000, before / after))
+
+        api.close()
+    finally:
+        shutil.rmtree(cache_dir, True)
+
+def bench_local_search():
+    print('\n#bench_local_search')
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ZonaMobiCache(cache_dir)
+        _fill_cache(cache, 5000)
+
+        queries = [('exact', u'Название title-4321'),
+                   ('prefix', u'назв title 43'),
+                   ('translit', u'nazvanie title 4321'),
+                   ]
+
+        #Same index is searched by LIKE where SQLite has no FTS4
+        fts = cache._has_fts()
+        for name, keyword in queries:
+            cache._fts = fts
+            indexed = _measure(lambda: cache.search_titles(keyword))
+            cache._fts = False
+            scanned = _measure(lambda: cache.search_titles(keyword))
+            print('5000 titles, %-8s: fts %8.2f ms, like %8.2f ms' % (name, indexed * 1000, scanned * 1000))
+        cache._fts = fts
+        cache.close()
+
+        #First page of results with a slow site, its responses are not
+        #taken from the cache
+        stub = ZonaMobiStub(latency=0.3)
+        site_url = stub.start()
+        try:
+            for mode in ['site', 'local', 'hybrid']:
+                api = ZonaMobi(site_url, {'cache_dir': cache_dir,
+                                          'search_mode': mode,
+                                          'search_wait': 0.1,
+                                          'force_refresh': True,
+                                          })
+                start = time.time()
+                count = len(list(api.get_video_list('search', {'keyword': 'title-4321'})['list']))
+                elapsed = time.time() - start
+                api.run_background_tasks()
+                api.close()
+                print('%-6s search: %3d items %8.2f ms' % (mode, count, elapsed * 1000))
+        finally:
+            stub.stop()
+    finally:
+        shutil.rmtree(cache_dir, True)
+
+def bench_cache_startup():
+    print('\n#bench_cache_startup')
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = ZonaMobiCache(cache_dir)
+        _fill_cache(cache, 5000)
+        cache.conn.close()
+
+        params = {'cache_dir': cache_dir}
+
+        def init_api():
+            ZonaMobi('localhost', params).close()
+
+        #Before: the cache was cleaned up every time it was opened
+        def init_api_with_maintenance():
+            api = ZonaMobi('localhost', params)
+            api._cache.maintain(True)
+            api.close()
+
+        #The first start may run cache maintenance
+        init_api()
+
+        before = _measure_average(init_api_with_maintenance, 20)
+        after = _measure_average(init_api, 20)
+        print('5000 cached documents: ZonaMobi() with maintenance %.2f ms, without %.2f ms on average' \
+              % (before * 1000, after * 1000))
+    finally:
+        shutil.rmtree(cache_dir, True)
+
+def _cache_invocation( args ):
+    cache_dir, worker, duration = args
+
+    invocations = 0
+    lock_errors = 0
+
+    #Every iteration acts as one plugin call: open, read a page, save
+    #a few fetched documents and close
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        try:
+            cache = ZonaMobiCache(cache_dir)
+
+            keys = [('title-%d' % random.randrange(2000), 0) for i in xrange(20)]
+            cache.get_details_many(keys)
+
+            #Network time of the missed documents
+            time.sleep(0.01)
+
+            items = []
+            for i in xrange(5):
+                name_id = 'worker-%d-%d' % (worker, random.randrange(500))
+                items.append({'name_id': name_id,
+                              'season': 0,
+                              'time': time.time(),
+                              'data': _make_document(name_id),
+                              })
+            cache.set_details_list(items)
+
+            cache.close()
+            invocations += 1
+        except sqlite3.OperationalError:
+            lock_errors += 1
+
+    return invocations, lock_errors
+
+def bench_cache_concurrency():
+    print('\n#bench_cache_concurrency')
+
+    duration = 3
+
+    for processes in [1, 4, 8, 16]:
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = ZonaMobiCache(cache_dir)
+            _fill_cache(cache, 2000)
+            cache.close()
+
+            pool = multiprocessing.Pool(processes)
+            results = pool.map(_cache_invocation, [(cache_dir, i, duration) for i in xrange(processes)])
+            pool.close()
+            pool.join()
+
+            invocations = sum([result[0] for result in results])
+            lock_errors = sum([result[1] for result in results])
+            print('%d processes: %7.1f invocations/s, %d lock errors' % (processes, float(invocations) / duration, lock_errors))
+        finally:
+            shutil.rmtree(cache_dir, True)
+
+def _api_movies( api ):
+    return list(api.get_video_list('movies')['list'])
+
+def _api_tvseries( api ):
+    return list(api.get_video_list('tvseries')['list'])
+
+def _api_seasons( api ):
+    return list(api.get_video_list('seasons', {'name_id': 'title-1'})['list'])
+
+def _api_episodes( api ):
+    return list(api.get_video_list('episodes', {'name_id': 'title-1', 'season': 1})['list'])
+
+def _api_search( api ):
+    return list(api.get_video_list('search', {'keyword': 'title'})['list'])
+
+def _api_content_url( api ):
+    return api.get_content_url({'type': 'episodes', 'name_id': 'title-1', 'season': 1, 'episode': 2})
+
+def _api_filters( api ):
+    return api.get_filters()
+
+API_SCENARIOS = [('movies', _api_movies),
+                 ('tvseries', _api_tvseries),
+                 ('seasons', _api_seasons),
+                 ('episodes', _api_episodes),
+                 ('search', _api_search),
+                 ('content_url', _api_content_url),
+                 ('filters', _api_filters),
+                 ]
+
+#Baseline is kept in the repository. It is made against the stub by
+#python benchmarks.py api --save-baseline, times depend on the machine,
+#so it is saved again on another one before changes are measured
+baseline_path = os.path.join(cwd, 'benchmarks_baseline.json')
+
+#Run is a regression if it is slower than the baseline by this ratio
+#plus a few ms of noise
+time_tolerance = 1.25
+time_slack = 0.01
+
+def _api_invocation( site_url, params, func, results ):
+    #One plugin call in a separate process, like Kodi does it
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    try:
+        start = time.time()
+        api = ZonaMobi(site_url, params)
+        func(api)
+        elapsed = time.time() - start
+        requests_count = api.get_transport_stats()['requests']
+        api.close()
+    except Exception as err:
+        results.put(err)
+        return
+
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory
+    results.put((elapsed, requests_count, memory))
+
+def _run_api_invocation( site_url, params, func ):
+    results = multiprocessing.Queue()
+
+    process = multiprocessing.Process(target=_api_invocation, args=(site_url, params, func, results))
+    process.start()
+    result = results.get()
+    process.join()
+
+    if isinstance(result, Exception):
+        raise result
+    elapsed, requests_count, memory = result
+
+    return {'time': elapsed,
+            'requests': requests_count,
+            'memory': memory,
+            }
+
+def _load_baseline():
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            return json.load(f)
+    return {}
+
+def _save_baseline( baseline ):
+    with open(baseline_path, 'w') as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+
+def bench_api():
+    print('\n#bench_api')
+
+    #Every response takes 20 ms like a near mirror. Traffic can be
+    #recorded to a cassette or replayed from one instead
+    stub = None
+    params = {'load_details': True,
+              'video_quality': 1,
+              }
+    if options.get('replay'):
+        site_url = 'w21.zona.plus'
+        ZonaMobiPlayer.load(options['replay'])
+        params.update({'cassette': options['replay'],
+                       'cassette_mode': 'replay',
+                       'cassette_latency': options.get('replay_latency', False),
+                       })
+    else:
+        stub = ZonaMobiStub(latency=0.02)
+        site_url = stub.start()
+        if options.get('record'):
+            params.update({'cassette': options['record'],
+                           'cassette_mode': 'record',
+                           })
+
+    baseline = _load_baseline()
+    results = {}
+    regressions = []
+
+    try:
+        for name, func in API_SCENARIOS:
+            cache_dir = tempfile.mkdtemp()
+            params['cache_dir'] = cache_dir
+            try:
+                for phase in ['cold', 'warm']:
+                    key = '%s_%s' % (name, phase)
+                    try:
+                        result = _run_api_invocation(site_url, params, func)
+                    except Exception as err:
+                        print('%-18s failed: %s' % (key, err))
+                        regressions.append(key)
+                        continue
+                    results[key] = result
+
+                    line = '%-18s %8.2f ms, %3d requests, %6d KB peak' \
+                           % (key, result['time'] * 1000, result['requests'], result['memory'])
+
+                    expected = baseline.get(key)
+                    if expected is not None:
+                        line += ' (baseline %8.2f ms, %3d requests)' % (expected['time'] * 1000, expected['requests'])
+                        if result['time'] > expected['time'] * time_tolerance + time_slack \
+                          or result['requests'] > expected['requests']:
+                            line += ' REGRESSION'
+                            regressions.append(key)
+                    print(line)
+            finally:
+                shutil.rmtree(cache_dir, True)
+    finally:
+        if stub is not None:
+            stub.stop()
+
+    if options.get('save_baseline'):
+        _save_baseline(results)
+        print('baseline saved to %s' % baseline_path)
+    elif regressions:
+        print('%d regressions: %s' % (len(regressions), ', '.join(regressions)))
+        options['failed'] = True
+
+def _listing_invocation( site_url, params, source, list_params, results ):
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    try:
+        start = time.time()
+        first = None
+        count = 0
+        api = ZonaMobi(site_url, params)
+        for item in api.get_video_list(source, list_params)['list']:
+            if first is None:
+                first = time.time() - start
+            count += 1
+        elapsed = time.time() - start
+        api.close()
+    except Exception as err:
+        results.put(err)
+        return
+
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory
+    results.put((first, elapsed, count, memory))
+
+def bench_listing_pipeline():
+    print('\n#bench_listing_pipeline')
+
+    #Pages of 100 items with large documents, details are loaded for
+    #every item of the page
+    stub = ZonaMobiStub(latency=0.02, payload_size=5, page_size=100, seasons=100)
+    site_url = stub.start()
+
+    listings = [('movies', {}),
+                ('seasons', {'name_id': 'title-1'}),
+                ]
+
+    try:
+        for source, list_params in listings:
+            cache_dir = tempfile.mkdtemp()
+            params = {'cache_dir': cache_dir,
+                      'load_details': True,
+                      'detail_workers': 8,
+                      }
+            try:
+                for phase in ['cold', 'warm']:
+                    results = multiprocessing.Queue()
+                    process = multiprocessing.Process(target=_listing_invocation,
+                                                      args=(site_url, params, source, list_params, results))
+                    process.start()
+                    result = results.get()
+                    process.join()
+
+                    if isinstance(result, Exception):
+                        print('%-8s %-4s: failed: %s' % (source, phase, result))
+                        options['failed'] = True
+                        continue
+
+                    first, elapsed, count, memory = result
+                    print('%-8s %-4s: first item %7.2f ms, %3d items %7.2f ms, %6d KB peak' \
+                          % (source, phase, first * 1000, count, elapsed * 1000, memory))
+            finally:
+                shutil.rmtree(cache_dir, True)
+    finally:
+        stub.stop()
+
+def bench_catalogue_sync():
+    print('\n#bench_catalogue_sync')
+
+    #1000 titles of each type in pages of 50, every title is in two
+    #genre and one country listing
+    stub = ZonaMobiStub(latency=0.02, page_size=50, total_pages=20)
+    site_url = stub.start()
+
+    try:
+        for workers, rate in [(1, 100), (4, 100), (4, 20)]:
+            cache_dir = tempfile.mkdtemp()
+            try:
+                api = ZonaMobi(site_url, {'cache_dir': cache_dir,
+                                          'catalogue_workers': workers,
+                                          'catalogue_rate': rate,
+                                          })
+                api.update_filters()
+                stub.reset()
+
+                start = time.time()
+                api.sync_catalogue(600)
+                elapsed = time.time() - start
+
+                pages = stub.get_requests_count()
+                c = api._catalogue.conn.cursor()
+                c.row_factory = None
+                titles = c.execute('SELECT COUNT(*) FROM titles').fetchone()[0]
+
+                #Next day only the first pages of the unfiltered listings
+                #are loaded
+                api.catalogue_ttl = 0
+                stub.reset()
+                api.sync_catalogue(600)
+                updated = stub.get_requests_count()
+                api.close()
+
+                size = os.path.getsize(os.path.join(cache_dir, 'catalogue.db'))
+                print('%d workers, %3d req/s: %4d pages %8.2f ms (%5.1f pages/s), %5d titles, %4d bytes per title, %d pages next day' \
+                      % (workers, rate, pages, elapsed * 1000, pages / elapsed, titles, size / titles, updated))
+            finally:
+                shutil.rmtree(cache_dir, True)
+    finally:
+        stub.stop()
+
+def _fill_catalogue( api, count ):
+    #Titles with 1-3 of 25 genres and 1-2 of 60 countries, walks of all
+    #the listings are finished like after sync_catalogue
+    random.seed(1)
+    genres = ['genre-g%d' % i for i in xrange(25)]
+    countries = ['country-c%d' % i for i in xrange(60)]
+
+    catalogue = api._get_catalogue()
+    walks = {}
+    def get_walk( walk_filter ):
+        if walk_filter not in walks:
+            walks[walk_filter] = {'type': 'movies', 'filter': walk_filter, 'page': 0, 'total_pages': 1,
+                                  'count': 0, 'started': time.time(), 'finished': None, 'rows': []}
+        return walks[walk_filter]
+
+    for i in xrange(count):
+        year = random.randint(1925, 2019)
+        item = {'name_id': 'title-%d' % i,
+                'name_rus': u'Название %d' % i,
+                'name_original': 'Title %d' % i,
+                'serial': False,
+                'year': year,
+                'cover': 'https://example.com/%d/cover.jpg' % i,
+                'release_date_int': u'%d января %d' % (random.randint(1, 28), year),
+                'rating': '%.1f' % random.uniform(1, 10),
+                'rating_imdb': '%.1f' % random.uniform(1, 10),
+                'rating_kinopoisk': '%.1f' % random.uniform(1, 10),
+                'mobi_link_id': i,
+                }
+        row = api._get_catalogue_row(item)
+        row.update({'type': 'movies', 'popularity': i, 'time': time.time()})
+
+        walk_filters = [''] + random.sample(genres, random.randint(1, 3)) + random.sample(countries, random.randint(1, 2))
+        for walk_filter in walk_filters:
+            get_walk(walk_filter)['rows'].append(dict(row, filter=walk_filter))
+
+    for walk in walks.itervalues():
+        rows = walk.pop('rows')
+        for start in xrange(0, len(rows), 1000):
+            walk['page'] += 1
+            catalogue.save_page(walk, rows[start:start + 1000])
+        walk['finished'] = time.time()
+        catalogue.finish_walk(walk)
+
+    catalogue.analyze()
+
+def bench_catalogue_query():
+    print('\n#bench_catalogue_query')
+
+    queries = [('popular, page 1', {}),
+               ('popular, page 500', {'page': 500}),
+               ('genre', {'genre': 'g1'}),
+               ('genre, page 50', {'genre': 'g1', 'page': 50}),
+               ('genre, 90s, by rating', {'genre': 'g1', 'year': '90s', 'sort': 'rating'}),
+               ('genre, country, by date', {'genre': 'g1', 'country': 'c1', 'sort': 'date'}),
+               ('year 2019, from 8', {'year': '2019', 'rating': '8'}),
+               ('old, by rating', {'year': 'old', 'sort': 'rating'}),
+               ('from 9, by date', {'rating': '9', 'sort': 'date'}),
+               ('100 per page', {'page_size': 100, 'sort': 'rating'}),
+               ]
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        api = ZonaMobi('localhost', {'cache_dir': cache_dir, 'catalogue_sync': True})
+        _fill_catalogue(api, 50000)
+
+        for name, params in queries:
+            elapsed = _measure(lambda: api._get_local_content_page('movies', params), 10)
+            data = api._get_local_content_page('movies', params)
+            print('50000 titles, %-24s: %7.2f ms, %3d items of %4d pages' \
+                  % (name, elapsed * 1000, len(data['items']), data['pagination']['total_pages']))
+
+        api.close()
+    finally:
+        shutil.rmtree(cache_dir, True)
+
+STARTUP_ACTIONS = [('root', '?action=root'),
+                   ('search_history', '?action=search_history'),
+                   ('list_movies', '?action=list_videos&cat=movies'),
+                   ('list_seasons', '?action=list_videos&cat=seasons&_name_id=title-1'),
+                   ('play', '?action=play&_type=movies&_name_id=title-1'),
+                   ]
+
+def bench_startup():
+    print('\n#bench_startup')
+
+    stub = ZonaMobiStub()
+    site_url = stub.start()
+
+    settings = {'site_url': site_url,
+                'history_length': 10,
+                'use_atl_names': False,
+                'video_rating': 0,
+                'video_quality': 0,
+                'load_details': False,
+                'detail_workers': 4,
+                'video_url_ttl': 10,
+                'cache_size': 50,
+                'stale_while_revalidate': True,
+                'prefetch': False,
+                'cassette_mode': 0,
+                'force_refresh': False,
+                }
+
+    config_dir = tempfile.mkdtemp()
+    try:
+        for name, query in STARTUP_ACTIONS:
+            #Every click is a new interpreter, the first one fills the cache
+            for phase in ['cold', 'warm']:
+                start = time.time()
+                output = subprocess.check_output([sys.executable, os.path.join(cwd, 'kodistub.py'),
+                                                  os.path.join(cwd, plugin_name), config_dir, json.dumps(settings), query])
+                elapsed = time.time() - start
+
+                result = json.loads(output.splitlines()[-1])
+                events = dict(result['events'])
+                listing = events.get('create_listing', events.get('resolve_url'))
+
+                print('%-16s %-4s: result %7.2f ms, process %7.2f ms, requests imported: %s' \
+                      % (name, phase, listing * 1000, elapsed * 1000, result['requests_imported']))
+    finally:
+        stub.stop()
+        shutil.rmtree(config_dir, True)
+
+BENCHMARKS = [('details_lookup', bench_details_lookup),
+              ('details_storage', bench_details_storage),
+              ('episodes_listing', bench_episodes_listing),
+              ('item_model', bench_item_model),
+              ('built_items', bench_built_items),
+              ('local_search', bench_local_search),
+              ('cache_startup', bench_cache_startup),
+              ('cache_concurrency', bench_cache_concurrency),
+              ('api', bench_api),
+              ('listing_pipeline', bench_listing_pipeline),
+              ('catalogue_sync', bench_catalogue_sync),
+              ('catalogue_query', bench_catalogue_query),
+              ('startup', bench_startup),
+              ]
+
+#Command line options: --save-baseline, --record=PATH, --replay=PATH
+#and --replay-latency
+options = {}
+
+def main( args ):
+    names = []
+    for arg in args:
+        if arg == '--save-baseline':
+            options['save_baseline'] = True
+        elif arg == '--replay-latency':
+            options['replay_latency'] = True
+        elif arg.startswith('--record='):
+            options['record'] = arg.split('=', 1)[1]
+        elif arg.startswith('--replay='):
+            options['replay'] = arg.split('=', 1)[1]
+        else:
+            names.append(arg)
+
+    for name, func in BENCHMARKS:
+        if not names or name in names:
+            func()
+
+    return 1 if options.get('failed') else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,201 @@
+# coding: utf-8
+# Module: kodistub
+
+# Minimal xbmc*, xbmcaddon and simpleplugin modules, enough to run
+# default.py outside of Kodi
+
+import os
+import sys
+import time
+import json
+import types
+import runpy
+import inspect
+import urllib
+import urlparse
+
+#Calls which hand the result to Kodi, with the time since start()
+events = []
+_start_time = [time.time()]
+
+def start():
+    _start_time[0] = time.time()
+
+def _add_event( name ):
+    events.append((name, time.time() - _start_time[0]))
+
+#Path of the last resolved item, it is "played" at once
+_playing_file = ['']
+
+class Player(object):
+
+    def isPlaying( self ):
+        return bool(_playing_file[0])
+
+    def isPlayingVideo( self ):
+        return bool(_playing_file[0])
+
+    def getPlayingFile( self ):
+        if not _playing_file[0]:
+            raise RuntimeError('Kodi is not playing any media file')
+        return _playing_file[0]
+
+class Monitor(object):
+
+    def waitForAbort( self, timeout=0 ):
+        return False
+
+class Keyboard(object):
+
+    def setDefault( self, text ):
+        pass
+
+    def setHeading( self, heading ):
+        pass
+
+    def doModal( self ):
+        pass
+
+    def isConfirmed( self ):
+        return False
+
+    def getText( self ):
+        return ''
+
+class Dialog(object):
+
+    def notification( self, *args, **kwargs ):
+        pass
+
+    def select( self, heading, items ):
+        return -1
+
+class Addon(object):
+
+    def getAddonInfo( self, name ):
+        return 'plugin.video.zona.mobi' if name == 'id' else 'ZONA.plus'
+
+class _Storage(dict):
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        return False
+
+class Plugin(object):
+
+    #Settings which are read as attributes of the plugin
+    settings = {}
+    config_dir = ''
+
+    def __init__( self ):
+        self._actions = {}
+        self.addon = Addon()
+        self.icon = 'icon.png'
+        self.fanart = 'fanart.jpg'
+
+    def __getattr__( self, name ):
+        if name in self.settings:
+            return self.settings[name]
+        raise AttributeError(name)
+
+    def initialize_gettext( self ):
+        return lambda text: text
+
+    def get_setting( self, id ):
+        return self.settings.get(id)
+
+    def set_setting( self, id, value ):
+        self.settings[id] = value
+
+    def log_error( self, message ):
+        pass
+
+    def get_url( self, **params ):
+        return 'plugin://plugin.video.zona.mobi/?%s' % urllib.urlencode(params)
+
+    def get_storage( self, name ):
+        return _Storage()
+
+    def mem_cached( self, duration ):
+        return lambda func: func
+
+    def action( self, name=None ):
+        def decorator( func ):
+            self._actions[name or func.__name__] = func
+            return func
+        return decorator
+
+    def create_listing( self, listing, **kwargs ):
+        #Kodi gets the items only when all of them are built
+        items = list(listing)
+        _add_event('create_listing')
+        return items
+
+    def resolve_url( self, path='', play_item=None, succeeded=True ):
+        _add_event('resolve_url')
+        if succeeded:
+            _playing_file[0] = play_item.get('path', '') if play_item else path
+        return play_item
+
+    def run( self ):
+        params = dict(urlparse.parse_qsl(sys.argv[2].lstrip('?')))
+        action = params.get('action', 'root')
+
+        func = self._actions[action]
+        if inspect.getargspec(func).args:
+            return func(params)
+        else:
+            return func()
+
+def install( settings, config_dir ):
+    #Modules are put to sys.modules before default.py is imported
+    xbmc = types.ModuleType('xbmc')
+    xbmc.Player = Player
+    xbmc.Monitor = Monitor
+    xbmc.Keyboard = Keyboard
+    xbmc.executebuiltin = lambda command: None
+    xbmc.getInfoLabel = lambda label: ''
+    xbmc.skinHasImage = lambda image: True
+
+    xbmcgui = types.ModuleType('xbmcgui')
+    xbmcgui.Dialog = Dialog
+    xbmcgui.NOTIFICATION_ERROR = 'error'
+
+    xbmcplugin = types.ModuleType('xbmcplugin')
+    for i, name in enumerate(['SORT_METHOD_UNSORTED', 'SORT_METHOD_LABEL', 'SORT_METHOD_LABEL_IGNORE_THE',
+                              'SORT_METHOD_TITLE_IGNORE_THE', 'SORT_METHOD_VIDEO_YEAR', 'SORT_METHOD_EPISODE']):
+        setattr(xbmcplugin, name, i)
+
+    xbmcaddon = types.ModuleType('xbmcaddon')
+    xbmcaddon.Addon = Addon
+
+    simpleplugin = types.ModuleType('simpleplugin')
+    simpleplugin.Plugin = Plugin
+
+    Plugin.settings = settings
+    Plugin.config_dir = config_dir
+
+    for module in [xbmc, xbmcgui, xbmcplugin, xbmcaddon, simpleplugin]:
+        sys.modules[module.__name__] = module
+
+def main( args ):
+    #kodistub.py PLUGIN_DIR CONFIG_DIR SETTINGS_JSON QUERY runs one plugin
+    #call and prints the events as JSON
+    start()
+
+    plugin_dir, config_dir, settings, query = args
+    install(json.loads(settings), config_dir)
+
+    sys.path.insert(0, plugin_dir)
+    sys.argv = ['plugin://plugin.video.zona.mobi/', '1', query]
+    runpy.run_path(os.path.join(plugin_dir, 'default.py'), run_name='__main__')
+    _add_event('exit')
+
+    print(json.dumps({'events': events,
+                      'requests_imported': 'requests' in sys.modules,
+                      }))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,6 +2,9 @@
 # Module: default
 # License: GPL v.3 https://www.gnu.org/copyleft/gpl.html
 
+import os
+import time
+
 import xbmc
 import xbmcgui
 import xbmcplugin
@@ -15,16 +18,109 @@ plugin = Plugin()
 _ = plugin.initialize_gettext()
 
 def _init_api():
-    settings_list = ['video_quality', 'load_details']
+    settings_list = ['video_quality', 'load_details', 'detail_workers', 'video_url_ttl', 'cache_size', 'stale_while_revalidate', 'prefetch',
+                     'catalogue_sync', 'hedge']
 
     settings = {}
     for id in settings_list:
         settings[id] = plugin.get_setting(id)
 
     settings['cache_dir'] = plugin.config_dir
+    settings['search_mode'] = ['site', 'local', 'hybrid'][plugin.get_setting('search_mode') or 0]
+
+    #Requests can be recorded and replayed for debugging and benchmarks
+    cassette_mode = plugin.get_setting('cassette_mode')
+    if cassette_mode:
+        settings['cassette'] = os.path.join(plugin.config_dir, 'cassette.jsonl')
+        settings['cassette_mode'] = 'record' if cassette_mode == 1 else 'replay'
+        settings['cassette_latency'] = (cassette_mode == 3)
+
+    #Forced refresh is done only once
+    settings['force_refresh'] = plugin.get_setting('force_refresh')
+    if settings['force_refresh']:
+        plugin.set_setting('force_refresh', False)
 
     return ZonaMobi(plugin.site_url, settings)
 
+class _LazyApi(object):
+    #API client and its cache are created by the first call which needs
+    #them, actions like root or search_history never do it
+
+    def __init__( self ):
+        self._api = None
+
+    def __getattr__( self, name ):
+        if self._api is None:
+            self._api = _init_api()
+        return getattr(self._api, name)
+
+    def is_created( self ):
+        return self._api is not None
+
+class _PlaybackChecker(xbmc.Player):
+    #Tells whether Kodi has started playing the path, None until it has
+    #started or failed. Another file which starts playing ends the check
+    #without a result
+
+    def __init__( self, path ):
+        super(_PlaybackChecker, self).__init__()
+        self.path = path
+        self.result = None
+        self.finished = False
+
+        #Playback may have started before the checker was created, another
+        #file may still be playing until it starts
+        if self.isPlaying():
+            self._check_file(started=False)
+
+    def _check_file( self, started=True ):
+        try:
+            playing_file = self.getPlayingFile()
+        except RuntimeError:
+            return
+        #Kodi may add request headers to the path after |
+        if playing_file.split('|')[0] == self.path.split('|')[0]:
+            self.result = True
+            self.finished = True
+        elif started:
+            self.finished = True
+
+    def onAVStarted( self ):
+        self._check_file()
+
+    def onPlayBackStarted( self ):
+        self._check_file()
+
+    def onPlayBackError( self ):
+        self._fail()
+
+    def onPlayBackStopped( self ):
+        self._fail()
+
+    def onPlayBackEnded( self ):
+        self._fail()
+
+    def _fail( self ):
+        #Only playback which has not started yet fails
+        if self.result is None:
+            self.result = False
+        self.finished = True
+
+def _check_playback( path, timeout=15 ):
+    #Cached link is dropped if Kodi could not start playing it. A slow
+    #start is not a failure, the link is kept when the wait runs out
+    player = _PlaybackChecker(path)
+    monitor = xbmc.Monitor()
+
+    start = time.time()
+    while not player.finished \
+      and time.time() - start < timeout:
+        if monitor.waitForAbort(0.1):
+            return
+
+    if player.result is False:
+        _api.invalidate_video_url(path)
+
 def _get_rating_source():
     rating_source = plugin.video_rating
     if rating_source == 0: source = 'zona'
@@ -288,11 +384,13 @@ def _make_item( video_item, search ):
         item_info = video_item['item_info']
         video_info = video_item['video_info']
 
-        if item_info.get('ratings'):
+        video = item_info.video
+
+        if item_info.ratings:
             rating_source = _get_rating_source()
-            for rating in item_info['ratings']:
-                if rating['type'] == rating_source:
-                    rating['defaultt'] = True
+            for rating in item_info.ratings:
+                if rating.type == rating_source:
+                    rating.defaultt = True
 
         if video_type == 'movies':
             is_folder = False
@@ -303,22 +401,22 @@ def _make_item( video_item, search ):
                 label_list.append('[%s] ' % _('Movies').decode('utf-8'))
 
             if use_atl_names:
-                title = item_info['info']['video']['originaltitle']
+                title = video.originaltitle
             else:
-                title = item_info['info']['video']['title']
+                title = video.title
 
             label_list.append(title)
 
             if use_atl_names \
-              and item_info['info']['video']['year'] > 0:
-                label_list.append(' (%d)' % item_info['info']['video']['year'])
+              and video.year > 0:
+                label_list.append(' (%d)' % video.year)
 
             if use_atl_names or search:
-                del item_info['info']['video']['title']
+                video.title = None
 
             if video_info.get('have_trailer'):
                 trailer_url = plugin.get_url(action='trailer', _type = video_type, _name_id = video_info['name_id'])
-                item_info['info']['video']['trailer'] = trailer_url
+                video.trailer = trailer_url
 
         elif video_type == 'tvseries':
             is_folder = True
@@ -327,20 +425,20 @@ def _make_item( video_item, search ):
 
             if video_info.get('have_trailer'):
                 trailer_url = plugin.get_url(action='trailer', _type = video_type, _name_id = video_info['name_id'])
-                item_info['info']['video']['trailer'] = trailer_url
+                video.trailer = trailer_url
 
             if search:
                 label_list.append('[%s] ' % _('TV Series').decode('utf-8'))
 
             if use_atl_names:
-                title = item_info['info']['video']['originaltitle']
+                title = video.originaltitle
             else:
-                title = item_info['info']['video']['title']
+                title = video.title
             label_list.append(title)
 
             if use_atl_names \
-              and item_info['info']['video']['year'] > 0:
-                label_list.append(' (%d)' % item_info['info']['video']['year'])
+              and video.year > 0:
+                label_list.append(' (%d)' % video.year)
 
         elif video_type == 'seasons':
             is_folder = True
@@ -361,49 +459,54 @@ def _make_item( video_item, search ):
             if use_atl_names:
                 label_list.append(video_info['originaltitle'])
                 label_list.append('.s%02de%02d' % (video_info['season'], video_info['episode']))
-                if item_info['info']['video']['title']:
-                    label_list.append('.%s' % (item_info['info']['video']['title']))
+                if video.title:
+                    label_list.append('.%s' % (video.title))
             else:
-                if not item_info['info']['video']['title']:
-                    item_info['info']['video']['title'] = '%s %d' % (_('Episode').decode('utf-8'), video_info['episode'])
-                label_list.append(item_info['info']['video']['title'])
+                if not video.title:
+                    video.title = '%s %d' % (_('Episode').decode('utf-8'), video_info['episode'])
+                label_list.append(video.title)
 
             if use_atl_names:
-                del item_info['info']['video']['title']
+                video.title = None
+
+        item_info.label = ''.join(label_list)
+        item_info.url = url
+        item_info.is_playable = is_playable
+        item_info.is_folder = is_folder
+
+        return _get_listitem(item_info)
+
+def _get_listitem( item_info ):
+    #Items are converted to the format of simpleplugin only here, when
+    #they are handed to Kodi
+    video = item_info.video
+
+    for rating in item_info.ratings:
+        if rating.defaultt:
+            if rating.rating:
+                video.rating = rating.rating
+            if rating.votes:
+                video.votes = rating.votes
+            break
+
+    listitem = item_info.get_dict()
 
-        item_info['label'] = ''.join(label_list)
-        item_info['url'] = url
-        item_info['is_playable'] = is_playable
-        item_info['is_folder'] = is_folder
+    listitem['info']['video']['cast'] = [member.name for member in item_info.cast]
+    listitem['info']['video']['castandrole'] = [(member.name, member.role) for member in item_info.cast]
 
-        _backward_capatibility(item_info)
+    _backward_capatibility(listitem)
 
-        return item_info
+    return listitem
 
 def _backward_capatibility( item_info ):
     major_version = xbmc.getInfoLabel('System.BuildVersion')[:2]
 
-    for rating in item_info.get('ratings', []):
-        if rating['defaultt']:
-            if rating['rating']:
-                item_info['info']['video']['rating'] = rating['rating']
-            if rating['votes']:
-                item_info['info']['video']['votes'] = rating['votes']
-            break
-
-    cast = []
-    castandrole = []
-    for cast_ in item_info.get('cast',[]):
-        cast.append(cast_['name'])
-        castandrole.append((cast_['name'], cast_.get('role')))
-    item_info['info']['video']['cast'] = cast
-    item_info['info']['video']['castandrole'] = castandrole
-
     if major_version < '18':
         for fields in ['genre', 'writer', 'director', 'country', 'credits']:
             item_info['info']['video'][fields] = ' / '.join(item_info['info']['video'].get(fields,[]))
 
-    if major_version < '15':
+    if major_version < '15' \
+      and item_info['info']['video'].get('duration'):
         item_info['info']['video']['duration'] = (item_info['info']['video']['duration'] / 60)
 
 def _make_category_label( color, title, category ):
@@ -428,8 +531,8 @@ def _get_image( image ):
 def get_video_details( params ):
     return _api.get_content_details(params)
 
-@plugin.mem_cached(180)
 def get_filters():
+    #Catalogue is saved by the api and never waits for the site
     return _api.get_filters()
 
 @plugin.mem_cached(180)
@@ -450,7 +553,6 @@ def search( params ):
     usearch  = (params.get('usearch') == 'True')
 
     new_search = (keyword == '')
-    succeeded = False
 
     if not keyword:
         kbd = xbmc.Keyboard()
@@ -474,7 +576,6 @@ def search( params ):
         return
 
     if keyword:
-        succeeded = True
         params['action'] = 'list_videos'
         params['cat'] = 'search'
         params['_keyword'] = keyword
@@ -540,16 +641,61 @@ def select_filer( params ):
         url = plugin.get_url(action='list_videos', update_listing=True, **params)
         xbmc.executebuiltin('Container.Update("%s")' % url)
 
+@plugin.action()
+def stats( params ):
+    if params.get('reset') == 'True':
+        _api.reset_metrics()
+        _show_notification(_('Statistics have been reset'))
+        xbmc.executebuiltin('Container.Refresh')
+        return
+
+    return plugin.create_listing(_list_stats(), content='files', sort_methods=[xbmcplugin.SORT_METHOD_LABEL])
+
+def _list_stats():
+    yield {'label': _('Reset statistics'),
+           'url': plugin.get_url(action='stats', reset=True),
+           'icon': plugin.icon,
+           'fanart': plugin.fanart,
+           'is_folder': False,
+           'properties': {'SpecialSort': 'top'}}
+
+    for action, metrics in _api.get_metrics().iteritems():
+        yield {'label': _format_metrics(action, metrics),
+               'url': plugin.get_url(action='stats'),
+               'icon': plugin.icon,
+               'fanart': plugin.fanart,
+               'is_folder': False}
+
+def _format_metrics( action, metrics ):
+    parts = []
+
+    if metrics['requests']:
+        parts.append('%s: %d' % (_('Requests'), metrics['requests']))
+        if metrics['errors']:
+            parts.append('%s: %d' % (_('Errors'), metrics['errors']))
+        if metrics['p50'] is not None:
+            parts.append('p50/p95/p99: %d/%d/%d ms' % (metrics['p50'], metrics['p95'], metrics['p99']))
+        parts.append('%.1f KB' % (metrics['avg_bytes'] / 1024.0))
+        parts.append('JSON %.1f ms' % metrics['decode_ms'])
+
+    if metrics['hit_ratio'] is not None:
+        parts.append('%s: %d%%' % (_('Cache hits'), metrics['hit_ratio'] * 100))
+        if metrics['stale']:
+            parts.append('%s: %d' % (_('Stale'), metrics['stale']))
+
+    return '%s  [COLOR=gray]%s[/COLOR]' % (action, ', '.join(parts))
+
 @plugin.action()
 def play( params ):
 
     u_params = _get_request_params( params )
     try:
-        item = _api.get_content_url( u_params )
+        item_info = _api.get_content_url( u_params )
         succeeded = True
         if u_params['type'] == 'episodes' \
-           and not item['info']['video']['title']:
-            item['info']['video']['title'] = '%s %d' % (_('Episode').decode('utf-8'), item['info']['video']['episode'])
+           and not item_info.video.title:
+            item_info.video.title = '%s %d' % (_('Episode').decode('utf-8'), item_info.video.episode)
+        item = item_info.get_dict()
     except ZonaMobiApiError as err:
         _show_api_error(err)
         item = None
@@ -573,6 +719,17 @@ def trailer( params ):
 
 if __name__ == '__main__':
 
-    _api = _init_api()
-    plugin.run()
+    _api = _LazyApi()
+    try:
+        plugin.run()
+        #Playback of a cached link is checked before the background tasks,
+        #which may take long
+        if _api.is_created():
+            if _api.cached_video_url:
+                _check_playback(_api.cached_video_url)
+            _api.run_background_tasks(plugin.log_error)
+    finally:
+        #Writes of the call are saved by close() even if the listing fails
+        if _api.is_created():
+            _api.close()
     
\ No newline at end of file
@@ -1,140 +1,1887 @@
 # -*- coding: utf-8 -*-
 # License: GPL v.3 https://www.gnu.org/copyleft/gpl.html
 
-import requests
 import urllib
+import urlparse
 import os
-import sqlite3
+import re
 import time
+import random
+import threading
+import itertools
+import traceback
+import Queue
+import zlib
+import base64
 try:
     import json
 except ImportError:
     import simplejson as json
 
+#requests takes most of the import time, it is loaded with the first
+#transport, so plugin calls which never go to the site do not pay for it
+requests = None
+
+def _import_requests():
+    global requests
+    if requests is None:
+        import requests
+
+#sqlite3 is loaded with the cache or the catalogue, calls which open
+#neither of them do not pay for it
+sqlite3 = None
+
+def _import_sqlite3():
+    global sqlite3
+    if sqlite3 is None:
+        import sqlite3
+
 class ZonaMobiApiError(Exception):
     """Custom exception"""
     pass
 
-class ZonaMobiCache:
+class ZonaMobiCache:
+
+    #Fields of detail documents which are used by the item builders,
+    #everything else is dropped before saving
+    _item_fields = {'name_id': None,
+                    'name_rus': None,
+                    'name_eng': None,
+                    'name_original': None,
+                    'serial': None,
+                    'year': None,
+                    'image': None,
+                    'cover': None,
+                    'description': None,
+                    'runtime': None,
+                    'release_date_int': None,
+                    'release_date_rus': None,
+                    'mobi_link_id': None,
+                    'mobi_link_date': None,
+                    'trailer': None,
+                    'trailer_url': None,
+                    'rating': None,
+                    'rating_count': None,
+                    'rating_imdb': None,
+                    'rating_imdb_count': None,
+                    'rating_kinopoisk': None,
+                    'rating_kinopoisk_count': None,
+                    }
+
+    _episode_fields = {'season': None,
+                       'episode': None,
+                       'episode_key': None,
+                       'mobi_link_id': None,
+                       'release_date': None,
+                       'title': None,
+                       }
+
+    #Latin forms of titles are indexed too, so a title can be found by
+    #a query typed in another alphabet
+    _translit = {u'а': u'a', u'б': u'b', u'в': u'v', u'г': u'g', u'д': u'd', u'е': u'e', u'ё': u'e',
+                 u'ж': u'zh', u'з': u'z', u'и': u'i', u'й': u'y', u'к': u'k', u'л': u'l', u'м': u'm',
+                 u'н': u'n', u'о': u'o', u'п': u'p', u'р': u'r', u'с': u's', u'т': u't', u'у': u'u',
+                 u'ф': u'f', u'х': u'h', u'ц': u'ts', u'ч': u'ch', u'ш': u'sh', u'щ': u'sch', u'ъ': u'',
+                 u'ы': u'y', u'ь': u'', u'э': u'e', u'ю': u'yu', u'я': u'ya',
+                 }
+
+    _details_fields = {'movie': _item_fields,
+                       'serial': _item_fields,
+                       'backdrops': {'image_1280': None},
+                       'genres': [{'name': None}],
+                       'countries': [{'name': None}],
+                       'persons': {'actors': [{'name': None, 'cover': None}],
+                                   'director': [{'name': None}],
+                                   'scenarist': [{'name': None}],
+                                   },
+                       'seasons': {'count': None},
+                       'episodes': {'count_all': None,
+                                    'items': [_episode_fields],
+                                    },
+                       'images': None,
+                       }
+
+    def __init__( self, cache_dir, cache_hours=48, max_size=50, stale_hours=0 ):
+        self._version = 9
+
+        self._time_delta = cache_hours * 3600 #time in seconds
+        #Details older than cache_hours can still be returned as stale
+        #until they are stale_hours old
+        self._stale_delta = max(stale_hours * 3600, self._time_delta)
+        self._max_size = max_size * 1024 * 1024 #size in bytes
+
+        #Maintenance is done not more often than once in interval
+        self._maintenance_interval = 3600
+        #last_access is refreshed when it is older than this
+        self._access_delta = 3600
+
+        #Writes are collected during the plugin call and saved by flush()
+        #in one short transaction, saved data is visible to this instance
+        #before that. Details are kept encoded so that the documents can
+        #be released by the caller
+        self._writes = []
+        self._pending_details = {}
+        self._pending_responses = {}
+        self._pending_meta = {}
+
+        #Whether search_index is a full-text table
+        self._fts = None
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        db_path = os.path.join(cache_dir, 'cache.db')
+
+        #Several plugin processes can use the cache at the same time.
+        #Transactions are started explicitly, so readers never hold locks
+        #and writers wait for each other instead of failing
+        _import_sqlite3()
+        self.conn = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+        self.conn.row_factory = self._dict_factory
+
+        #Journal mode is kept in the file, if it is busy now it will be
+        #switched next time
+        try:
+            self.conn.execute('PRAGMA journal_mode = WAL').fetchall()
+        except sqlite3.OperationalError:
+            pass
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+
+        if self._database_exists():
+            self.check_for_update()
+        else:
+            self.create_database()
+
+    def _dict_factory(self, cursor, row):
+        d = {}
+        for idx, col in enumerate(cursor.description):
+            d[col[0]] = row[idx]
+        return d
+
+    def _database_exists(self):
+
+        c = self.conn.cursor()
+        c.execute('SELECT name FROM sqlite_master WHERE type = \'table\' AND name = \'version\'')
+
+        return c.fetchone() is not None
+
+    def _begin(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def _commit(self):
+        self.conn.execute('COMMIT')
+
+    def _rollback(self):
+        self.conn.execute('ROLLBACK')
+
+    def check_for_update(self):
+
+        c = self.conn.cursor()
+        c.execute('SELECT idVersion FROM version LIMIT 1')
+
+        result = c.fetchone()
+        if result['idVersion'] < self._version:
+            self._begin()
+
+            #Another process may have updated it already
+            c.execute('SELECT idVersion FROM version LIMIT 1')
+            result = c.fetchone()
+            if result['idVersion'] >= self._version:
+                self._rollback()
+                return
+
+            if result['idVersion'] < 2:
+                self._convert_details_v2()
+            if result['idVersion'] < 3:
+                self._create_responses_table()
+            if result['idVersion'] < 4:
+                self._create_video_urls_table()
+            if result['idVersion'] < 5:
+                self._update_details_v5()
+                self._create_meta_table()
+            if result['idVersion'] < 6:
+                self._create_metrics_table()
+            if result['idVersion'] < 7:
+                self._create_item_infos_table()
+            if result['idVersion'] < 8:
+                self._create_search_tables()
+                self._index_details_v8()
+
+            #Version 9 is set when the database is in incremental
+            #auto_vacuum mode, see _convert_auto_vacuum_v9
+            version = self._version
+            if self.conn.execute('PRAGMA auto_vacuum').fetchone()['auto_vacuum'] != 2:
+                version = 8
+
+            c.execute('DELETE FROM version')
+            c.execute('INSERT INTO version (idVersion) VALUES (:version)', {'version': version} )
+
+            self._commit()
+
+            if version < self._version:
+                self._convert_auto_vacuum_v9()
+
+    def _convert_auto_vacuum_v9(self):
+        #Databases older than version 5 get incremental auto_vacuum mode,
+        #it is applied by full VACUUM once. VACUUM does not wait while
+        #another plugin process writes to the database, then it is tried
+        #again on the next start
+        self.conn.execute('PRAGMA busy_timeout = 0')
+        try:
+            self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            self.conn.execute('VACUUM')
+        except sqlite3.OperationalError:
+            return
+        finally:
+            self.conn.execute('PRAGMA busy_timeout = 10000')
+
+        self._execute([('UPDATE version SET idVersion = :version', [{'version': self._version}])])
+
+    def _update_details_v5(self):
+
+        c = self.conn.cursor()
+        c.execute('ALTER TABLE details ADD COLUMN last_access integer')
+        c.execute('UPDATE details SET last_access = time')
+        c.execute('CREATE INDEX details_time_idx ON details(time)')
+        c.execute('CREATE INDEX details_access_idx ON details(last_access)')
+
+    def _convert_details_v2(self):
+        #Version 1 kept the raw page text, re-save it in the compact format
+        c = self.conn.cursor()
+        c.row_factory = None
+
+        rows = c.execute('SELECT name_id, season, data, time FROM details').fetchall()
+
+        c.execute('DELETE FROM details')
+
+        items = []
+        for name_id, season, data, time_ in rows:
+            try:
+                document = json.loads(data)
+            except (TypeError, ValueError):
+                continue
+            items.append({'name_id': name_id,
+                          'season': season,
+                          'data': self._encode(document),
+                          'time': time_,
+                          })
+
+        c.executemany('INSERT OR REPLACE INTO details (name_id, season, data, time) VALUES (:name_id, :season, :data, :time)', items)
+
+    def _project(self, value, fields):
+        if fields is None:
+            return value
+
+        if isinstance(fields, list):
+            if isinstance(value, list):
+                return [self._project(val, fields[0]) for val in value]
+            elif isinstance(value, dict):
+                result = {}
+                for key, val in value.iteritems():
+                    result[key] = self._project(val, fields[0])
+                return result
+            return value
+
+        if not isinstance(value, dict):
+            return value
+
+        result = {}
+        for key, sub_fields in fields.iteritems():
+            if key in value:
+                result[key] = self._project(value[key], sub_fields)
+        return result
+
+    def _encode(self, document):
+        data = json.dumps(self._project(document, self._details_fields), separators=(',', ':'))
+        return sqlite3.Binary(zlib.compress(data))
+
+    def _decode(self, data):
+        return json.loads(zlib.decompress(data))
+
+    def create_database(self):
+
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+        self._begin()
+
+        #Another process may have created it already
+        if self._database_exists():
+            self._rollback()
+            self.check_for_update()
+            return
+
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE version (idVersion integer)')
+        c.execute('CREATE TABLE details (name_id text, season integer, data blob, time integer, last_access integer)')
+
+        c.execute('CREATE UNIQUE INDEX details_idx ON details(name_id, season)')
+        c.execute('CREATE INDEX details_time_idx ON details(time)')
+        c.execute('CREATE INDEX details_access_idx ON details(last_access)')
+        c.execute('INSERT INTO version (idVersion) VALUES (:version)', {'version': self._version} )
+
+        self._create_responses_table()
+        self._create_video_urls_table()
+        self._create_meta_table()
+        self._create_metrics_table()
+        self._create_item_infos_table()
+        self._create_search_tables()
+
+        self._commit()
+
+    def _create_meta_table(self):
+
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE meta (key text PRIMARY KEY, value text)')
+
+    def _get_meta(self, key):
+
+        if key in self._pending_meta:
+            return self._pending_meta[key]
+
+        c = self.conn.cursor()
+        c.execute('SELECT value FROM meta WHERE key = :key', {'key': key})
+
+        result = c.fetchone()
+        if result is not None:
+            return result['value']
+
+    def _set_meta(self, key, value):
+
+        self._pending_meta[key] = value
+        self._writes.append(('INSERT OR REPLACE INTO meta (key, value) VALUES (:key, :value)', [{'key': key, 'value': value}]))
+
+    def get_latency(self, action):
+
+        value = self._get_meta('latency_%s' % action)
+        if value:
+            return json.loads(value)
+        else:
+            return []
+
+    def set_latency(self, action, samples):
+
+        self._set_meta('latency_%s' % action, json.dumps(samples))
+
+    def get_mirrors(self):
+
+        value = self._get_meta('mirrors')
+        if value:
+            return json.loads(value)
+
+    def set_mirrors(self, mirrors):
+
+        self._set_meta('mirrors', json.dumps(mirrors))
+
+    def get_filters(self):
+
+        value = self._get_meta('filters')
+        if value:
+            return json.loads(value)
+
+    def set_filters(self, filters):
+
+        self._set_meta('filters', json.dumps(filters))
+
+    def _create_metrics_table(self):
+
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE metrics (action text, name text, value integer, PRIMARY KEY (action, name))')
+
+    def get_metrics(self):
+
+        c = self.conn.cursor()
+        c.execute('SELECT action, name, value FROM metrics')
+
+        result = {}
+        for row in c:
+            result.setdefault(row['action'], {})[row['name']] = row['value']
+        return result
+
+    def add_metrics(self, metrics):
+        #Counters of the current invocation are added to the saved ones
+        items = []
+        for action, counters in metrics.iteritems():
+            for name, value in counters.iteritems():
+                items.append({'action': action, 'name': name, 'value': int(value)})
+
+        if items:
+            self._writes.append(('INSERT OR IGNORE INTO metrics (action, name, value) VALUES (:action, :name, 0)', items))
+            self._writes.append(('UPDATE metrics SET value = value + :value WHERE action = :action AND name = :name', items))
+
+    def reset_metrics(self):
+
+        self._writes.append(('DELETE FROM metrics', [{}]))
+
+    def _create_responses_table(self):
+
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE responses (key text PRIMARY KEY, action text, data blob, expires integer)')
+
+    def _create_video_urls_table(self):
+
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE video_urls (mobi_link_id text PRIMARY KEY, lq_url text, url text, expires integer)')
+
+    def _create_item_infos_table(self):
+        #Items built from the details, they live and die with the details
+        #document of (name_id, season)
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE item_infos (name_id text, season integer, episode integer, full_details integer, version integer, data blob, PRIMARY KEY (name_id, season, episode, full_details))')
+
+    def get_item_infos(self, keys, version):
+        #keys are (name_id, season, episode, full_details), only items of
+        #the builder version and with fresh details are returned
+        result = {}
+
+        names = {}
+        for key in keys:
+            name_id, season = key[:2]
+            #Pending details replace the saved ones on flush
+            if (name_id, season) not in self._pending_details:
+                names.setdefault(name_id, set()).add(key)
+
+        c = self.conn.cursor()
+        c.row_factory = None
+
+        accessed = []
+        name_ids = list(names)
+        for i in xrange(0, len(name_ids), 500):
+            chunk = name_ids[i:i + 500]
+            sql = 'SELECT i.name_id, i.season, i.episode, i.full_details, i.data, d.last_access FROM item_infos i' \
+                  ' JOIN details d ON d.name_id = i.name_id AND d.season = i.season' \
+                  ' WHERE i.name_id IN (%s) AND i.version = ? AND d.time >= ?' % ', '.join(['?'] * len(chunk))
+            for name_id, season, episode, full_details, data, last_access in c.execute(sql, chunk + [version, time.time() - self._time_delta]):
+                key = (name_id, season, episode, bool(full_details))
+                if key in names[name_id]:
+                    result[key] = json.loads(zlib.decompress(data).decode('utf-8'))
+                    accessed.append((name_id, season, last_access))
+
+        self._touch_details(accessed)
+
+        return result
+
+    def set_item_infos(self, items, version):
+
+        if items:
+            #Texts are saved as UTF-8, escaped ones take twice longer to
+            #decode
+            rows = []
+            for key, value in items:
+                name_id, season, episode, full_details = key
+                rows.append({'name_id': name_id,
+                             'season': season,
+                             'episode': episode,
+                             'full_details': int(full_details),
+                             'version': version,
+                             'data': sqlite3.Binary(zlib.compress(json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))),
+                             })
+
+            self._writes.append(('INSERT OR REPLACE INTO item_infos (name_id, season, episode, full_details, version, data) VALUES (:name_id, :season, :episode, :full_details, :version, :data)', rows))
+
+    def _create_search_tables(self):
+        #Titles of the cached details for local search. Full-text index is
+        #used where SQLite has FTS4, otherwise the same table is searched
+        #by LIKE
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE search_titles (name_id text PRIMARY KEY, year integer, data text)')
+        try:
+            c.execute('CREATE VIRTUAL TABLE search_index USING fts4(titles, translit, description)')
+        except sqlite3.OperationalError:
+            c.execute('CREATE TABLE search_index (docid INTEGER PRIMARY KEY, titles text, translit text, description text)')
+
+    def _index_details_v8(self):
+        #Titles of the details which are in the cache already
+        c = self.conn.cursor()
+        c.row_factory = None
+
+        items = []
+        for data, in c.execute('SELECT data FROM details WHERE season = 0').fetchall():
+            items.append({'data': self._decode(data)})
+
+        rows = self._get_search_rows(items)
+        c.executemany('INSERT OR REPLACE INTO search_titles (name_id, year, data) VALUES (:name_id, :year, :data)', rows)
+        c.executemany('INSERT INTO search_index (docid, titles, translit, description) SELECT rowid, :titles, :translit, :description FROM search_titles WHERE name_id = :name_id', rows)
+
+    def _has_fts(self):
+        if self._fts is None:
+            c = self.conn.cursor()
+            c.execute('SELECT sql FROM sqlite_master WHERE name = :name', {'name': 'search_index'})
+            self._fts = 'VIRTUAL' in c.fetchone()['sql'].upper()
+        return self._fts
+
+    def _get_words(self, text):
+        return re.findall(r'[^\W_]+', text.lower(), re.UNICODE)
+
+    def _get_translit(self, words):
+        result = []
+        for word in words:
+            result.append(u''.join([self._translit.get(char, char) for char in word]))
+        return result
+
+    def _get_search_rows(self, items):
+        #One row per title, seasons of a tvseries have the same title
+        rows = {}
+        for item in items:
+            document = item['data']
+            title = document.get('movie') or document.get('serial')
+            if not title \
+              or title['name_id'] in rows:
+                continue
+
+            #Names are separated to find the one equal to the query
+            names = []
+            for field in ['name_rus', 'name_eng', 'name_original']:
+                name = u' '.join(self._get_words(unicode(title.get(field) or u'')))
+                if name \
+                  and name not in names:
+                    names.append(name)
+
+            words = u' '.join(names).split()
+            translit = [word for word in self._get_translit(words) if word not in words]
+
+            data = self._project(title, self._item_fields)
+            data.pop('description', None)
+            if not data.get('cover'):
+                data['cover'] = data.get('image', '')
+
+            rows[title['name_id']] = {'name_id': title['name_id'],
+                                      'year': title.get('year'),
+                                      'data': json.dumps(data),
+                                      'titles': u' | '.join(names),
+                                      'translit': u' '.join(translit),
+                                      'description': u' '.join(self._get_words(title.get('description') or u'')),
+                                      }
+        return rows.values()
+
+    def search_titles(self, keyword, limit=50, offset=0):
+        #Titles which have all words of keyword as prefixes, best matches
+        #of the titles go first. Returns a page of them and their count
+        if isinstance(keyword, str):
+            keyword = keyword.decode('utf-8')
+
+        words = self._get_words(keyword)
+        if not words:
+            return [], 0
+
+        variants = [words]
+        translit = self._get_translit(words)
+        if translit != words:
+            variants.append(translit)
+
+        #Year is not a part of the indexed text, a word which looks like
+        #a year matches the year of the title as well
+        years = [word for word in words if self._is_year(word)]
+        if len(years) == 1:
+            year = years[0]
+            for variant in list(variants):
+                variants.append([word for word in variant if word != year] + [int(year)])
+
+        c = self.conn.cursor()
+        c.row_factory = None
+
+        rows = {}
+        for variant in variants:
+            text_words = [word for word in variant if not isinstance(word, int)]
+            conditions = []
+            sql_params = []
+            if text_words:
+                if self._has_fts():
+                    conditions.append('search_index MATCH ?')
+                    sql_params.append(u' '.join([word + u'*' for word in text_words]))
+                else:
+                    for word in text_words:
+                        conditions.append("(' ' || i.titles || ' ' || i.translit || ' ' || i.description) LIKE ?")
+                        sql_params.append(u'%% %s%%' % word)
+            if len(text_words) < len(variant):
+                conditions.append('t.year = ?')
+                sql_params.append(variant[-1])
+
+            sql = 'SELECT t.name_id, t.year, t.data, i.titles, i.translit FROM search_index i JOIN search_titles t ON t.rowid = i.docid' \
+                  ' WHERE %s LIMIT 500' % ' AND '.join(conditions)
+
+            for name_id, year, data, titles, translit in c.execute(sql, sql_params):
+                names = [name.split() for name in titles.split(u' | ')]
+                score = self._get_search_score(text_words, names, translit.split())
+                if len(text_words) < len(variant):
+                    score += 10
+                if name_id not in rows \
+                  or rows[name_id][0] < score:
+                    #Shorter names are closer to the query
+                    rows[name_id] = (score, -min([len(name) for name in names]), year or 0, data)
+
+        ranked = sorted(rows.values(), reverse=True)[offset:offset + limit]
+        return [json.loads(row[3]) for row in ranked], len(rows)
+
+    def _is_year(self, word):
+        return len(word) == 4 \
+               and word.isdigit() \
+               and 1900 <= int(word) <= 2100
+
+    def _get_search_score(self, words, names, translit):
+        #Whole words of the title count more than prefixes, words of the
+        #transliterated title count less, a match in description only
+        #counts least
+        titles = list(itertools.chain(*names))
+
+        score = 0
+        for word in words:
+            if word in titles:
+                score += 10
+            elif [title for title in titles if title.startswith(word)]:
+                score += 5
+            elif word in translit:
+                score += 4
+            elif [title for title in translit if title.startswith(word)]:
+                score += 2
+            else:
+                score += 1
+
+        #Name which is exactly the query is the best match
+        for name in names:
+            if words == name \
+              or words == self._get_translit(name):
+                score += 100
+                break
+
+        return score
+
+    def get_details(self, params, stale_keys=None):
+        key = (params['name_id'], params.get('season', 0))
+
+        result = self.get_details_many([key], stale_keys)
+
+        return result.get(key)
+
+    def get_details_many(self, keys, stale_keys=None):
+        #Stale documents are returned only if the caller collects their keys
+        #in stale_keys to refresh them
+        result = {}
+
+        names = {}
+        for key in keys:
+            data = self._pending_details.get(key)
+            if data is not None:
+                result[key] = self._decode(data)
+            else:
+                name_id, season = key
+                names.setdefault(name_id, set()).add(season)
+
+        c = self.conn.cursor()
+        c.row_factory = None
+
+        fresh_time = time.time() - self._time_delta
+        if stale_keys is not None:
+            min_time = time.time() - self._stale_delta
+        else:
+            min_time = fresh_time
+
+        #One query on the name_id index is about 1.4x faster than a query
+        #per key, but decoding the documents takes over 90% of the lookup,
+        #so end to end both are the same. Seasons are filtered too, so the
+        #documents of the other seasons of a tvseries are not read
+        seasons = list(set(itertools.chain(*names.values())))
+
+        accessed = []
+        name_ids = list(names)
+        #Keep well below SQLITE_MAX_VARIABLE_NUMBER
+        for i in xrange(0, len(name_ids), 500):
+            chunk = name_ids[i:i + 500]
+            sql = 'SELECT name_id, season, data, last_access, time FROM details WHERE name_id IN (%s) AND season IN (%s) AND time >= ?' \
+                  % (', '.join(['?'] * len(chunk)), ', '.join(['?'] * len(seasons)))
+            for name_id, season, data, last_access, time_ in c.execute(sql, chunk + seasons + [min_time]):
+                if season in names[name_id]:
+                    result[(name_id, season)] = self._decode(data)
+                    accessed.append((name_id, season, last_access))
+                    if time_ < fresh_time:
+                        stale_keys.append((name_id, season))
+
+        self._touch_details(accessed)
+
+        return result
+
+    def _touch_details(self, rows):
+        now = time.time()
+
+        items = []
+        for name_id, season, last_access in rows:
+            if not last_access \
+              or last_access < now - self._access_delta:
+                items.append({'name_id': name_id,
+                              'season': season,
+                              'last_access': now,
+                              })
+
+        if items:
+            self._writes.append(('UPDATE details SET last_access = :last_access WHERE name_id = :name_id AND season = :season', items))
+
+    def set_details(self, params, document):
+
+        item = {'data': document,
+                'name_id': params['name_id'],
+                'season': params.get('season', 0),
+                'time': time.time()}
+
+        self.set_details_list([item])
+
+    def set_details_list(self, items):
+
+        if items:
+            self._add_search_titles(items)
+
+            items = [dict(item, data=self._encode(item['data'])) for item in items]
+
+            for item in items:
+                self._pending_details[(item['name_id'], item['season'])] = item['data']
+
+            self._writes.append(('INSERT OR REPLACE INTO details (name_id, season, data, time, last_access) VALUES (:name_id, :season, :data, :time, :time)', items))
+            self._writes.append(('DELETE FROM item_infos WHERE name_id = :name_id AND season = :season', items))
+
+    def _add_search_titles(self, items):
+        #Search index is updated with the details
+        rows = self._get_search_rows(items)
+        if rows:
+            self._writes.append(('DELETE FROM search_index WHERE docid IN (SELECT rowid FROM search_titles WHERE name_id = :name_id)', rows))
+            self._writes.append(('INSERT OR REPLACE INTO search_titles (name_id, year, data) VALUES (:name_id, :year, :data)', rows))
+            self._writes.append(('INSERT INTO search_index (docid, titles, translit, description) SELECT rowid, :titles, :translit, :description FROM search_titles WHERE name_id = :name_id', rows))
+
+    def get_response(self, key):
+        sql_params = {'key': key,
+                      'time': time.time()}
+
+        data = self._pending_responses.get(key)
+        if data is not None:
+            return json.loads(data)
+
+        c = self.conn.cursor()
+        c.execute('SELECT data FROM responses WHERE key = :key AND expires >= :time LIMIT 1', sql_params)
+
+        result = c.fetchone()
+        if result is not None:
+            return json.loads(zlib.decompress(result['data']))
+
+    def set_response(self, key, action, content, ttl):
+
+        sql_params = {'key': key,
+                      'action': action,
+                      'data': sqlite3.Binary(zlib.compress(content)),
+                      'expires': time.time() + ttl}
+
+        self._pending_responses[key] = content
+        self._writes.append(('INSERT OR REPLACE INTO responses (key, action, data, expires) VALUES (:key, :action, :data, :expires)', [sql_params]))
+
+    def get_video_url(self, mobi_link_id):
+        sql_params = {'mobi_link_id': str(mobi_link_id),
+                      'time': time.time()}
+
+        c = self.conn.cursor()
+        c.execute('SELECT lq_url, url FROM video_urls WHERE mobi_link_id = :mobi_link_id AND expires >= :time LIMIT 1', sql_params)
+
+        result = c.fetchone()
+        if result is not None:
+            return {'lqUrl': result['lq_url'],
+                    'url': result['url'],
+                    }
+
+    def set_video_url(self, mobi_link_id, data, expires):
+
+        sql_params = {'mobi_link_id': str(mobi_link_id),
+                      'lq_url': data.get('lqUrl'),
+                      'url': data.get('url'),
+                      'expires': expires}
+
+        self._writes.append(('INSERT OR REPLACE INTO video_urls (mobi_link_id, lq_url, url, expires) VALUES (:mobi_link_id, :lq_url, :url, :expires)', [sql_params]))
+
+    def remove_video_url(self, path):
+
+        self._writes.append(('DELETE FROM video_urls WHERE lq_url = :path OR url = :path', [{'path': path}]))
+
+    def flush(self):
+        if not self._writes:
+            return True
+
+        writes = self._writes
+        self._writes = []
+        self._pending_details = {}
+        self._pending_responses = {}
+        self._pending_meta = {}
+
+        #Cached data can be lost, but it must not break the plugin call
+        try:
+            self._execute(writes)
+        except sqlite3.OperationalError:
+            return False
+
+        return True
+
+    def _execute(self, writes):
+        c = self.conn.cursor()
+
+        self._begin()
+        try:
+            for sql, items in writes:
+                c.executemany(sql, items)
+        except:
+            self._rollback()
+            raise
+        self._commit()
+
+    def maintain(self, force=False):
+        now = time.time()
+
+        last_maintenance = self._get_meta('last_maintenance')
+        if not force \
+          and last_maintenance is not None \
+          and now - float(last_maintenance) < self._maintenance_interval:
+            return False
+
+        self._set_meta('last_maintenance', str(now))
+        if not self.flush():
+            return False
+
+        try:
+            self.remove_old_data()
+            self.remove_least_used()
+            self._vacuum()
+        except sqlite3.OperationalError:
+            return False
+
+        return True
+
+    def remove_old_data(self):
+
+        now = time.time()
+
+        self._execute([('DELETE FROM details WHERE time < :time', [{'time': now - self._stale_delta}]),
+                       ('DELETE FROM responses WHERE expires < :time', [{'time': now}]),
+                       ('DELETE FROM video_urls WHERE expires < :time', [{'time': now}]),
+                       ])
+        self._remove_orphans()
+
+    def get_size(self):
+        page_size = self.conn.execute('PRAGMA page_size').fetchone()['page_size']
+        page_count = self.conn.execute('PRAGMA page_count').fetchone()['page_count']
+        freelist_count = self.conn.execute('PRAGMA freelist_count').fetchone()['freelist_count']
+
+        return (page_count - freelist_count) * page_size
+
+    def remove_least_used(self):
+        size = self.get_size()
+        if size <= self._max_size:
+            return
+
+        c = self.conn.cursor()
+        c.row_factory = None
+
+        #Details and cached responses take almost all the space, both lose
+        #the share of excess plus a margin, so eviction is not repeated on
+        #every maintenance. Details go by last access, responses which
+        #expire first go first
+        orders = [('details', 'last_access'), ('responses', 'expires')]
+        while size > self._max_size:
+            share = (size - self._max_size * 0.9) / size
+
+            writes = []
+            for table, order in orders:
+                count = c.execute('SELECT COUNT(*) FROM %s' % table).fetchone()[0]
+                if count:
+                    limit = int(count * share) + 1
+                    writes.append(('DELETE FROM %s WHERE rowid IN (SELECT rowid FROM %s ORDER BY %s LIMIT :limit)' % (table, table, order), [{'limit': limit}]))
+
+            if not writes:
+                break
+            self._execute(writes)
+
+            self._remove_orphans()
+
+            size = self.get_size()
+
+    def _remove_orphans(self):
+        #Built items and search titles are kept only with their details
+        self._execute([('DELETE FROM item_infos WHERE NOT EXISTS (SELECT 1 FROM details d WHERE d.name_id = item_infos.name_id AND d.season = item_infos.season)', [{}]),
+                       ('DELETE FROM search_index WHERE docid IN (SELECT rowid FROM search_titles WHERE name_id NOT IN (SELECT name_id FROM details))', [{}]),
+                       ('DELETE FROM search_titles WHERE name_id NOT IN (SELECT name_id FROM details)', [{}]),
+                       ])
+
+    def _vacuum(self):
+        #Only incremental, it does nothing while the database is not
+        #converted by _convert_auto_vacuum_v9
+        freelist_count = self.conn.execute('PRAGMA freelist_count').fetchone()['freelist_count']
+        page_count = self.conn.execute('PRAGMA page_count').fetchone()['page_count']
+
+        #Free pages are returned to file system when they take a tenth of it
+        if freelist_count * 10 > page_count:
+            self.conn.execute('PRAGMA incremental_vacuum').fetchall()
+
+    def close(self):
+        self.flush()
+        self.maintain()
+        self.conn.close()
+
+class ZonaMobiCatalogue:
+
+    #Local copy of the movies and tvseries listings. It is a separate
+    #database, so it is not counted in the cache size and long walks of
+    #the site do not hold the cache locked
+
+    #Listings are walked in descending order of these, titles which are
+    #not in the unfiltered listing yet go last by popularity. name_id
+    #makes the order of equal titles the same on every page. The site is
+    #taken to filter and sort by the zona rating, not by the IMDb or
+    #KinoPoisk one, tests.test_rating_filter_field checks it against the
+    #site or a cassette of it
+    _sorts = {'': 't.popularity, t.name_id',
+              'rating': 't.rating DESC, t.popularity, t.name_id',
+              'date': 't.premiered DESC, t.popularity, t.name_id',
+              }
+
+    def __init__(self, cache_dir):
+        self._version = 3
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        db_path = os.path.join(cache_dir, 'catalogue.db')
+
+        _import_sqlite3()
+        self.conn = sqlite3.connect(db_path, timeout=10, isolation_level=None)
+        self.conn.row_factory = self._dict_factory
+
+        try:
+            self.conn.execute('PRAGMA journal_mode = WAL').fetchall()
+        except sqlite3.OperationalError:
+            pass
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+
+        if self._database_exists():
+            self.check_for_update()
+        else:
+            self.create_database()
+
+    def _dict_factory(self, cursor, row):
+        d = {}
+        for idx, col in enumerate(cursor.description):
+            d[col[0]] = row[idx]
+        return d
+
+    def _database_exists(self):
+
+        c = self.conn.cursor()
+        c.execute('SELECT name FROM sqlite_master WHERE type = \'table\' AND name = \'version\'')
+
+        return c.fetchone() is not None
+
+    def _begin(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+
+    def _commit(self):
+        self.conn.execute('COMMIT')
+
+    def _rollback(self):
+        self.conn.execute('ROLLBACK')
+
+    def check_for_update(self):
+
+        c = self.conn.cursor()
+        c.execute('SELECT idVersion FROM version LIMIT 1')
+
+        result = c.fetchone()
+        if result['idVersion'] < self._version:
+            self._begin()
+
+            #Another process may have updated it already
+            c.execute('SELECT idVersion FROM version LIMIT 1')
+            result = c.fetchone()
+            if result['idVersion'] >= self._version:
+                self._rollback()
+                return
+
+            #Sort indexes of version 2 are made again with the whole order
+            if result['idVersion'] < 3:
+                self._update_sort_indexes_v3()
+
+            c.execute('DELETE FROM version')
+            c.execute('INSERT INTO version (idVersion) VALUES (:version)', {'version': self._version} )
+
+            self._commit()
+
+    def create_database(self):
+
+        self._begin()
+
+        #Another process may have created it already
+        if self._database_exists():
+            self._rollback()
+            return
+
+        c = self.conn.cursor()
+        c.execute('CREATE TABLE version (idVersion integer)')
+        c.execute('INSERT INTO version (idVersion) VALUES (:version)', {'version': self._version} )
+
+        #One row per title with the fields it is filtered and sorted by,
+        #data is the listing item. popularity is the position in the
+        #unfiltered listing
+        c.execute('CREATE TABLE titles (type text, name_id text, popularity integer, year integer, rating real, rating_imdb real, rating_kinopoisk real,'
+                  ' premiered text, added text, time real, data text, PRIMARY KEY (type, name_id))')
+
+        #Genres and countries of the titles, filter is the part of the
+        #site url like genre-drama
+        c.execute('CREATE TABLE title_filters (type text, filter text, name_id text, time real, PRIMARY KEY (type, filter, name_id))')
+
+        #Progress of the listing walks, a walk is continued from the page
+        #after the saved one
+        c.execute('CREATE TABLE walks (type text, filter text, page integer, total_pages integer, count integer, started real, finished real,'
+                  ' PRIMARY KEY (type, filter))')
+
+        c.execute('CREATE TABLE meta (key text PRIMARY KEY, value text)')
+
+        self._create_sort_indexes()
+
+        self._commit()
+
+    def _create_sort_indexes(self):
+        #Indexes end with the whole sort order, so a page is read in order
+        c = self.conn.cursor()
+        c.execute('CREATE INDEX titles_popularity_idx ON titles(type, popularity, name_id)')
+        c.execute('CREATE INDEX titles_rating_idx ON titles(type, rating DESC, popularity, name_id)')
+        c.execute('CREATE INDEX titles_premiered_idx ON titles(type, premiered DESC, popularity, name_id)')
+        c.execute('CREATE INDEX titles_year_idx ON titles(type, year)')
+
+    def _update_sort_indexes_v3(self):
+
+        c = self.conn.cursor()
+        for name in ['titles_popularity_idx', 'titles_rating_idx', 'titles_premiered_idx', 'titles_year_idx']:
+            c.execute('DROP INDEX IF EXISTS %s' % name)
+        self._create_sort_indexes()
+
+    def _execute(self, writes):
+        c = self.conn.cursor()
+
+        self._begin()
+        try:
+            for sql, items in writes:
+                c.executemany(sql, items)
+        except:
+            self._rollback()
+            raise
+        self._commit()
+
+    def get_walks(self):
+
+        c = self.conn.cursor()
+        c.execute('SELECT type, filter, page, total_pages, count, started, finished FROM walks')
+
+        result = {}
+        for row in c:
+            result[(row['type'], row['filter'])] = row
+        return result
+
+    def get_known_titles(self, content, name_ids):
+        #Titles which are in the unfiltered listing already
+        if not name_ids:
+            return set()
+
+        c = self.conn.cursor()
+        c.execute('SELECT name_id FROM titles WHERE type = ? AND popularity < 2147483647 AND name_id IN (%s)' % ', '.join(['?'] * len(name_ids)), [content] + name_ids)
+
+        return set(row['name_id'] for row in c)
+
+    def save_page(self, walk, rows, shift=None):
+        #Titles of a page and the walk progress are saved together, so an
+        #interrupted walk is continued from the first page which is not
+        #saved. New titles of the page push the titles which have not been
+        #saved since shift['time'] down the listing by shift['count']
+        walk_sql = 'INSERT OR REPLACE INTO walks (type, filter, page, total_pages, count, started, finished)' \
+                   ' VALUES (:type, :filter, :page, :total_pages, :count, :started, :finished)'
+
+        if walk['filter']:
+            #Filtered listings only add titles, their order is not kept
+            writes = [('INSERT OR IGNORE INTO titles (type, name_id, popularity, year, rating, rating_imdb, rating_kinopoisk, premiered, added, time, data)'
+                       ' VALUES (:type, :name_id, 2147483647, :year, :rating, :rating_imdb, :rating_kinopoisk, :premiered, :added, :time, :data)', rows),
+                      ('INSERT OR REPLACE INTO title_filters (type, filter, name_id, time) VALUES (:type, :filter, :name_id, :time)', rows),
+                      ]
+        else:
+            writes = []
+            if shift is not None \
+              and shift['count']:
+                writes.append(('UPDATE titles SET popularity = popularity + :count WHERE type = :type AND time < :time AND popularity < 2147483647',
+                               [dict(shift, type=walk['type'])]))
+            writes.append(('INSERT OR REPLACE INTO titles (type, name_id, popularity, year, rating, rating_imdb, rating_kinopoisk, premiered, added, time, data)'
+                           ' VALUES (:type, :name_id, :popularity, :year, :rating, :rating_imdb, :rating_kinopoisk, :premiered, :added, :time, :data)', rows))
+        writes.append((walk_sql, [walk]))
+
+        self._execute(writes)
+
+    def finish_walk(self, walk):
+        #Titles which are not in the listing anymore are removed
+        sql_params = {'type': walk['type'],
+                      'filter': walk['filter'],
+                      'started': walk['started'],
+                      }
+
+        if walk['filter']:
+            writes = [('DELETE FROM title_filters WHERE type = :type AND filter = :filter AND time < :started', [sql_params])]
+        else:
+            writes = [('DELETE FROM titles WHERE type = :type AND time < :started', [sql_params]),
+                      ('DELETE FROM title_filters WHERE type = :type AND name_id NOT IN (SELECT name_id FROM titles WHERE type = :type)', [sql_params]),
+                      ]
+        writes.append(('UPDATE walks SET finished = :finished WHERE type = :type AND filter = :filter', [dict(sql_params, finished=walk['finished'])]))
+
+        self._execute(writes)
+
+    def start_sync(self, duration):
+        #Only one plugin process walks the site at a time, a process which
+        #has stopped without finish_sync holds it not longer than duration
+        now = time.time()
+
+        self._begin()
+        c = self.conn.cursor()
+        c.execute('SELECT value FROM meta WHERE key = \'sync_started\'')
+
+        result = c.fetchone()
+        if result is not None \
+          and now - float(result['value']) < duration:
+            self._rollback()
+            return False
+
+        c.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (\'sync_started\', :value)', {'value': str(now)})
+        self._commit()
+        return True
+
+    def finish_sync(self):
+
+        self._execute([('DELETE FROM meta WHERE key = \'sync_started\'', [{}])])
+
+    def analyze(self):
+        #Without statistics SQLite walks titles in the sort order and
+        #checks the genre of each one, which is slow for a deep page
+        self.conn.execute('ANALYZE')
+
+    def get_meta(self, key):
+
+        c = self.conn.cursor()
+        c.execute('SELECT value FROM meta WHERE key = :key', {'key': key})
+
+        result = c.fetchone()
+        if result is not None:
+            return json.loads(result['value'])
+
+    def set_meta(self, key, value):
+
+        self._execute([('INSERT OR REPLACE INTO meta (key, value) VALUES (:key, :value)', [{'key': key, 'value': json.dumps(value)}])])
+
+    def get_synced(self):
+        #Time when all the walks were finished last time
+        return self.get_meta('synced')
+
+    def set_synced(self, value):
+
+        self.set_meta('synced', value)
+
+    def get_walks_time(self, content, filters):
+        #Time of the oldest finished walk of the listings, None if any of
+        #them has not been finished yet. Walk which is going again keeps
+        #the time of the last finish
+        walk_filters = [''] + filters
+
+        c = self.conn.cursor()
+        c.execute('SELECT COUNT(*) AS count, MIN(finished) AS finished FROM walks WHERE type = ? AND filter IN (%s) AND finished IS NOT NULL' \
+                  % ', '.join(['?'] * len(walk_filters)), [content] + walk_filters)
+
+        result = c.fetchone()
+        if result['count'] == len(walk_filters):
+            return result['finished']
+
+    def query_titles(self, content, filters, years=None, rating=None, sort='', offset=0, limit=50):
+        #Listing items of one page and the number of all matching titles
+        joins = []
+        conditions = ['t.type = ?']
+        sql_params = [content]
+
+        for index, value in enumerate(filters):
+            joins.append('JOIN title_filters f%d ON f%d.type = t.type AND f%d.name_id = t.name_id AND f%d.filter = ?' % ((index,) * 4))
+            sql_params.insert(index, value)
+
+        if years is not None:
+            conditions.append('t.year BETWEEN ? AND ?')
+            sql_params.extend(years)
+        if rating is not None:
+            conditions.append('t.rating >= ?')
+            sql_params.append(rating)
+
+        sql = 'FROM titles t %s WHERE %s' % (' '.join(joins), ' AND '.join(conditions))
+
+        c = self.conn.cursor()
+        c.row_factory = None
+
+        count = c.execute('SELECT COUNT(*) %s' % sql, sql_params).fetchone()[0]
+
+        items = []
+        if offset < count:
+            rows = c.execute('SELECT t.data %s ORDER BY %s LIMIT ? OFFSET ?' % (sql, self._sorts[sort]), sql_params + [limit, offset])
+            items = [json.loads(data) for data, in rows]
+
+        return items, count
+
+    def close(self):
+        self.conn.close()
+
+class ZonaMobiTransport:
+
+    #Hosts whose connection pools are kept. Requests go to one mirror,
+    #a call may switch to the others: site_url, the discovered host and
+    #the two known mirrors of the site
+    _pool_hosts = 4
+
+    def __init__( self, headers, pool_size=4 ):
+
+        self._headers = headers
+        self._pool_size = pool_size
+
+        #Session is created with the first request, answers from cache
+        #do not need it
+        self._session = None
+        self._adapter = None
+
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    def _get_session( self ):
+        with self._lock:
+            if self._session is None:
+                _import_requests()
+
+                session = requests.Session()
+                session.headers.update(self._headers)
+
+                #One pool per host, connections are kept alive between requests
+                self._adapter = requests.adapters.HTTPAdapter(pool_connections=self._pool_hosts, pool_maxsize=self._pool_size)
+                session.mount('https://', self._adapter)
+                session.mount('http://', self._adapter)
+
+                self._session = session
+            self._requests += 1
+
+        return self._session
+
+    def get( self, url, params=None, data=None, timeout=None ):
+        return self._get_session().get(url, data=data, params=params, timeout=timeout)
+
+    def get_stats( self ):
+        opened = 0
+        served = 0
+
+        if self._adapter is None:
+            return {'requests': 0,
+                    'opened': 0,
+                    'reused': 0,
+                    }
+
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                served += pool.num_requests
+
+        return {'requests': self._requests,
+                'opened': opened,
+                'reused': max(served - opened, 0),
+                }
+
+    def close( self ):
+        if self._session is not None:
+            self._session.close()
 
-    def __init__( self, cache_dir, cache_hours=48 ):
-        self._version = 1
+class ZonaMobiCassette:
 
-        self._time_delta = cache_hours * 3600 #time in seconds
+    #Cassette is a file with one JSON record per request. Records are
+    #matched by path and query, so a cassette works with any mirror
 
-        if not os.path.exists(cache_dir):
-            os.makedirs(cache_dir)
-        db_path = os.path.join(cache_dir, 'cache.db')
+    def __init__( self, path ):
 
-        db_exist = os.path.exists(db_path)
+        self.path = path
+        self._lock = threading.Lock()
+        self._requests = 0
 
-        self.conn = sqlite3.connect(db_path)
-        self.conn.row_factory = self._dict_factory
+    def _get_key( self, url, params=None ):
+        url_parts = urlparse.urlparse(url)
 
-        if db_exist:
-            self.check_for_update()
-            self.remove_old_data()
-        else:
-            self.create_database()
+        query = urlparse.parse_qsl(url_parts.query)
+        for key, value in (params or {}).iteritems():
+            query.append((key, str(value)))
 
-    def _dict_factory(self, cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
+        return '%s?%s' % (url_parts.path, urllib.urlencode(sorted(query)))
 
-    def check_for_update(self):
+    def get_stats( self ):
+        return {'requests': self._requests,
+                'opened': 0,
+                'reused': 0,
+                }
 
-        c = self.conn.cursor()
-        c.execute('SELECT idVersion FROM version LIMIT 1')
+class ZonaMobiRecorder(ZonaMobiCassette):
 
-        result = c.fetchone()
-        if result['idVersion'] < self._version:
-            c.execute('DELETE FROM version')
-            c.execute('INSERT INTO version (idVersion) VALUES (:version)', {'version': self._version} )
+    #Only the headers which replay needs are kept, cookies never get to
+    #the file
+    _headers = ['Content-Type']
 
-            self.conn.commit()
+    def __init__( self, transport, path, max_size=20 ):
+        ZonaMobiCassette.__init__(self, path)
 
+        self._transport = transport
+        #Recording stops when the file is larger
+        self.max_size = max_size * 1024 * 1024 #size in bytes
 
-    def create_database(self):
+    def get( self, url, params=None, data=None, timeout=None ):
+        start = time.time()
+        r = self._transport.get(url, data=data, params=params, timeout=timeout)
 
-        c = self.conn.cursor()
-        c.execute('CREATE TABLE version (idVersion integer)')
-        c.execute('CREATE TABLE details (name_id text, season integer, data text, time integer)')
+        record = {'url': url,
+                  'params': params or {},
+                  'key': self._get_key(url, params),
+                  'status': r.status_code,
+                  'reason': r.reason,
+                  'headers': dict((name, r.headers[name]) for name in self._headers if name in r.headers),
+                  'latency': round(time.time() - start, 3),
+                  }
+        try:
+            record['body'] = r.content.decode('utf-8')
+        except UnicodeDecodeError:
+            record['body_base64'] = base64.b64encode(r.content)
 
-        c.execute('CREATE UNIQUE INDEX details_idx ON details(name_id, season)')
-        c.execute('INSERT INTO version (idVersion) VALUES (:version)', {'version': self._version} )
+        with self._lock:
+            self._requests += 1
+            if not os.path.exists(self.path) \
+              or os.path.getsize(self.path) < self.max_size:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record) + '\n')
+
+        return r
 
-        self.conn.commit()
+    def get_stats( self ):
+        return self._transport.get_stats()
+
+    def close( self ):
+        self._transport.close()
+
+class ZonaMobiPlayer(ZonaMobiCassette):
+
+    #Parsed cassettes by path, so a benchmark can load one before it
+    #starts the measured processes
+    _loaded = {}
+
+    def __init__( self, path, simulate_latency=False ):
+        ZonaMobiCassette.__init__(self, path)
+        _import_requests()
+
+        self.simulate_latency = simulate_latency
+
+        #Repeated requests get the recorded responses in turn, the last
+        #one is kept for the rest
+        self._records = self.load(path)
+        self._positions = {}
+
+    @classmethod
+    def load( cls, path ):
+        mtime = os.path.getmtime(path) if os.path.exists(path) else 0
+
+        loaded = cls._loaded.get(path)
+        if loaded is not None \
+          and loaded['mtime'] == mtime:
+            return loaded['records']
+
+        records = {}
+        if mtime:
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        records.setdefault(record['key'], []).append(record)
+
+        cls._loaded[path] = {'mtime': mtime, 'records': records}
+        return records
+
+    def get( self, url, params=None, data=None, timeout=None ):
+        key = self._get_key(url, params)
+
+        with self._lock:
+            self._requests += 1
+            records = self._records.get(key)
+            if not records:
+                raise requests.ConnectionError('No recorded response for %s' % key)
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            record = records[min(position, len(records) - 1)]
+
+        if self.simulate_latency:
+            time.sleep(record['latency'])
+
+        return self._make_response(url, record)
+
+    def _make_response( self, url, record ):
+        r = requests.models.Response()
+        r.url = url
+        r.status_code = record['status']
+        r.reason = record.get('reason')
+        r.headers = requests.structures.CaseInsensitiveDict(record['headers'])
+        r.encoding = 'utf-8'
+        if 'body_base64' in record:
+            r._content = base64.b64decode(record['body_base64'])
+        else:
+            r._content = record['body'].encode('utf-8')
+        return r
 
-    def get_details(self, params):
-        sql_params = {'name_id': params['name_id'],
-                      'season': params.get('season', 0)}
+    def close( self ):
+        pass
 
-        c = self.conn.cursor()
-        c.execute('SELECT data FROM details WHERE name_id = :name_id AND season = :season LIMIT 1', sql_params)
+class ZonaMobiMirrors:
 
-        result = c.fetchone()
-        if result is not None:
-            return result['data']
+    #Hosts which are tried besides site_url and the discovered ones when
+    #site_url is given without a scheme, i.e. it is the real site
+    _known_hosts = ['w21.zona.plus', 'y1.zona.plus']
 
-    def set_details(self, params, data):
+    #Path used to measure round trip time of a mirror
+    _probe_path = '/api/v1/app_update_info'
 
-        sql_params = {'data': data,
-                      'name_id': params['name_id'],
-                      'season': params.get('season', 0),
-                      'time': time.time()}
+    def __init__( self, site_url, transport, cache=None, probe_interval=6, known_hosts=None ):
 
-        c = self.conn.cursor()
-        c.execute('INSERT OR REPLACE INTO details (name_id, season, data, time) VALUES (:name_id, :season, :data, :time)', sql_params)
+        self._transport = transport
+        self._cache = cache
+        self._lock = threading.Lock()
 
-        self.conn.commit()
+        self.probe_interval = probe_interval * 3600 #hours
+        self.site_url = site_url
 
-    def set_details_list(self, items):
+        #Mirrors are used with the scheme of site_url
+        if '://' in site_url:
+            self.scheme = urlparse.urlparse(site_url).scheme
+        else:
+            self.scheme = 'https'
 
-        if items:
-            c = self.conn.cursor()
-            c.executemany('INSERT OR REPLACE INTO details (name_id, season, data, time) VALUES (:name_id, :season, :data, :time)', items)
+        if known_hosts is None:
+            known_hosts = [] if '://' in site_url else self._known_hosts
+        self.known_hosts = known_hosts
 
-            self.conn.commit()
+        #Hosts which failed during the current invocation
+        self._failed = set()
 
-    def remove_old_data(self):
+        self.host = site_url
+        self.rtt = None
+        self.checked = 0
+        self.discovered = []
 
-        sql_params = {'time': time.time() - self._time_delta}
+        #Selection is kept until site_url setting is changed
+        state = None
+        if self._cache is not None:
+            state = self._cache.get_mirrors()
+        if state is not None \
+          and state.get('site_url') == site_url:
+            self.host = state['host']
+            self.rtt = state['rtt']
+            self.checked = state['time']
+            self.discovered = state.get('discovered', [])
+
+    def get_base_url( self, host=None ):
+        host = host or self.host
+
+        #Host may be given with a scheme, e.g. a local test server
+        if '://' in host:
+            return host.rstrip('/')
+        return '{0}://{1}'.format(self.scheme, host)
+
+    def get_host( self, url ):
+        for host in [self.host] + self.get_hosts():
+            base_url = self.get_base_url(host)
+            if url == base_url \
+              or url.startswith(base_url + '/'):
+                return host
+
+    def get_hosts( self ):
+        hosts = []
+        base_urls = set()
+        for host in [self.site_url] + self.discovered + self.known_hosts:
+            base_url = self.get_base_url(host)
+            if base_url not in base_urls:
+                base_urls.add(base_url)
+                hosts.append(host)
+        return hosts
+
+    def add_host( self, host ):
+        with self._lock:
+            base_urls = [self.get_base_url(known_host) for known_host in self.get_hosts()]
+            if self.get_base_url(host) not in base_urls:
+                self.discovered.append(host)
+
+    def need_probe( self ):
+        #Time of the last probe is kept in the cache, without it every
+        #plugin call would probe all the mirrors
+        if self._transport is None \
+          or self._cache is None:
+            return False
+        return (time.time() - self.checked) >= self.probe_interval
+
+    def probe( self, hosts ):
+        #All hosts are checked at the same time, healthy ones are returned
+        #as (rtt, host) sorted by rtt
+        results = [None] * len(hosts)
+        if self._transport is None:
+            return []
+
+        def worker( index, host ):
+            start = time.time()
+            try:
+                r = self._transport.get(self.get_base_url(host) + self._probe_path, timeout=(3, 5))
+                r.raise_for_status()
+            except requests.RequestException:
+                return
+            results[index] = (round(time.time() - start, 3), host)
+
+        threads = []
+        for index, host in enumerate(hosts):
+            thread = threading.Thread(target=worker, args=(index, host))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        return sorted([result for result in results if result is not None])
+
+    def select( self ):
+        with self._lock:
+            hosts = [host for host in self.get_hosts() if host not in self._failed]
+
+        healthy = self.probe(hosts)
+
+        with self._lock:
+            self.checked = int(time.time())
+            if healthy:
+                self.rtt, self.host = healthy[0]
+            self._save()
+
+        return self.host
+
+    def switch( self, failed_host ):
+        #Returns the host to use instead of failed_host or None
+        with self._lock:
+            if failed_host != self.host:
+                return self.host
+            self._failed.add(failed_host)
+            hosts = [host for host in self.get_hosts() if host not in self._failed]
+
+        healthy = self.probe(hosts)
+        if not healthy:
+            return None
+
+        with self._lock:
+            if failed_host == self.host:
+                self.rtt, self.host = healthy[0]
+                self.checked = int(time.time())
+                self._save()
+            return self.host
+
+    def _save( self ):
+        if self._cache is not None:
+            self._cache.set_mirrors({'site_url': self.site_url,
+                                     'host': self.host,
+                                     'rtt': self.rtt,
+                                     'time': self.checked,
+                                     'discovered': self.discovered,
+                                     })
+
+class ZonaMobiRating(object):
+
+    __slots__ = ('type', 'rating', 'votes', 'defaultt')
+
+    def __init__( self, type, rating=0, votes=0, defaultt=False ):
+        self.type = type
+        self.rating = rating
+        self.votes = votes
+        self.defaultt = defaultt
+
+class ZonaMobiCastMember(object):
+
+    __slots__ = ('name', 'thumbnail', 'role')
+
+    def __init__( self, name, thumbnail='', role=None ):
+        self.name = name
+        self.thumbnail = thumbnail
+        self.role = role
+
+class ZonaMobiVideoInfo(object):
+
+    #Fields of the video info labels, unset fields are not passed to Kodi
+    __slots__ = ('title', 'originaltitle', 'sorttitle', 'tvshowtitle', 'year', 'plot',
+                 'genre', 'country', 'director', 'writer', 'duration', 'date', 'premiered', 'aired',
+                 'season', 'episode', 'sortseason', 'sortepisode', 'mediatype',
+                 'rating', 'votes', 'trailer')
+
+    #Fields which are passed to Kodi even when they are not set, with the
+    #values they get then. Fields of tvseries are passed for tvseries
+    _empty = {'title': '',
+              'originaltitle': '',
+              'sorttitle': '',
+              'year': None,
+              'plot': '',
+              'genre': [],
+              'country': [],
+              'director': [],
+              'writer': [],
+              'duration': 0,
+              'date': '',
+              'premiered': '',
+              'aired': '',
+              'sortseason': None,
+              'sortepisode': None,
+              'mediatype': 'video',
+              }
+    _tvshow_empty = {'season': None,
+                     'episode': None,
+                     }
+
+    def __init__( self, year=None ):
+        self.title = self.originaltitle = self.sorttitle = self.tvshowtitle = None
+        self.year = year
+        self.plot = self.genre = self.country = self.director = self.writer = None
+        self.duration = self.date = self.premiered = self.aired = None
+        self.season = self.episode = self.sortseason = self.sortepisode = None
+        self.mediatype = self.rating = self.votes = self.trailer = None
+
+    def get_dict( self ):
+        if self.tvshowtitle is not None:
+            empty = dict(self._empty, **self._tvshow_empty)
+        else:
+            empty = self._empty
+
+        result = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                result[name] = value
+            elif name in empty:
+                value = empty[name]
+                result[name] = list(value) if isinstance(value, list) else value
+        return result
 
-        c = self.conn.cursor()
-        c.execute('DELETE FROM details WHERE time < :time', sql_params)
+    def get_state( self ):
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def from_state( cls, state ):
+        video = cls()
+        for name, value in zip(cls.__slots__, state):
+            setattr(video, name, value)
+        return video
+
+class ZonaMobiItem(object):
+
+    #Listing item, it is converted to the dict of simpleplugin only when
+    #it is handed to Kodi
+    __slots__ = ('label', 'path', 'url', 'is_folder', 'is_playable',
+                 'poster', 'fanart', 'thumb', 'video', 'ratings', 'cast', 'properties')
+
+    def __init__( self, video, poster='', fanart='', thumb='', ratings=(), cast=(), properties=None ):
+        self.label = None
+        self.path = None
+        self.url = None
+        self.is_folder = None
+        self.is_playable = None
+        self.poster = poster
+        self.fanart = fanart
+        self.thumb = thumb
+        self.video = video
+        self.ratings = ratings
+        self.cast = cast
+        self.properties = properties
+
+    def get_dict( self ):
+        #Ratings and cast are converted here, a method call per member
+        #costs more than the conversion
+        ratings = [{'type': rating.type, 'rating': rating.rating, 'votes': rating.votes, 'defaultt': rating.defaultt}
+                   for rating in self.ratings]
+        cast = [{'name': member.name, 'thumbnail': member.thumbnail} if member.role is None
+                else {'name': member.name, 'thumbnail': member.thumbnail, 'role': member.role}
+                for member in self.cast]
+
+        result = {'info': {'video': self.video.get_dict()},
+                  'art': {'poster': self.poster},
+                  'fanart': self.fanart,
+                  'thumb': self.thumb,
+                  'ratings': ratings,
+                  'cast': cast,
+                  'properties': self.properties or {},
+                  }
+        for name in ['label', 'path', 'url', 'is_folder', 'is_playable']:
+            value = getattr(self, name)
+            if value is not None:
+                result[name] = value
+        return result
 
-        self.conn.commit()
+    def get_state( self ):
+        #Built item as JSON-compatible lists, fields set by the caller
+        #later are not included
+        return [self.poster,
+                self.fanart,
+                self.thumb,
+                self.video.get_state(),
+                [[rating.type, rating.rating, rating.votes] for rating in self.ratings],
+                [[member.name, member.thumbnail, member.role] for member in self.cast],
+                self.properties,
+                ]
+
+    @classmethod
+    def from_state( cls, state ):
+        poster, fanart, thumb, video, ratings, cast, properties = state
+        return cls(ZonaMobiVideoInfo.from_state(video), poster, fanart, thumb,
+                   [ZonaMobiRating(*rating) for rating in ratings],
+                   [ZonaMobiCastMember(*member) for member in cast],
+                   properties)
 
 class ZonaMobi:
 
+    #Months in release dates of the site
+    _months = {u'января':   1,
+               u'февраля':  2,
+               u'марта':    3,
+               u'апреля':   4,
+               u'мая':      5,
+               u'июня':     6,
+               u'июля':     7,
+               u'августа':  8,
+               u'сентября': 9,
+               u'октября': 10,
+               u'ноября':  11,
+               u'декабря': 12,
+               }
+
+    #Methods which build items, built items are saved in the cache with
+    #a version computed from their code
+    _item_info_builders = ['_get_item_info', '_get_premiere_date', '_get_rating', '_make_rating',
+                           '_get_episode', '_get_episodes_index', '_get_episodes_key', '_make_eposode_list', '_sort_by_episode']
+    _item_info_version = None
+
     def __init__( self, site_url, params = {} ):
 
         #Settings
         self.video_quality = params.get('video_quality', 0)
         self.load_details = params.get('load_details', False)
         cache_dir = params.get('cache_dir')
-
+        self.detail_workers = max(int(params.get('detail_workers', 4)), 1)
+        #Details loaded ahead of the item that is being listed
+        self.detail_window = max(int(params.get('detail_window', self.detail_workers * 2)), 1)
+        pool_size = max(params.get('pool_size', 4), self.detail_workers)
+        self.force_refresh = params.get('force_refresh', False)
+        self.stale_while_revalidate = params.get('stale_while_revalidate', False)
+        self.prefetch = params.get('prefetch', False)
+        #Slow requests of the actions with hedge are repeated, it adds
+        #load on the site
+        self.hedge = params.get('hedge', False)
+        #Limits of loading the next page in background
+        self.prefetch_time = params.get('prefetch_time', 15) #seconds
+        self.prefetch_requests = params.get('prefetch_requests', 25)
+        #Saved filter catalogue is refreshed when it is older
+        self.filters_ttl = params.get('filters_ttl', 7 * 86400) #seconds
+        self._filters_update_added = False
+        #Search in titles of the cached details: 'site', 'local' or 'hybrid'
+        self.search_mode = params.get('search_mode', 'site')
+        #Time the local results wait for the site ones in hybrid mode
+        self.search_wait = params.get('search_wait', 2) #seconds
+        #New titles of the unfiltered listings are looked for when the
+        #local copy is older than catalogue_ttl, the whole listings are
+        #walked again when they are older than catalogue_walk_ttl
+        self.catalogue_sync = params.get('catalogue_sync', False)
+        self.catalogue_ttl = params.get('catalogue_ttl', 86400) #seconds
+        self.catalogue_walk_ttl = params.get('catalogue_walk_ttl', 6 * 86400) #seconds
+        #Limits of the walk: parallel requests, requests per second and
+        #time of one plugin call
+        self.catalogue_workers = max(int(params.get('catalogue_workers', 2)), 1)
+        self.catalogue_rate = params.get('catalogue_rate', 2)
+        self.catalogue_time = params.get('catalogue_time', 30) #seconds
+        #Listings are made from the copy while it is not older
+        self.catalogue_max_age = params.get('catalogue_max_age', 7 * 86400) #seconds
+        #Titles on a page of the copy, the size of the site pages if 0
+        self.page_size = int(params.get('page_size', 0))
+        self._catalogue_task_added = False
+        self.video_url_ttl = int(params.get('video_url_ttl', 10)) * 60 #minutes
+
+        #Last link which _get_video_url has taken from the cache
+        self.cached_video_url = ''
+
+        self._cache = None
         if cache_dir is not None:
-            self._cache = ZonaMobiCache(cache_dir)
-
-        #URLs
-        base_url = 'https://{0}'.format(site_url)
-
-        self._actions = {'main': {'url': base_url},
-                         'get_filters': {'url': base_url + '/ajax/widget/filter'},
-                         'get_video_url': {'url': base_url + '/api/v1/video/#mobi_link_id'},
-                         'search': {'url': base_url + '/search//#keyword'},
+            stale_hours = 168 if self.stale_while_revalidate else 0
+            self._cache = ZonaMobiCache(cache_dir, max_size=int(params.get('cache_size', 50)), stale_hours=stale_hours)
+
+        #Catalogue is opened by the first call which needs it
+        self._cache_dir = cache_dir
+        self._catalogue = None
+        self._catalogue_lock = threading.Lock()
+        self._catalogue_next_request = 0
+
+        #Work done after the result has been handed to Kodi
+        self._background_tasks = []
+
+        #Timeouts are (connect, read) in seconds, they are cut to the time
+        #left to the deadline but not below _min_timeout
+        self._timeout = (5, 15)
+        self._min_timeout = 1
+
+        #Whole invocation, details that are not loaded in time are skipped.
+        #Every background task gets its own
+        self.deadline = params.get('deadline', 20) #seconds
+        self._deadline = time.time() + self.deadline
+
+        #Transient errors are retried after 0.5, 1, 2... seconds with jitter
+        self._retry_delay = 0.5
+
+        #Hedged request is fired after this delay until p95 of the action
+        #latency is known
+        self._hedge_delay = 1.5
+        self._latency_samples = 50
+        self._latency = {}
+
+        #ttl is lifetime of cached response in seconds, details are cached
+        #separately and video links are never cached here
+        #retries is number of repeated attempts on transient errors
+        #hedge fires a second request when the first one is slower than
+        #usual and hedged requests are on
+        #Pages of the filter catalogue are not cached, the catalogue itself
+        #is saved by update_filters, the same for pages of catalogue walks
+        self._actions = {'main': {'path': '', 'timeout': (5, 10), 'ttl': 0, 'retries': 2},
+                         'get_filters': {'path': '/ajax/widget/filter', 'timeout': (5, 10), 'ttl': 0, 'retries': 2},
+                         'get_video_url': {'path': '/api/v1/video/#mobi_link_id', 'timeout': (5, 10), 'ttl': 0, 'retries': 2, 'hedge': True},
+                         'search': {'path': '/search//#keyword', 'timeout': (5, 20), 'ttl': 3600, 'retries': 1},
                          #content
-                         'browse_content': {'url': base_url + '/#content/#filter'},
-                         'browse_content_updates': {'url': base_url + '/updates/#content'},
-                         'get_content_details': {'url': base_url + '/#content/#name_id'},
+                         'browse_content': {'path': '/#content/#filter', 'timeout': (5, 20), 'ttl': 1800, 'retries': 1},
+                         'browse_content_updates': {'path': '/updates/#content', 'timeout': (5, 20), 'ttl': 300, 'retries': 1},
+                         'browse_catalogue': {'path': '/#content/#filter', 'timeout': (5, 20), 'ttl': 0, 'retries': 2},
+                         'get_content_details': {'path': '/#content/#name_id', 'timeout': (5, 15), 'ttl': 0, 'retries': 1},
                          #tvseries
-                         'browse_episodes': {'url': base_url + '/tvseries/#name_id/season-#season'},
-                         'app_update_info': {'url': base_url + '/api/v1/app_update_info'},
+                         'browse_episodes': {'path': '/tvseries/#name_id/season-#season', 'timeout': (5, 15), 'ttl': 0, 'retries': 1},
+                         'app_update_info': {'path': '/api/v1/app_update_info', 'timeout': (5, 10), 'ttl': 86400, 'retries': 0},
                          }
 
+        self._cache_stats = {}
+
+        #Counters which are added to the saved metrics on close,
+        #latency histogram buckets are upper bounds in ms
+        self._metrics_lock = threading.Lock()
+        self._metrics = {}
+        self._latency_buckets = [50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+        #Responses of the current invocation
+        self._requests_lock = threading.Lock()
+        self._responses = {}
+        self._in_flight = {}
+        self._request_stats = {}
+
+        #Episode indexes of the last used documents. The documents are
+        #shared by the callers, so nothing is added to them, and they are
+        #not kept here, so a listing can release them. Keys are in order
+        #of use, the last used go last
+        self._episodes_indexes = {}
+        self._episodes_indexes_keys = []
+        self._episodes_indexes_lock = threading.Lock()
+        self._episodes_indexes_size = 16
+
         self._html_headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:54.0) Gecko/20100101 Firefox/54.0',
                               'Accept': 'application/json, text/javascript, */*; q=0.01',
                               'Accept-Encoding': 'gzip, deflate, br',
@@ -142,8 +1889,200 @@ class ZonaMobi:
                               'X-Requested-With': 'XMLHttpRequest',
                               }
 
+        #Traffic can be recorded to a cassette and replayed without network,
+        #cassette_size limits the file in MB
+        cassette = params.get('cassette')
+        cassette_mode = params.get('cassette_mode')
+        if cassette and cassette_mode == 'replay':
+            self._transport = ZonaMobiPlayer(cassette, params.get('cassette_latency', False))
+        elif cassette and cassette_mode == 'record':
+            self._transport = ZonaMobiRecorder(ZonaMobiTransport(self._html_headers, pool_size), cassette, params.get('cassette_size', 20))
+        else:
+            self._transport = ZonaMobiTransport(self._html_headers, pool_size)
+
+        #Mirrors are probed with their own transport, so the probes are
+        #not in the transport stats and in a cassette. Replayed traffic
+        #has no mirrors to probe
+        self._probe_transport = None
+        if not (cassette and cassette_mode == 'replay'):
+            self._probe_transport = ZonaMobiTransport(self._html_headers)
+
+        #Action URLs are built from the selected mirror, mirror_hosts
+        #replaces the known mirrors of the site
+        self._mirrors = ZonaMobiMirrors(site_url, self._probe_transport, self._cache,
+                                        known_hosts=params.get('mirror_hosts'))
+        self._set_base_url(self._mirrors.get_base_url())
+        if self._mirrors.need_probe():
+            self._add_background_task(self.update_mirrors)
+
+    def _set_base_url( self, base_url ):
+        self.base_url = base_url
+        for action_settings in self._actions.itervalues():
+            action_settings['url'] = base_url + action_settings['path']
+
+    def update_mirrors( self ):
+        #Current address of the site is reported by the site itself
+        try:
+            result = self.app_update_info()
+        except ZonaMobiApiError:
+            result = {}
+
+        base_url = result.get('base_url')
+        if base_url:
+            host = urlparse.urlparse(base_url).netloc or base_url.strip('/')
+            self._mirrors.add_host(host)
+
+        host = self._mirrors.select()
+        self._set_base_url(self._mirrors.get_base_url(host))
+
+    def get_mirror( self ):
+        return {'host': self._mirrors.host,
+                'rtt': self._mirrors.rtt,
+                }
+
+    def _switch_mirror( self, url ):
+        #Returns url on another mirror or None if there is no healthy one
+        failed_host = self._mirrors.get_host(url)
+        if failed_host is None:
+            return None
+
+        host = self._mirrors.switch(failed_host)
+        if host is None \
+          or host == failed_host:
+            return None
+
+        base_url = self._mirrors.get_base_url(host)
+        if base_url != self.base_url:
+            self._set_base_url(base_url)
+
+        return base_url + url[len(self._mirrors.get_base_url(failed_host)):]
+
+    def close( self ):
+        self._transport.close()
+        if self._probe_transport is not None:
+            self._probe_transport.close()
+        if self._catalogue is not None:
+            self._catalogue.close()
+        if self._cache is not None:
+            self._save_latency()
+            self._cache.add_metrics(self._metrics)
+            self._cache.close()
+
+    def _add_background_task( self, func, *args ):
+        self._background_tasks.append((func, args))
+
+    def run_background_tasks( self, log_error=None ):
+        #Failed task must not stop the others and saving of the cache
+        while self._background_tasks:
+            func, args = self._background_tasks.pop(0)
+            self._deadline = time.time() + self.deadline
+            try:
+                func(*args)
+            except ZonaMobiApiError:
+                pass
+            except Exception:
+                if log_error is not None:
+                    log_error('Background task %s failed:\n%s' % (getattr(func, '__name__', func), traceback.format_exc()))
+
+    def get_transport_stats( self ):
+        return self._transport.get_stats()
+
+    def get_cache_stats( self ):
+        result = {}
+        with self._metrics_lock:
+            for action, stats in self._cache_stats.iteritems():
+                result[action] = stats.copy()
+        return result
+
+    def _count_cache( self, action, key, value=1 ):
+        #Called from the worker threads as well
+        with self._metrics_lock:
+            stats = self._cache_stats.setdefault(action, {'hits': 0, 'misses': 0, 'stale': 0})
+            stats[key] += value
+        self._add_metric(action, key, value)
+
+    def _add_metric( self, action, name, value=1 ):
+        with self._metrics_lock:
+            counters = self._metrics.setdefault(action, {})
+            counters[name] = counters.get(name, 0) + value
+
+    def get_metrics( self ):
+        #Saved metrics with the current invocation, latency percentiles
+        #are upper bounds of histogram buckets
+        metrics = {}
+        if self._cache is not None:
+            metrics = self._cache.get_metrics()
+
+        with self._metrics_lock:
+            for action, counters in self._metrics.iteritems():
+                action_metrics = metrics.setdefault(action, {})
+                for name, value in counters.iteritems():
+                    action_metrics[name] = action_metrics.get(name, 0) + value
+
+        result = {}
+        for action, counters in metrics.iteritems():
+            requests_count = counters.get('requests', 0)
+            responses = counters.get('responses', 0)
+            hits = counters.get('hits', 0)
+            lookups = hits + counters.get('misses', 0)
+
+            result[action] = {'requests': requests_count,
+                              'errors': counters.get('errors', 0),
+                              'p50': self._get_percentile(counters, 0.50),
+                              'p95': self._get_percentile(counters, 0.95),
+                              'p99': self._get_percentile(counters, 0.99),
+                              'bytes': counters.get('bytes', 0),
+                              'avg_bytes': counters.get('bytes', 0) / responses if responses else 0,
+                              'decode_ms': counters.get('decode_us', 0) / 1000.0 / responses if responses else 0,
+                              'hits': hits,
+                              'misses': counters.get('misses', 0),
+                              'stale': counters.get('stale', 0),
+                              'hit_ratio': float(hits) / lookups if lookups else None,
+                              }
+        return result
+
+    def _get_percentile( self, counters, percentile ):
+        total = 0
+        for bucket in self._latency_buckets:
+            total += counters.get('latency_%d' % bucket, 0)
+        if not total:
+            return None
+
+        rank = total * percentile
+        count = 0
+        for bucket in self._latency_buckets:
+            count += counters.get('latency_%d' % bucket, 0)
+            if count >= rank:
+                return bucket
+
+        return self._latency_buckets[-1]
+
+    def reset_metrics( self ):
+        with self._metrics_lock:
+            self._metrics = {}
+        #Saved at once, the view is refreshed before the API is closed
+        if self._cache is not None:
+            self._cache.reset_metrics()
+            self._cache.flush()
+
+    def _get_cache_key( self, action, url, params ):
+        #Mirrors serve the same content, so the host is not a part of the key
+        path = urlparse.urlparse(url).path
+        query = urllib.urlencode(sorted(params.items()))
+        return '%s %s?%s' % (action, path, query)
+
+    def get_request_stats( self ):
+        result = {}
+        with self._requests_lock:
+            for action, stats in self._request_stats.iteritems():
+                result[action] = stats.copy()
+        return result
+
+    def _count_request( self, action, key ):
+        stats = self._request_stats.setdefault(action, {'network': 0, 'coalesced': 0, 'memoized': 0})
+        stats[key] += 1
 
-    def _http_request( self, action, params=None, data=None, url='', url_params=None ):
+    def _http_request( self, action, params=None, data=None, url='', url_params=None, memoize=True, read_cache=True ):
         params = params or {}
         data = data or {}
         url_params = url_params or {}
@@ -155,19 +2094,246 @@ class ZonaMobi:
             for key, val in url_params.iteritems():
                 url = url.replace(key, str(val))
 
+        if data:
+            return self._load_response(action, url, params, data)
+
+        #Cache can be read only in the thread which has opened it, other
+        #threads get read_cache=False and only save the response
+        #Identical requests of one invocation share a single call
+        request_key = self._get_cache_key(action, url, params)
+        with self._requests_lock:
+            if request_key in self._responses:
+                self._count_request(action, 'memoized')
+                return self._responses[request_key]
+
+            request = self._in_flight.get(request_key)
+            if request is None:
+                request = {'event': threading.Event(),
+                           'result': None,
+                           'error': None}
+                self._in_flight[request_key] = request
+                is_leader = True
+            else:
+                self._count_request(action, 'coalesced')
+                is_leader = False
+
+        if not is_leader:
+            request['event'].wait()
+            if request['error'] is not None:
+                raise request['error']
+            return request['result']
+
         try:
-            r = requests.get(url, data=data, params=params, headers=self._html_headers)
-            r.raise_for_status()
-        except requests.ConnectionError as err:
-            raise ZonaMobiApiError('Connection error')
-        except requests.exceptions.HTTPError as err:
+            result = self._load_response(action, url, params, data, request_key, read_cache)
+            request['result'] = result
+        except Exception as err:
+            request['error'] = err
+            raise
+        finally:
+            with self._requests_lock:
+                if request['error'] is None \
+                  and memoize:
+                    self._responses[request_key] = request['result']
+                del self._in_flight[request_key]
+            request['event'].set()
+
+        return result
+
+    def _load_response( self, action, url, params, data, cache_key=None, read_cache=True ):
+        action_settings = self._actions.get(action)
+
+        ttl = action_settings.get('ttl', 0)
+        use_cache = (ttl and not data and self._cache is not None)
+
+        if use_cache:
+            cache_key = cache_key or self._get_cache_key(action, url, params)
+            if read_cache \
+              and not self.force_refresh:
+                cached_data = self._cache.get_response(cache_key)
+                if cached_data is not None:
+                    self._count_cache(action, 'hits')
+                    return cached_data
+            self._count_cache(action, 'misses')
+
+        while True:
+            try:
+                r = self._send_request(action, url, params, data)
+                break
+            except (requests.ConnectionError, requests.Timeout) as err:
+                url = self._switch_mirror(url)
+                if url is None:
+                    raise ZonaMobiApiError('Connection error')
+            except requests.exceptions.HTTPError as err:
+                raise ZonaMobiApiError(err)
+            except requests.RequestException as err:
+                raise ZonaMobiApiError(err)
+
+        start = time.time()
+        try:
+            result = r.json()
+        except ValueError as err:
+            self._add_metric(action, 'errors')
             raise ZonaMobiApiError(err)
+        self._add_metric(action, 'decode_us', int((time.time() - start) * 1000000))
+        self._add_metric(action, 'responses')
+        self._add_metric(action, 'bytes', len(r.content))
+
+        if use_cache:
+            self._cache.set_response(cache_key, action, r.content, ttl)
+
+        return result
+
+
+    def _send_request( self, action, url, params, data ):
+        action_settings = self._actions.get(action)
+
+        retries = action_settings.get('retries', 0) if not data else 0
+        if self.hedge \
+          and action_settings.get('hedge') \
+          and not data:
+            send = self._send_hedged
+        else:
+            send = self._send_once
+
+        attempt = 0
+        while True:
+            try:
+                return send(action, url, params, data)
+            except requests.RequestException as err:
+                delay = self._retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if attempt >= retries \
+                  or not self._is_transient(err) \
+                  or time.time() + delay > self._deadline:
+                    raise
+            attempt += 1
+            time.sleep(delay)
+
+    def _is_transient( self, err ):
+        if isinstance(err, (requests.ConnectionError, requests.Timeout)):
+            return True
+
+        response = getattr(err, 'response', None)
+        return response is not None \
+               and (response.status_code >= 500 or response.status_code == 429)
+
+    def _send_once( self, action, url, params, data ):
+        timeout = self._actions[action].get('timeout', self._timeout)
+        remaining = max(self._deadline - time.time(), self._min_timeout)
+        timeout = tuple([min(value, remaining) for value in timeout])
+
+        with self._requests_lock:
+            self._count_request(action, 'network')
+
+        self._add_metric(action, 'requests')
+
+        start = time.time()
+        try:
+            r = self._transport.get(url, data=data, params=params, timeout=timeout)
+            r.raise_for_status()
+        except requests.RequestException:
+            self._add_metric(action, 'errors')
+            raise
+        self._add_latency(action, time.time() - start)
+
         return r
 
+    def _send_hedged( self, action, url, params, data ):
+        #Second attempt is fired when the first one is slower than p95,
+        #the first successful response wins
+        results = Queue.Queue()
+        finished = []
+        finished_lock = threading.Lock()
+
+        def attempt():
+            #Every error is put, otherwise the caller waits for it forever
+            try:
+                result = (self._send_once(action, url, params, data), None)
+            except Exception as err:
+                result = (None, err)
+
+            #Response which has lost is closed, its connection goes back
+            #to the pool
+            with finished_lock:
+                if not finished:
+                    results.put(result)
+                    return
+            if result[0] is not None:
+                result[0].close()
+
+        def start():
+            thread = threading.Thread(target=attempt)
+            thread.daemon = True
+            thread.start()
+
+        start()
+        hedge_delay = self._get_hedge_delay(action)
+        pending = 1
+
+        while True:
+            try:
+                if hedge_delay is not None:
+                    response, error = results.get(timeout=hedge_delay)
+                else:
+                    response, error = results.get()
+            except Queue.Empty:
+                start()
+                pending += 1
+                hedge_delay = None
+                continue
+
+            pending -= 1
+            if error is None:
+                with finished_lock:
+                    finished.append(True)
+                while not results.empty():
+                    loser, error = results.get()
+                    if loser is not None:
+                        loser.close()
+                return response
+            elif not pending:
+                raise error
+
+    def _add_latency( self, action, latency ):
+        with self._requests_lock:
+            latency_info = self._latency.setdefault(action, {'samples': None, 'new': []})
+            latency_info['new'].append(round(latency, 3))
+
+        latency_ms = latency * 1000
+        for bucket in self._latency_buckets:
+            if latency_ms <= bucket:
+                break
+        self._add_metric(action, 'latency_%d' % bucket)
+
+    def _get_latency( self, action ):
+        #Samples of previous invocations are stored in cache
+        with self._requests_lock:
+            latency_info = self._latency.setdefault(action, {'samples': None, 'new': []})
+            samples = latency_info['samples']
+            new_samples = list(latency_info['new'])
+
+        if samples is None:
+            samples = []
+            if self._cache is not None:
+                samples = self._cache.get_latency(action)
+            latency_info['samples'] = samples
+
+        return (samples + new_samples)[-self._latency_samples:]
+
+    def _get_hedge_delay( self, action ):
+        samples = self._get_latency(action)
+        if len(samples) < 10:
+            return self._hedge_delay
+
+        samples.sort()
+        return samples[int(len(samples) * 0.95)]
+
+    def _save_latency( self ):
+        for action in self._latency.keys():
+            if self._latency[action]['new']:
+                self._cache.set_latency(action, self._get_latency(action))
 
     def app_update_info(self):
-        r = self._http_request(app_update_info)
-        return r.json()
+        return self._http_request('app_update_info')
     
     def _sort_by_episode(self, item):
         return item.get('episode_key', '')
@@ -197,6 +2363,75 @@ class ZonaMobi:
 
     def browse_content( self, content_type, params ):
 
+        data = self._get_local_content_page(content_type, params)
+        if data is None:
+            data = self._get_content_page(content_type, params)
+            self._add_prefetch_task(content_type, params, data.get('pagination', {}).get('total_pages', 0))
+
+        items = data.get('items', [])
+
+        result = {'count': len(items),
+                  'title': data['title_h1'].strip(),
+                  'total_pages': data.get('pagination', {}).get('total_pages', 0),
+                  'list':  self._make_list(content_type, data, items)}
+
+        self._add_catalogue_task()
+
+        return result
+
+    def _get_local_content_page( self, content_type, params ):
+        #Page of the catalogue copy like the one of the site, None if the
+        #copy has no finished walks of the listings or they are too old
+        if not self.catalogue_sync \
+          or (params.get('sort') or '') not in ZonaMobiCatalogue._sorts \
+          or self._get_catalogue() is None:
+            return None
+
+        filters = []
+        for filter_key in ['genre', 'country']:
+            if params.get(filter_key):
+                filters.append('%s-%s' % (filter_key, params[filter_key]))
+
+        walks_time = self._catalogue.get_walks_time(content_type, filters)
+        if walks_time is None \
+          or time.time() - walks_time >= self.catalogue_max_age:
+            return None
+
+        listing = self._catalogue.get_meta('listing_%s' % content_type) or {}
+        page_size = int(params.get('page_size') or self.page_size or listing.get('page_size') or 50)
+        page = int(params.get('page', 1))
+
+        rating = params.get('rating')
+        items, count = self._catalogue.query_titles(content_type, filters,
+                                                    years=self._get_year_range(params.get('year')),
+                                                    rating=int(rating) if rating else None,
+                                                    sort=params.get('sort') or '',
+                                                    offset=(page - 1) * page_size,
+                                                    limit=page_size)
+
+        return {'title_h1': listing.get('title', ''),
+                'items': items,
+                'pagination': {'current_page': page,
+                               'total_pages': (count + page_size - 1) // page_size},
+                }
+
+    def _get_year_range( self, year ):
+        #Values of the year filter: 2019, 2010s, 90s and old for the years
+        #before the 40s
+        if not year:
+            return None
+        elif year == 'old':
+            return (0, 1939)
+        elif year.endswith('s'):
+            decade = int(year[:-1])
+            if decade < 100:
+                decade += 1900
+            return (decade, decade + 9)
+        else:
+            return (int(year), int(year))
+
+    def _get_content_page( self, content_type, params ):
+
         u_params = {'page':    params.get('page', 1)}
         url_params = {'#content': content_type}
 
@@ -206,27 +2441,45 @@ class ZonaMobi:
             action = 'browse_content'
             url_params['#filter'] = self._get_filter(params)
 
-        r = self._http_request(action, u_params, url_params=url_params)
+        return self._http_request(action, u_params, url_params=url_params)
 
-        data = r.json()
-        items = data.get('items', [])
+    def _add_prefetch_task( self, content_type, params, total_pages ):
+        #Next page is loaded to cache while the current one is shown
+        if not self.prefetch \
+          or self._cache is None:
+            return
 
-        result = {'count': len(items),
-                  'title': data['title_h1'].strip(),
-                  'total_pages': data.get('pagination', {}).get('total_pages', 0),
-                  'list':  self._make_list(content_type, data, items)}
-        return result
+        next_page = int(params.get('page', 1)) + 1
+        if next_page <= total_pages:
+            next_params = params.copy()
+            next_params['page'] = next_page
+            self._add_background_task(self._prefetch_page, content_type, next_params)
+
+    def _prefetch_page( self, content_type, params ):
+        deadline = time.time() + self.prefetch_time
+
+        if content_type == 'search':
+            data = self._get_search_page(params)
+        else:
+            data = self._get_content_page(content_type, params)
+
+        if not self.load_details:
+            return
+
+        items = data.get('items', [])[:self.prefetch_requests - 1]
+
+        for _ in self._iter_items_details(content_type, items, deadline):
+            pass
 
     def browse_episodes( self, params ):
 
         url_params = {'#name_id': params['name_id'],
                       '#season': str(params['season'])}
 
-        r = self._http_request('browse_episodes', url_params=url_params)
-        data = r.json()
+        data = self._http_request('browse_episodes', url_params=url_params)
 
         item = data['serial']
-        items = self._make_eposode_list(data)
+        items = self._get_episodes_index(data)['list']
 
         result = {'count': len(items),
                   'title': item['name_rus'],
@@ -235,26 +2488,71 @@ class ZonaMobi:
         return result
 
     def _make_eposode_list( self, data ):
-        episodes = []
-
+        #The document is shared, so its list is not sorted in place
         items = data['episodes']['items']
         if isinstance(items, dict):
-            for key, val in items.iteritems():
-                episodes.append(val)
-        elif isinstance(items, list):
-            episodes = items
+            items = items.itervalues()
+        elif not isinstance(items, list):
+            items = []
 
-        episodes.sort(key=self._sort_by_episode)
+        return sorted(items, key=self._sort_by_episode)
 
-        return episodes
+    def _get_episodes_key( self, data ):
+        #Documents of one season of a tvseries have the same episodes
+        item = data.get('serial') or data.get('movie') or {}
+        items = data['episodes']['items']
+        if isinstance(items, dict):
+            first = next(items.itervalues(), None)
+        elif isinstance(items, list) and items:
+            first = items[0]
+        else:
+            first = None
+
+        if first is None:
+            return (item.get('name_id'), None, 0)
+        return (item.get('name_id'), first['season'], len(items))
+
+    def _get_episodes_index( self, data ):
+        #Built once per season of a tvseries, the last used are kept
+        key = self._get_episodes_key(data)
+        with self._episodes_indexes_lock:
+            index = self._episodes_indexes.get(key)
+            if index is not None:
+                self._episodes_indexes_keys.remove(key)
+                self._episodes_indexes_keys.append(key)
+        if index is not None:
+            return index
+
+        episodes = self._make_eposode_list(data)
+
+        by_key = {}
+        first_episode = None
+        for episode in episodes:
+            by_key[(episode['season'], episode['episode'])] = episode
+            if first_episode is None \
+              and episode['episode'] == 1:
+                first_episode = episode
+
+        index = {'list': episodes,
+                 'by_key': by_key,
+                 'first_episode': first_episode,
+                 }
+
+        with self._episodes_indexes_lock:
+            if key not in self._episodes_indexes:
+                self._episodes_indexes_keys.append(key)
+            self._episodes_indexes[key] = index
+            while len(self._episodes_indexes_keys) > self._episodes_indexes_size:
+                del self._episodes_indexes[self._episodes_indexes_keys.pop(0)]
+
+        return index
 
     def browse_seasons( self, params ):
 
         url_params = {'#content': 'tvseries',
                       '#name_id': params['name_id']}
 
-        r = self._http_request('get_content_details', url_params=url_params)
-        data = r.json()
+        data = self._http_request('get_content_details', url_params=url_params)
 
         item = data['serial']
 
@@ -265,19 +2563,67 @@ class ZonaMobi:
         return result
 
     def get_filters( self ):
-        r = self._http_request('get_filters')
-        data = r.json()
+        #Saved catalogue is returned without waiting for the site, it is
+        #loaded again in background when it is old. Without a saved copy
+        #it is loaded at once, otherwise there is nothing to choose from
+        catalogue = None
+        if self._cache is not None:
+            catalogue = self._cache.get_filters()
+
+        if catalogue is None:
+            return self._make_filters(self.update_filters())
+
+        if time.time() - catalogue['time'] >= self.filters_ttl \
+          and not self._filters_update_added:
+            self._filters_update_added = True
+            self._add_background_task(self.update_filters)
+
+        return self._make_filters(catalogue)
+
+    def update_filters( self ):
+        #Both pages are loaded at the same time
+        main = {}
+        def load_main():
+            try:
+                main['data'] = self._http_request('main')
+            except ZonaMobiApiError as err:
+                main['error'] = err
+
+        thread = threading.Thread(target=load_main)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            data = self._http_request('get_filters')
+        finally:
+            thread.join()
+
+        if 'error' in main:
+            raise main['error']
+
+        catalogue = {'time': time.time(),
+                     'genres': [[genre['name'], genre['translit']] for genre in data['genres'].itervalues()],
+                     'countries': [[country['name'], country['translit']] for country in data['countries']],
+                     'current_year': main['data']['current_year'],
+                     }
+
+        if self._cache is not None:
+            self._cache.set_filters(catalogue)
+
+        return catalogue
 
+    def _make_filters( self, catalogue ):
+        #Genres and countries are empty until the catalogue is loaded once
         genres = []
-        for key, genre in data['genres'].iteritems():
-            genres.append({'name': genre['name'],
-                          'value': genre['translit']
+        for name, value in catalogue.get('genres', []):
+            genres.append({'name': name,
+                          'value': value
                           })
 
         countries = []
-        for country in data['countries']:
-            countries.append({'name': country['name'],
-                              'value': country['translit']
+        for name, value in catalogue.get('countries', []):
+            countries.append({'name': name,
+                              'value': value
                               })
 
         ratings = []
@@ -286,10 +2632,7 @@ class ZonaMobi:
                             'value': str(rating)
                             })
 
-        r = self._http_request('main')
-        data = r.json()
-
-        current_year = data['current_year']
+        current_year = catalogue.get('current_year') or time.localtime().tm_year
         last_year = current_year // 10 * 10
 
         years = []
@@ -329,14 +2672,225 @@ class ZonaMobi:
 
         return result
 
-    def search( self, params ):
+    def _get_catalogue( self ):
+        if self._catalogue is None \
+          and self._cache_dir is not None:
+            self._catalogue = ZonaMobiCatalogue(self._cache_dir)
+        return self._catalogue
+
+    def _add_catalogue_task( self ):
+        if not self.catalogue_sync \
+          or self._catalogue_task_added \
+          or self._get_catalogue() is None:
+            return
+
+        synced = self._catalogue.get_synced()
+        if synced is None \
+          or time.time() - synced >= self.catalogue_ttl:
+            self._catalogue_task_added = True
+            self._add_background_task(self.sync_catalogue)
+
+    def sync_catalogue( self, time_limit=None ):
+        #Unfiltered listings of movies and tvseries and the listings of
+        #every genre and country are walked. A walk which is not finished
+        #in time_limit is continued by the next call. Between the walks
+        #only the first pages of the unfiltered listings are loaded
+        catalogue = self._get_catalogue()
+        if catalogue is None:
+            return False
+
+        time_limit = time_limit or self.catalogue_time
+        deadline = time.time() + time_limit
+        #Requests of the walks are retried until the end of time_limit
+        self._deadline = max(self._deadline, deadline)
+
+        if not catalogue.start_sync(time_limit):
+            return False
 
-        url = self._actions['search'].get('url').replace('#keyword', urllib.quote(params['keyword']))
+        try:
+            filters = self._cache.get_filters() if self._cache is not None else None
+            if filters is None:
+                filters = self.update_filters()
+
+            walk_filters = ['']
+            walk_filters.extend(['genre-%s' % value for _, value in filters['genres']])
+            walk_filters.extend(['country-%s' % value for _, value in filters['countries']])
+
+            walks = catalogue.get_walks()
+            for content in ['movies', 'tvseries']:
+                for walk_filter in walk_filters:
+                    walk = walks.get((content, walk_filter))
+                    if walk is not None \
+                      and self._is_walk_finished(walk) \
+                      and time.time() - walk['started'] < self.catalogue_walk_ttl:
+                        if walk_filter \
+                          or time.time() - walk['finished'] < self.catalogue_ttl:
+                            continue
+                        if not self._update_catalogue(walk, deadline):
+                            return False
+                    elif not self._walk_catalogue(content, walk_filter, walk, deadline):
+                        return False
+
+            catalogue.analyze()
+            catalogue.set_synced(time.time())
+        finally:
+            catalogue.finish_sync()
+
+        return True
+
+    def _walk_catalogue( self, content, walk_filter, walk, deadline ):
+        if time.time() >= deadline:
+            return False
+
+        if walk is None \
+          or self._is_walk_finished(walk):
+            walk = {'type': content,
+                    'filter': walk_filter,
+                    'page': 0,
+                    'total_pages': None,
+                    'count': 0,
+                    'started': time.time(),
+                    'finished': walk['finished'] if walk is not None else None,
+                    }
+        else:
+            walk = dict(walk)
 
-        u_params = {'page':    params.get('page', 1)}
+        if walk['total_pages'] is None:
+            self._save_catalogue_page(walk, 1, self._get_catalogue_page(1, content, walk_filter))
+
+        pages = range(walk['page'] + 1, walk['total_pages'] + 1)
+        for page, data in self._imap_parallel(self._get_catalogue_page, pages, (content, walk_filter), deadline, self.catalogue_workers):
+            #Failed page is loaded again by the next walk
+            if data is None:
+                return False
+            self._save_catalogue_page(walk, page, data)
+
+        walk['finished'] = time.time()
+        self._catalogue.finish_walk(walk)
+
+        return True
+
+    def _update_catalogue( self, walk, deadline ):
+        #Pages of the finished walk are loaded until a page without new
+        #titles, titles which have gone are removed by the next walk
+        walk = dict(walk)
+        page_size = None
+        started = time.time()
+
+        for page in xrange(1, walk['total_pages'] + 1):
+            if time.time() >= deadline:
+                return False
+
+            data = self._get_catalogue_page(page, walk['type'], walk['filter'])
+            items = data.get('items', [])
+            page_size = page_size or len(items)
+
+            now = time.time()
+            rows = []
+            for item in items:
+                row = self._get_catalogue_row(item)
+                row.update({'type': walk['type'],
+                            'filter': walk['filter'],
+                            'popularity': (page - 1) * page_size + len(rows),
+                            'time': now,
+                            })
+                rows.append(row)
+
+            name_ids = [row['name_id'] for row in rows]
+            new_count = len(name_ids) - len(self._catalogue.get_known_titles(walk['type'], name_ids))
+            last = (new_count == 0)
+            if last \
+              or page == walk['total_pages']:
+                walk['finished'] = now
+
+            self._catalogue.save_page(walk, rows, {'count': new_count, 'time': started})
+            if last:
+                break
+
+        return True
+
+    def _is_walk_finished( self, walk ):
+        #Walk which is going again keeps the time it was finished last
+        return walk['finished'] is not None \
+               and walk['finished'] >= walk['started']
+
+    def _get_catalogue_page( self, page, content, walk_filter ):
+        #Requests are spread evenly, not more than catalogue_rate a second
+        with self._catalogue_lock:
+            now = time.time()
+            start = max(now, self._catalogue_next_request)
+            self._catalogue_next_request = start + 1.0 / self.catalogue_rate
+        if start > now:
+            time.sleep(start - now)
+
+        url_params = {'#content': content,
+                      '#filter': 'filter/%s' % walk_filter if walk_filter else ''}
+
+        return self._http_request('browse_catalogue', {'page': page}, url_params=url_params, memoize=False)
+
+    def _save_catalogue_page( self, walk, page, data ):
+        now = time.time()
+
+        #Local pages are titled and sized like the site ones
+        if page == 1 \
+          and not walk['filter']:
+            self._catalogue.set_meta('listing_%s' % walk['type'], {'title': data.get('title_h1', ''),
+                                                                   'page_size': len(data.get('items', [])),
+                                                                   })
+
+        rows = []
+        for item in data.get('items', []):
+            row = self._get_catalogue_row(item)
+            row.update({'type': walk['type'],
+                        'filter': walk['filter'],
+                        'popularity': walk['count'] + len(rows),
+                        'time': now,
+                        })
+            rows.append(row)
+
+        walk['page'] = page
+        walk['total_pages'] = data.get('pagination', {}).get('total_pages', 0)
+        walk['count'] += len(rows)
+
+        self._catalogue.save_page(walk, rows)
+
+    def _get_catalogue_row( self, item ):
+        #Listing item without description, it is loaded with details
+        data = {}
+        for key in ZonaMobiCache._item_fields:
+            if key in item \
+              and key != 'description':
+                data[key] = item[key]
+
+        try:
+            premiered = self._get_premiere_date(item)
+        except (KeyError, IndexError, ValueError):
+            premiered = ''
+
+        return {'name_id': item['name_id'],
+                'year': item.get('year'),
+                'rating': self._get_float(item.get('rating')),
+                'rating_imdb': self._get_float(item.get('rating_imdb')),
+                'rating_kinopoisk': self._get_float(item.get('rating_kinopoisk')),
+                'premiered': premiered,
+                'added': item.get('mobi_link_date') or '',
+                'data': json.dumps(data, separators=(',', ':'), ensure_ascii=False),
+                }
+
+    def _get_float( self, value ):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
 
-        r = self._http_request('search', params = u_params, url = url)
-        data = r.json()
+    def search( self, params ):
+
+        if self._cache is not None \
+          and (self.search_mode == 'local'
+               or self.search_mode == 'hybrid' and int(params.get('page', 1)) == 1):
+            data = self._get_local_search_page(params)
+        else:
+            data = self._get_search_page(params)
 
         items = data.get('items', [])
 
@@ -346,36 +2900,121 @@ class ZonaMobi:
                   'total_pages': data['pagination']['total_pages'],
                   'list':  self._make_list('search', data, items)
                   }
+
+        self._add_prefetch_task('search', params, result['total_pages'])
+
         return result
 
-    def _get_content_data(self, params):
-        url_params = {'#name_id': params['name_id']}
+    def _get_local_search_page( self, params ):
+        #Pages are made of the cached titles. In hybrid mode the site is
+        #searched at the same time and its first page is added after them
+        if self.search_mode == 'local':
+            page_size = self.page_size or 50
+            page = int(params.get('page', 1))
+            items, count = self._cache.search_titles(params['keyword'], page_size, (page - 1) * page_size)
+            if count:
+                return {'items': items,
+                        'is_second': False,
+                        'pagination': {'current_page': page,
+                                       'total_pages': (count + page_size - 1) // page_size},
+                        }
+            return self._get_search_page(params)
+
+        remote = {}
+        def load_remote():
+            try:
+                remote['data'] = self._get_search_page(params, read_cache=False)
+            except ZonaMobiApiError as err:
+                remote['error'] = err
+
+        cached_data = self._get_cached_search_page(params)
+        if cached_data is not None:
+            remote['data'] = cached_data
+            thread = None
+        else:
+            thread = threading.Thread(target=load_remote)
+            thread.daemon = True
+            thread.start()
+
+        items = self._cache.search_titles(params['keyword'])[0]
+
+        if thread is not None:
+            #Without local results there is nothing to show but the site ones
+            thread.join(self.search_wait if items else None)
+            if thread.is_alive():
+                #Late response is not shown, it is saved to the cache and
+                #is added when the search is opened again
+                self._add_background_task(thread.join)
+
+        if not items \
+          and 'error' in remote:
+            raise remote['error']
+
+        data = remote.get('data')
+        if data is None:
+            return {'items': items,
+                    'is_second': False,
+                    'pagination': {'total_pages': 1},
+                    }
 
+        name_ids = set([item['name_id'] for item in items])
+        for item in data.get('items', []):
+            if item['name_id'] not in name_ids:
+                name_ids.add(item['name_id'])
+                items.append(item)
+
+        return {'items': items,
+                'is_second': data.get('is_second', False),
+                'pagination': data['pagination'],
+                }
+
+    def _get_search_page( self, params, read_cache=True ):
+
+        url, u_params = self._get_search_request(params)
+
+        return self._http_request('search', params = u_params, url = url, read_cache = read_cache)
+
+    def _get_cached_search_page( self, params ):
+        if self.force_refresh:
+            return None
+
+        url, u_params = self._get_search_request(params)
+
+        return self._cache.get_response(self._get_cache_key('search', url, u_params))
+
+    def _get_search_request( self, params ):
+
+        url = self._actions['search'].get('url').replace('#keyword', urllib.quote(params['keyword']))
+
+        u_params = {'page':    params.get('page', 1)}
+
+        return url, u_params
+
+    def _get_content_data(self, params):
         content = params['type']
 
-        if content == 'episodes':
-            action = 'browse_episodes'
-            url_params['#season'] = params['season']
-        elif content in ['movies', 'tvseries']:
-            action = 'get_content_details'
-            url_params['#content'] = content
-        else:
-            action = None
+        item = {'name_id': params['name_id'],
+                'season': int(params.get('season', 0)),
+                'content': content}
+        source = 'seasons' if content == 'episodes' else content
 
+        data = None
         if self._cache is not None:
-            cached_data = self._cache.get_details(params)
+            stale_keys = [] if self.stale_while_revalidate else None
+            data = self._cache.get_details(item, stale_keys)
+            if stale_keys:
+                self._add_background_task(self._fetch_details, [item], source)
 
-        if action is not None \
-          and (self._cache is None \
-               or cached_data is None):
-            r = self._http_request(action, url_params=url_params)
-            data = r.json()
+            action = self._get_details_action(source)
+            self._count_cache(action, 'hits' if data is not None else 'misses')
+            if stale_keys:
+                self._count_cache(action, 'stale')
 
-        if self._cache is not None:
-            if cached_data is None:
-                self._cache.set_details(params, r.text)
-            else:
-                data = json.loads(cached_data)
+        if data is None:
+            data = self._get_item_details(item, source)
+
+            if self._cache is not None:
+                self._cache.set_details(item, data)
 
         return data
 
@@ -398,7 +3037,7 @@ class ZonaMobi:
 
         path = self._get_video_url(mobi_link_id)
 
-        item_info['path'] = path
+        item_info.path = path
         return item_info
 
     def get_trailer_url( self, params ):
@@ -421,9 +3060,20 @@ class ZonaMobi:
     def _get_video_url( self, mobi_link_id ):
         video_quality = self.video_quality
 
-        url_params = {'#mobi_link_id': str(mobi_link_id)}
-        r = self._http_request('get_video_url', url_params=url_params)
-        data = r.json()
+        use_cache = (self.video_url_ttl and self._cache is not None)
+
+        data = None
+        if use_cache:
+            data = self._cache.get_video_url(mobi_link_id)
+            self._count_cache('get_video_url', 'hits' if data is not None else 'misses')
+
+        cached = (data is not None)
+        if not cached:
+            url_params = {'#mobi_link_id': str(mobi_link_id)}
+            data = self._http_request('get_video_url', url_params=url_params)
+
+            if use_cache:
+                self._cache.set_video_url(mobi_link_id, data, self._get_video_url_expires(data))
 
         path = ''
         if not path or video_quality >= 0:
@@ -431,68 +3081,341 @@ class ZonaMobi:
         if not path or video_quality >= 1:
             path = data['url']
 
+        self.cached_video_url = path if cached else ''
+
         return path
 
-    def _get_items_details(self, source, data):
+    def _get_video_url_expires( self, data ):
+        expires = time.time() + self.video_url_ttl
 
-        details = {}
-        if not self.load_details:
-            return details
+        #Signed links may tell when they expire
+        for key in ['lqUrl', 'url']:
+            query = urlparse.urlparse(data.get(key) or '').query
+            for name, values in urlparse.parse_qs(query).iteritems():
+                if name.lower() in ['expires', 'expire', 'exp', 'e'] \
+                  and values[0].isdigit():
+                    expires = min(expires, int(values[0]) - 30)
 
-        req_items = []
-        for item in data:
-            if source in ['movies', 'tvseries', 'search']:
-                params = {'name_id': item['name_id'],
-                          'season': 0,
-                          'content': 'tvseries' if item['serial'] else 'movies'}
-                req_items.append(params)
-            elif source == 'seasons':
-                item = data['serial']
-                for season in xrange(1, data['seasons']['count'] + 1):
-                    params = {'name_id': item['name_id'],
-                              'season': season,
-                              'content': 'tvseries' if item['serial'] else 'movies'}
-                    req_items.append(params)
+        return expires
 
+    def invalidate_video_url( self, path ):
+        if self._cache is not None:
+            self._cache.remove_video_url(path)
 
+    def _iter_items_details( self, source, data, deadline=None, skip_keys=() ):
+        #Yields details of the items in order of the listing, None for items
+        #which are listed with basic data or are in skip_keys. Details which
+        #are not cached are loaded ahead in a window, so a document is held
+        #only until the item is built
+        req_items = self._get_details_items(source, data)
+        list_keys = [(item['name_id'], item['season']) for item in req_items]
 
-        if self._cache is not None:
-            items_for_caching =[]
+        if not self.load_details:
+            for key in list_keys:
+                yield None
+            return
 
-            for item in req_items:
-                cached_data = self._cache.get_details(item)
-                if cached_data is not None:
-                    item_key = '%s_%d' % (item['name_id'], item['season'])
-                    details[item_key] = json.loads(cached_data)
+        if deadline is None:
+            deadline = self._deadline
 
-        for item in req_items:
-            item_key = '%s_%d' % (item['name_id'], item['season'])
-            if details.get(item_key) is None:
-                url_params = {'#name_id': item['name_id']}
+        if skip_keys:
+            req_items = [item for item, key in zip(req_items, list_keys) if key not in skip_keys]
+        keys = [(item['name_id'], item['season']) for item in req_items]
 
-                if source == 'seasons':
-                    action = 'browse_episodes'
-                    url_params['#season'] = item['season']
+        details = {}
+        if self._cache is not None:
+            stale_keys = [] if self.stale_while_revalidate else None
+            details = self._cache.get_details_many(keys, stale_keys)
+
+            action = self._get_details_action(source)
+            self._count_cache(action, 'hits', len(details))
+            self._count_cache(action, 'misses', len(set(keys)) - len(details))
+            if stale_keys:
+                self._count_cache(action, 'stale', len(stale_keys))
+
+            if stale_keys:
+                stale_keys = set(stale_keys)
+                stale_items = [item for item in req_items if (item['name_id'], item['season']) in stale_keys]
+                self._add_background_task(self._fetch_details, stale_items, source)
+
+        missed_items = []
+        missed_keys = set()
+        for item, key in zip(req_items, keys):
+            if key not in details \
+              and key not in missed_keys:
+                missed_keys.add(key)
+                missed_items.append(item)
+
+        #Items can repeat in search results
+        remaining = {}
+        for key in keys:
+            remaining[key] = remaining.get(key, 0) + 1
+
+        responses = self._iter_fetch_details(missed_items, source, deadline)
+        try:
+            for key in list_keys:
+                if key in skip_keys:
+                    yield None
+                    continue
+
+                #Responses come in order of missed_items, failed items get None
+                while key not in details \
+                  and responses is not None:
+                    try:
+                        item, item_data = responses.next()
+                    except StopIteration:
+                        responses = None
+                        break
+                    details[(item['name_id'], item['season'])] = item_data
+
+                remaining[key] -= 1
+                if remaining[key]:
+                    item_data = details.get(key)
                 else:
-                    action = 'get_content_details'
-                    url_params['#content'] = item['content']
+                    item_data = details.pop(key, None)
+
+                yield item_data
+                del item_data
+        finally:
+            if responses is not None:
+                responses.close()
+
+    def _get_built_items( self, source, keys ):
+        #Items which are built from the cached details already, by
+        #(name_id, season)
+        if not self.load_details \
+          or self._cache is None:
+            return {}
+
+        records = self._cache.get_item_infos([(name_id, season, 0, True) for name_id, season in keys],
+                                             self._get_item_info_version())
+        self._count_cache(self._get_details_action(source), 'hits', len(records))
+
+        built_items = {}
+        for key, record in records.iteritems():
+            built_items[key[:2]] = record
+        return built_items
+
+    def _load_built_item( self, record ):
+        video_info, item_state = record
+        return {'item_info': ZonaMobiItem.from_state(item_state),
+                'video_info': video_info,
+                }
 
-                r = self._http_request(action, url_params=url_params)
+    def _save_built_item( self, key, video_info, item_info ):
+        if self._cache is not None:
+            name_id, season = key
+            self._cache.set_item_infos([((name_id, season, 0, True), [video_info, item_info.get_state()])],
+                                       self._get_item_info_version())
+
+    def _get_item_info_version( self ):
+        #Saved items are built again when the code of the builders or of
+        #the item model changes
+        if ZonaMobi._item_info_version is None:
+            parts = []
+            for name in self._item_info_builders:
+                parts.extend(self._get_code_parts(getattr(ZonaMobi, name).im_func.func_code))
+            for cls in [ZonaMobiItem, ZonaMobiVideoInfo, ZonaMobiRating, ZonaMobiCastMember]:
+                parts.append(repr(cls.__slots__))
+                for name, value in sorted(cls.__dict__.items()):
+                    func = getattr(value, '__func__', value)
+                    if hasattr(func, 'func_code'):
+                        parts.extend(self._get_code_parts(func.func_code))
+            parts.append(repr(sorted(self._months.items())))
+
+            ZonaMobi._item_info_version = zlib.crc32(''.join(parts)) & 0x7fffffff
+
+        return ZonaMobi._item_info_version
+
+    def _get_code_parts( self, code ):
+        #Line numbers are not included, moving a method does not change it
+        parts = [code.co_code, repr(code.co_names)]
+        for const in code.co_consts:
+            if hasattr(const, 'co_code'):
+                parts.extend(self._get_code_parts(const))
+            else:
+                parts.append(repr(const))
+        return parts
 
-                details[item_key] = r.json()
+    def _get_details_items( self, source, data ):
+        req_items = []
+        if source in ['movies', 'tvseries', 'search']:
+            for item in data:
+                params = {'name_id': item['name_id'],
+                          'season': 0,
+                          'content': 'tvseries' if item['serial'] else 'movies'}
+                req_items.append(params)
+        elif source == 'seasons':
+            item = data['serial']
+            for season in xrange(1, data['seasons']['count'] + 1):
+                params = {'name_id': item['name_id'],
+                          'season': season,
+                          'content': 'tvseries' if item['serial'] else 'movies'}
+                req_items.append(params)
 
-                if self._cache is not None:
-                    item_for_caching = {'name_id': item['name_id'],
-                                        'season': item['season'],
-                                        'time': time.time(),
-                                        'data': r.text,
-                                        }
-                    items_for_caching.append(item_for_caching)
+        return req_items
+
+    def _iter_fetch_details( self, items, source, deadline=None ):
+        #Every document is cached as soon as it is loaded, documents of one
+        #listing are not memoized to let them go after use
+        for item, item_data in self._imap_parallel(self._get_item_details, items, (source, False), deadline):
+            if item_data is not None \
+              and self._cache is not None:
+                self._cache.set_details_list([{'name_id': item['name_id'],
+                                               'season': item['season'],
+                                               'time': time.time(),
+                                               'data': item_data,
+                                               }])
+            yield item, item_data
+
+    def _fetch_details( self, items, source, deadline=None ):
+        #Loads the details again and saves them to the cache
+        responses = self._map_parallel(self._get_item_details, items, (source,), deadline)
+
+        items_for_caching = []
+        for item, item_data in zip(items, responses):
+            #Failed items are listed with basic data
+            if item_data is None:
+                continue
+
+            items_for_caching.append({'name_id': item['name_id'],
+                                      'season': item['season'],
+                                      'time': time.time(),
+                                      'data': item_data,
+                                      })
 
         if self._cache is not None:
             self._cache.set_details_list(items_for_caching)
 
-        return details
+    def _get_item_details( self, item, source, memoize=True ):
+        action = self._get_details_action(source)
+        url_params = {'#name_id': item['name_id']}
+
+        if action == 'browse_episodes':
+            url_params['#season'] = item['season']
+        else:
+            url_params['#content'] = item['content']
+
+        return self._http_request(action, url_params=url_params, memoize=memoize)
+
+    def _get_details_action( self, source ):
+        if source == 'seasons':
+            return 'browse_episodes'
+        else:
+            return 'get_content_details'
+
+    def _map_parallel( self, func, items, args=(), deadline=None ):
+        #Items which are not started before deadline get None
+        results = [None] * len(items)
+
+        tasks = Queue.Queue()
+        for index, item in enumerate(items):
+            tasks.put((index, item))
+
+        def worker():
+            while True:
+                if deadline is not None \
+                  and time.time() >= deadline:
+                    return
+                try:
+                    index, item = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = func(item, *args)
+                except (ZonaMobiApiError, ValueError):
+                    results[index] = None
+
+        workers = []
+        for i in xrange(min(self.detail_workers, len(items)) - 1):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+
+        worker()
+        for thread in workers:
+            thread.join()
+
+        return results
+
+    def _imap_parallel( self, func, items, args=(), deadline=None, workers=None ):
+        #Yields (item, result) in order of the items as soon as the result
+        #is ready. Not more than detail_window results are loaded ahead of
+        #the consumer, items which are not started before deadline get None.
+        #Unexpected error of an item is raised to the consumer
+        if not items:
+            return
+
+        if workers is None:
+            workers = self.detail_workers
+            window_size = self.detail_window
+        else:
+            window_size = workers * 2
+
+        results = {}
+        ready = threading.Condition()
+        window = threading.Semaphore(window_size)
+        state = {'workers': min(workers, len(items)),
+                 'stopped': False}
+
+        tasks = Queue.Queue()
+        for index, item in enumerate(items):
+            tasks.put((index, item))
+
+        def worker():
+            try:
+                while True:
+                    window.acquire()
+                    if state['stopped'] \
+                      or deadline is not None and time.time() >= deadline:
+                        break
+                    try:
+                        index, item = tasks.get_nowait()
+                    except Queue.Empty:
+                        break
+                    error = None
+                    try:
+                        result = func(item, *args)
+                    except (ZonaMobiApiError, ValueError):
+                        result = None
+                    except Exception as err:
+                        result = None
+                        error = err
+                    with ready:
+                        results[index] = (result, error)
+                        ready.notify_all()
+            finally:
+                #Consumer waits for the results while there are workers
+                with ready:
+                    state['workers'] -= 1
+                    ready.notify_all()
+
+        for i in xrange(state['workers']):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for index, item in enumerate(items):
+                with ready:
+                    while index not in results \
+                      and state['workers']:
+                        ready.wait()
+                    result, error = results.pop(index, (None, None))
+                window.release()
+
+                if error is not None:
+                    raise error
+
+                yield item, result
+                del result
+        finally:
+            #Consumer has stopped early, waiting workers must not start
+            #new requests
+            state['stopped'] = True
+            for i in xrange(workers):
+                window.release()
 
     def _make_list( self, source, data, items=None, item=None, params=None ):
         items = items or []
@@ -501,13 +3424,17 @@ class ZonaMobi:
 
         if source in ['movies', 'tvseries', 'search']:
 
-            details = self._get_items_details(source, items)
+            built_items = self._get_built_items(source, [(item['name_id'], 0) for item in items])
+            details = self._iter_items_details(source, items, skip_keys=built_items)
 
-            for item in items:
-                item_key = '%s_%d' % (item['name_id'], 0)
+            for item, item_data in itertools.izip(items, details):
+
+                built_item = built_items.get((item['name_id'], 0))
+                if built_item is not None:
+                    yield self._load_built_item(built_item)
+                    continue
 
                 full_details = True
-                item_data = details.get(item_key)
                 if item_data is not None:
                     item_type = 'serial' if item['serial'] else 'movie'
                     item_detail = item_data[item_type]
@@ -521,6 +3448,10 @@ class ZonaMobi:
                               }
 
                 item_info = self._get_item_info(item_data, item_detail, full_details )
+                if full_details:
+                    self._save_built_item((item['name_id'], 0), video_info, item_info)
+                #Parsed document is not needed anymore
+                item_data = item_detail = None
 
                 video_info = {'item_info':  item_info,
                               'video_info': video_info,
@@ -530,13 +3461,18 @@ class ZonaMobi:
 
         elif source == 'seasons':
 
-            details = self._get_items_details(source, data)
+            seasons = xrange(1, data['seasons']['count'] + 1)
+            built_items = self._get_built_items(source, [(item['name_id'], season) for season in seasons])
+            details = self._iter_items_details(source, data, skip_keys=built_items)
 
-            for season in xrange(1, data['seasons']['count'] + 1):
-                item_key = '%s_%d' % (item['name_id'], season)
+            for season, item_data in itertools.izip(seasons, details):
+
+                built_item = built_items.get((item['name_id'], season))
+                if built_item is not None:
+                    yield self._load_built_item(built_item)
+                    continue
 
                 full_details = True
-                item_data = details.get(item_key)
                 if item_data is not None:
                     item_type = 'serial' if item['serial'] else 'movie'
                     season_detail = item_data[item_type]
@@ -551,6 +3487,9 @@ class ZonaMobi:
                               'season':  season}
 
                 item_info = self._get_item_info(season_data, season_detail, params=video_info )
+                if full_details:
+                    self._save_built_item((item['name_id'], season), video_info, item_info)
+                item_data = season_data = season_detail = None
 
                 video_info = {'item_info':  item_info,
                               'video_info': video_info,
@@ -584,11 +3523,8 @@ class ZonaMobi:
                 yield video_info
 
     def _get_episode( self, episode, season, data ):
-        for _episode in self._make_eposode_list(data):
-            if _episode['episode'] == int(episode) \
-               and _episode['season'] == int(season):
-                return _episode
-        return {}
+        by_key = self._get_episodes_index(data)['by_key']
+        return by_key.get((int(season), int(episode)), {})
 
     def _get_rating( self, item ):
 
@@ -614,30 +3550,12 @@ class ZonaMobi:
         else:
             rating = 0
 
-        return {'type':	rating_source,
-                'rating': rating,
-                'votes': item.get(votes_field, 0),
-                'defaultt': False,
-                }
+        return ZonaMobiRating(rating_source, rating, item.get(votes_field, 0))
 
     def _get_premiere_date( self, item ):
 
         premiered = ''
 
-        months = {u'января':   1,
-                  u'февраля':  2,
-                  u'марта':    3,
-                  u'апреля':   4,
-                  u'мая':      5,
-                  u'июня':     6,
-                  u'июля':     7,
-                  u'августа':  8,
-                  u'сентября': 9,
-                  u'октября': 10,
-                  u'ноября':  11,
-                  u'декабря': 12,
-                  }
-
         release_date_int = item.get('release_date_int', '')
         release_date_rus = item.get('release_date_rus', '')
 
@@ -648,42 +3566,26 @@ class ZonaMobi:
 
         if release_date:
             parts = release_date.split(' ')
-            premiered = '%s-%02d-%02d' % (parts[2], months[parts[1]], int(parts[0]))
+            premiered = '%s-%02d-%02d' % (parts[2], self._months[parts[1]], int(parts[0]))
 
         return premiered
 
     def _get_item_info( self, data, item, full_details=True, params={} ):
 
-        #Default variables
-        fanart = ''
-        aired = ''
-        date = ''
-        premiered = ''
-        title = ''
-        originaltitle = ''
-        tvshowtitle = ''
-        plot = ''
-        episode = None
-        season = None
-        mobi_link_id = ''
-
-        ratings = []
-        genres = []
-        cast = []
-        director = []
-        writer = []
-        country = []
+        #Fields which are not set here get empty values of ZonaMobiVideoInfo
+        video = ZonaMobiVideoInfo(item.get('year'))
 
-        properties = {}
-        mediatype = 'video'
-        duration = 0
+        fanart = ''
+        ratings = ()
+        cast = ()
+        properties = None
 
         #Defaults
         if full_details:
             poster = item['image']
             fanart = data['backdrops']['image_1280']
-            plot = item.get('description')
-            premiered = self._get_premiere_date(item)
+            video.plot = item.get('description')
+            video.premiered = self._get_premiere_date(item)
         else:
             poster = item['cover']
 
@@ -705,43 +3607,38 @@ class ZonaMobi:
 
         if full_details:
             #Duration
-            if item['runtime']:
-                duration = item['runtime']['value'] * 60
+            video.duration = item['runtime']['value'] * 60 if item['runtime'] else 0
 
             #Genres
-            for genre in data['genres']:
-                genres.append(genre['name'])
+            video.genre = [genre['name'] for genre in data['genres']]
 
             persons = data.get('persons', {})
 
             #Cast
-            for actor in persons.get('actors', []):
-                cast.append({'name': actor['name'],
-                             'thumbnail': actor['cover'].replace('https://', 'http://')})
+            cast = [ZonaMobiCastMember(actor['name'], actor['cover'].replace('https://', 'http://')) for actor in persons.get('actors', [])]
 
             #Director
-            for _director in persons.get('director', []):
-                director.append(_director['name'])
+            video.director = [_director['name'] for _director in persons.get('director', [])]
 
             #Writer
-            for scenarist in persons.get('scenarist', []):
-                writer.append(scenarist['name'])
+            video.writer = [scenarist['name'] for scenarist in persons.get('scenarist', [])]
 
             #Country
-            for _country in data.get('countries', []):
-                country.append(_country['name'])
+            video.country = [_country['name'] for _country in data.get('countries', [])]
 
             #Date
             mobi_link_date = item.get('mobi_link_date', '')
             if mobi_link_date:
-                date = ('%s.%s.%s') %(mobi_link_date[8:10], mobi_link_date[5:7], mobi_link_date[0:4])
+                video.date = ('%s.%s.%s') %(mobi_link_date[8:10], mobi_link_date[5:7], mobi_link_date[0:4])
 
         if item['serial']:
-            tvshowtitle = item_title
+            video.tvshowtitle = item_title
 
             p_episode = params.get('episode')
             p_season = params.get('season')
 
+            season = None
+            episode = None
             if data is not None:
                 season = data['seasons']['count']
                 episode = data['episodes']['count_all']
@@ -750,17 +3647,17 @@ class ZonaMobi:
                 _episode = self._get_episode(p_episode, p_season, data)
                 mobi_link_id = _episode.get('mobi_link_id','')
 
-                mediatype = 'episode'
+                video.mediatype = 'episode'
                 thumb = data['images'].get(str(mobi_link_id)).replace('https://', 'http://')
 
                 release_date = _episode.get('release_date')
                 if release_date:
-                    aired = release_date[0:10]
+                    video.aired = release_date[0:10]
 
                 title = _episode.get('title', '')
                 if type(title) == int:
                     title = str(title)
-                originaltitle = title
+                video.title = video.sorttitle = video.originaltitle = title
 
                 episode = _episode['episode']
                 season = _episode['season']
@@ -771,62 +3668,32 @@ class ZonaMobi:
                     season = 0
 
             elif p_season is not None:
-                mediatype = 'season'
-                title = item_title
-                originaltitle = item_title_orig
-                episodes = self._make_eposode_list(data)
-                for _episode in episodes:
-                    if _episode['episode'] == 1:
-                      if _episode['release_date']:
-                        aired = _episode['release_date'][0:10]
-                      break
-                properties['TotalEpisodes'] = str(len(episodes))
-                properties['WatchedEpisodes'] = '0'
+                video.mediatype = 'season'
+                video.title = video.sorttitle = item_title
+                video.originaltitle = item_title_orig
+                episodes_index = self._get_episodes_index(data)
+                first_episode = episodes_index['first_episode']
+                if first_episode is not None \
+                  and first_episode['release_date']:
+                    video.aired = first_episode['release_date'][0:10]
+                properties = {'TotalEpisodes': str(len(episodes_index['list'])),
+                              'WatchedEpisodes': '0'}
             else:
-                mediatype = 'tvshow'
-                title = item_title
-                originaltitle = item_title_orig
+                video.mediatype = 'tvshow'
+                video.title = video.sorttitle = item_title
+                video.originaltitle = item_title_orig
                 ratings = self._get_rating(item)
 
-                properties['TotalSeasons'] = str(season)
-                properties['TotalEpisodes'] = str(episode)
-                properties['WatchedEpisodes'] = '0'
+                properties = {'TotalSeasons': str(season),
+                              'TotalEpisodes': str(episode),
+                              'WatchedEpisodes': '0'}
+
+            video.season = video.sortseason = season
+            video.episode = video.sortepisode = episode
         else:
-            mediatype = 'movie'
-            title = item_title
-            originaltitle = item_title_orig
+            video.mediatype = 'movie'
+            video.title = video.sorttitle = item_title
+            video.originaltitle = item_title_orig
             ratings = self._get_rating(item)
 
-        item_info = {# 'label':  label,
-                     'cast':   cast,
-                     'ratings': ratings,
-                     'properties': properties,
-                     'info': {'video': {'date': date,
-                                        'genre': genres,
-                                        'country': country,
-                                        'year': item.get('year'),
-                                        'sortepisode': episode,
-                                        'sortseason': season,
-                                        'director': director,
-                                        'plot': plot,
-                                        'title': title,
-                                        'originaltitle': originaltitle,
-                                        'sorttitle': title,
-                                        'duration': duration,
-                                        'writer': writer,
-                                        'premiered': premiered,
-                                        'aired': aired,
-                                        'mediatype': mediatype,
-                                        }
-                              },
-                     'art': {'poster': poster},
-                     'fanart': fanart,
-                     'thumb':  thumb,
-                    }
-        if item['serial']:
-            item_info['info']['video'].update({'episode': episode,
-                                               'season': season,
-                                               'tvshowtitle': tvshowtitle,
-                                               })
-
-        return item_info
\ No newline at end of file
+        return ZonaMobiItem(video, poster, fanart, thumb, ratings, cast, properties)
\ No newline at end of file
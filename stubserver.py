@@ -0,0 +1,386 @@
+# coding: utf-8
+# Module: stubserver
+
+import re
+import sys
+import time
+import zlib
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+class ZonaMobiStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    #Headers and body are sent in one packet, otherwise delayed ACK
+    #adds up to 40 ms to every response
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    _routes = [('main', r'^/?$'),
+               ('get_filters', r'^/ajax/widget/filter$'),
+               ('app_update_info', r'^/api/v1/app_update_info$'),
+               ('get_video_url', r'^/api/v1/video/(?P<mobi_link_id>\d+)$'),
+               ('search', r'^/search//(?P<keyword>[^/]+)$'),
+               ('browse_content_updates', r'^/updates/(?P<content>movies|tvseries)$'),
+               ('browse_episodes', r'^/tvseries/(?P<name_id>[^/]+)/season-(?P<season>\d+)$'),
+               ('browse_content', r'^/(?P<content>movies|tvseries)(/filter(?P<filter>(/[^/]+)*))?/?$'),
+               ('get_content_details', r'^/(?P<content>movies|tvseries)/(?P<name_id>[^/]+)$'),
+               ]
+
+    def do_GET( self ):
+        stub = self.server.stub
+
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+
+        action = None
+        for route, pattern in self._routes:
+            match = re.match(pattern, url.path)
+            if match is not None:
+                action = route
+                break
+
+        stub.count(action)
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        if action is None \
+          or action in stub.failures:
+            self._send(404 if action is None else 500, {})
+            return
+
+        status = stub.get_error(action)
+        if status is not None:
+            self._send(status, {})
+            return
+
+        params = match.groupdict()
+        params['page'] = int(query.get('page', ['1'])[0])
+
+        self._send(200, getattr(stub, action)(params))
+
+    def _send( self, status, data ):
+        body = json.dumps(data)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message( self, format, *args ):
+        pass
+
+class ZonaMobiStubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+class ZonaMobiStub:
+
+    #Every title has one or two genres and one country of these
+    genres = [u'драма', u'комедия', u'боевик', u'фантастика']
+    countries = [u'США', u'Россия', u'Франция']
+
+    def __init__( self, latency=0, payload_size=1, page_size=20, total_pages=5, seasons=3, episodes=10 ):
+
+        #latency is a delay of every response in seconds, payload_size
+        #multiplies size of texts and lists in the documents
+        self.latency = latency
+        self.payload_size = payload_size
+        self.page_size = page_size
+        self.total_pages = total_pages
+        #Titles which have been added at the top of the listings
+        self.new_titles = 0
+        self.seasons = seasons
+        self.episodes = episodes
+
+        #Actions which respond with an error
+        self.failures = set()
+        #Statuses of the next responses of the actions, e.g. {'search': [500]}
+        self.errors = {}
+
+        self.requests = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def start( self, port=0 ):
+        self._server = ZonaMobiStubServer(('127.0.0.1', port), ZonaMobiStubHandler)
+        self._server.stub = self
+
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        return self.url
+
+    def stop( self ):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    @property
+    def url( self ):
+        return 'http://127.0.0.1:%d' % self._server.server_port
+
+    def count( self, action ):
+        with self._lock:
+            self.requests[action] = self.requests.get(action, 0) + 1
+
+    def get_error( self, action ):
+        with self._lock:
+            statuses = self.errors.get(action)
+            if statuses:
+                return statuses.pop(0)
+
+    def get_requests_count( self ):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def reset( self ):
+        with self._lock:
+            self.requests = {}
+
+    def main( self, params ):
+        return {'current_year': 2019}
+
+    def get_filters( self, params ):
+        genres = {}
+        for i, name in enumerate(self.genres):
+            genres[str(i + 1)] = {'id': i + 1, 'name': name, 'translit': 'genre-%d' % (i + 1)}
+
+        countries = []
+        for i, name in enumerate(self.countries):
+            countries.append({'id': i + 1, 'name': name, 'translit': 'country-%d' % (i + 1)})
+
+        return {'genres': genres,
+                'countries': countries}
+
+    def app_update_info( self, params ):
+        return {'version': '1.0.0',
+                'base_url': self.url}
+
+    def get_video_url( self, params ):
+        mobi_link_id = params['mobi_link_id']
+        expires = int(time.time()) + 3600
+        return {'lqUrl': '%s/video/%s/lq.mp4?expires=%d' % (self.url, mobi_link_id, expires),
+                'url': '%s/video/%s/hq.mp4?expires=%d' % (self.url, mobi_link_id, expires)}
+
+    def search( self, params ):
+        data = self._make_listing(params['keyword'], None, params['page'])
+        data['is_second'] = False
+        return data
+
+    def browse_content( self, params ):
+        if params.get('filter'):
+            return self._make_filtered_listing(params['content'], params['filter'], params['page'])
+        return self._make_listing(params['content'], params['content'] == 'tvseries', params['page'])
+
+    def browse_content_updates( self, params ):
+        return self._make_listing('updates-%s' % params['content'], params['content'] == 'tvseries', params['page'])
+
+    def get_content_details( self, params ):
+        serial = (params['content'] == 'tvseries')
+        return self._make_document(params['name_id'], serial, 1 if serial else 0)
+
+    def browse_episodes( self, params ):
+        return self._make_document(params['name_id'], True, int(params['season']))
+
+    def _make_listing( self, prefix, serial, page ):
+        #New titles go first and push the others to the next pages
+        count = self.page_size * self.total_pages + self.new_titles
+        start = (page - 1) * self.page_size
+
+        items = []
+        for index in xrange(start, min(start + self.page_size, count)):
+            position = index - self.new_titles
+            if position < 0:
+                name_id = '%s-new-%d' % (prefix, -position)
+            else:
+                name_id = '%s-%d-%d' % (prefix, position // self.page_size + 1, position % self.page_size)
+            item_serial = serial if serial is not None else ((index - start) % 2 == 1)
+            items.append(self._make_item(name_id, item_serial))
+
+        return {'title_h1': u'Список %s' % prefix,
+                'items': items,
+                'pagination': {'current_page': page,
+                               'total_pages': self._get_total_pages()},
+                }
+
+    def _get_total_pages( self ):
+        count = self.page_size * self.total_pages + self.new_titles
+        return (count + self.page_size - 1) // self.page_size
+
+    def _make_filtered_listing( self, content, filter, page ):
+        #Titles of the unfiltered pages which match all the filters, like
+        #/genre-genre-1/year-90s/sort-rating
+        filters = {}
+        for part in filter.strip('/').split('/'):
+            key, value = part.split('-', 1)
+            filters[key] = value
+
+        items = []
+        for list_page in xrange(1, self._get_total_pages() + 1):
+            for item in self._make_listing(content, content == 'tvseries', list_page)['items']:
+                if self._match_filters(item, filters):
+                    items.append(item)
+
+        if filters.get('sort') == 'rating':
+            items.sort(key=lambda item: float(item['rating']), reverse=True)
+        elif filters.get('sort') == 'date':
+            items.sort(key=lambda item: item['year'], reverse=True)
+
+        total_pages = max((len(items) + self.page_size - 1) // self.page_size, 1)
+        start = (page - 1) * self.page_size
+
+        return {'title_h1': u'Список %s' % content,
+                'items': items[start:start + self.page_size],
+                'pagination': {'current_page': page,
+                               'total_pages': total_pages},
+                }
+
+    def _match_filters( self, item, filters ):
+        genres, countries = self._get_item_filters(item['name_id'])
+
+        if 'genre' in filters \
+          and filters['genre'] not in genres:
+            return False
+        if 'country' in filters \
+          and filters['country'] not in countries:
+            return False
+        if 'rating' in filters \
+          and float(item['rating']) < int(filters['rating']):
+            return False
+
+        year = filters.get('year')
+        if year == 'old':
+            return item['year'] < 1940
+        elif year and year.endswith('s'):
+            decade = int(year[:-1])
+            if decade < 100:
+                decade += 1900
+            return decade <= item['year'] < decade + 10
+        elif year:
+            return item['year'] == int(year)
+
+        return True
+
+    def _get_item_filters( self, name_id ):
+        #Translits of the genres and countries of a title
+        number = zlib.crc32(name_id) & 0xffff
+
+        genres = ['genre-%d' % (number % len(self.genres) + 1)]
+        second = (number >> 4) % len(self.genres) + 1
+        if 'genre-%d' % second not in genres:
+            genres.append('genre-%d' % second)
+
+        countries = ['country-%d' % ((number >> 8) % len(self.countries) + 1)]
+
+        return genres, countries
+
+    def _make_item( self, name_id, serial ):
+        number = zlib.crc32(name_id) & 0xffff
+
+        return {'name_id': name_id,
+                'name_rus': u'Название %s' % name_id,
+                'name_eng': 'Title %s' % name_id,
+                'name_original': 'Title %s' % name_id,
+                'serial': serial,
+                'year': 1980 + number % 40,
+                'cover': 'https://img.example.com/cover/%s.jpg' % name_id,
+                'image': 'https://img.example.com/image/%s.jpg' % name_id,
+                'description': u'Описание фильма. ' * 20 * self.payload_size,
+                'runtime': None if serial else {'value': 60 + number % 90, 'text': u'%d мин.' % (60 + number % 90)},
+                'release_date_int': u'1 января %d' % (1980 + number % 40),
+                'release_date_rus': u'1 января %d' % (1980 + number % 40),
+                'rating': '%.1f' % (5 + (number % 50) / 10.0),
+                'rating_count': number,
+                'rating_imdb': '%.1f' % (5 + (number % 40) / 10.0),
+                'rating_imdb_count': number * 2,
+                'rating_kinopoisk': '%.1f' % (5 + (number % 45) / 10.0),
+                'rating_kinopoisk_count': number * 3,
+                'mobi_link_id': number,
+                'mobi_link_date': '2019-01-02 10:00:00',
+                'trailer_url': 'https://img.example.com/trailer/%s.mp4' % name_id,
+                'trailer': {'id': number + 1, 'url': ''},
+                'seo_title': u'Смотреть онлайн %s' % name_id,
+                'seo_description': u'Смотреть онлайн бесплатно. ' * 10 * self.payload_size,
+                }
+
+    def _make_document( self, name_id, serial, season ):
+        item = self._make_item(name_id, serial)
+
+        persons = []
+        for i in xrange(10 * self.payload_size):
+            persons.append({'name': u'Актер %d' % i,
+                            'name_eng': 'Actor %d' % i,
+                            'cover': 'https://img.example.com/person/%d.jpg' % i,
+                            'translit': 'actor-%d' % i,
+                            })
+
+        similar = []
+        for i in xrange(6 * self.payload_size):
+            similar.append(self._make_item('%s-similar-%d' % (name_id, i), serial))
+
+        genres, countries = self._get_item_filters(name_id)
+
+        document = {'serial' if serial else 'movie': item,
+                    'backdrops': {'image_1280': 'https://img.example.com/backdrop/%s.jpg' % name_id},
+                    'genres': [self._make_filter_value(self.genres, value) for value in genres],
+                    'countries': [self._make_filter_value(self.countries, value) for value in countries],
+                    'persons': {'actors': persons,
+                                'director': persons[:1],
+                                'scenarist': persons[1:3]},
+                    'similar': similar,
+                    }
+
+        if serial:
+            episodes = {}
+            images = {}
+            for i in xrange(self.episodes, 0, -1):
+                mobi_link_id = season * 100000 + i
+                episodes[str(mobi_link_id)] = {'season': season,
+                                               'episode': i,
+                                               'episode_key': '%02d-%04d' % (season, i),
+                                               'mobi_link_id': mobi_link_id,
+                                               'release_date': '2015-01-%02d 00:00:00' % (i % 28 + 1),
+                                               'title': u'Серия %d' % i,
+                                               }
+                images[str(mobi_link_id)] = 'https://img.example.com/episode/%d.jpg' % mobi_link_id
+
+            document.update({'seasons': {'count': self.seasons},
+                             'episodes': {'count_all': self.episodes * self.seasons, 'items': episodes},
+                             'images': images,
+                             })
+
+        return document
+
+    def _make_filter_value( self, names, value ):
+        number = int(value.rsplit('-', 1)[1])
+        return {'id': number, 'name': names[number - 1], 'translit': value}
+
+def main( args ):
+    #Stub can be started alone to point a Kodi installation at it
+    port = int(args[0]) if args else 8080
+    latency = float(args[1]) if len(args) > 1 else 0
+
+    stub = ZonaMobiStub(latency=latency)
+    print(stub.start(port))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stub.stop()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
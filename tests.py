@@ -3,6 +3,10 @@
 
 import os
 import sys
+import time
+import json
+import sqlite3
+import threading
 import unittest
 import shutil
 
@@ -13,9 +17,23 @@ plugin_name = 'plugin.video.zona.mobi'
 
 # Import our module being tested
 sys.path.append(os.path.join(cwd, plugin_name))
-from resources.lib.zonamobi import ZonaMobi
+from resources.lib.zonamobi import ZonaMobi, ZonaMobiApiError, ZonaMobiCache
+from stubserver import ZonaMobiStub
+
+# Tests run against a local stub of the site unless a real one is given,
+# e.g. ZONA_SITE_URL=w21.zona.plus
+site_url = os.environ.get('ZONA_SITE_URL')
+stub = None
+
+def setUpModule():
+    global site_url, stub
+    if not site_url:
+        stub = ZonaMobiStub()
+        site_url = stub.start()
 
 def tearDownModule():
+    if stub is not None:
+        stub.stop()
     shutil.rmtree(cache_dir, True)
 
 class ZonaMobiTestCase(unittest.TestCase):
@@ -29,7 +47,10 @@ class ZonaMobiTestCase(unittest.TestCase):
                   'video_quality': 1,
                   }
 
-        self.api = ZonaMobi('w21.zona.plus', params)
+        self.api = ZonaMobi(site_url, params)
+
+    def tearDown(self):
+        self.api.close()
 
     def test_browse_content_movies(self):
         print('\n#test_browse_content_movies')
@@ -61,6 +82,108 @@ class ZonaMobiTestCase(unittest.TestCase):
 
         self.assertTrue(has_video)
 
+    def test_browse_content_local(self):
+        print('\n#test_browse_content_local')
+
+        if stub is None:
+            self.skipTest('walks the whole site')
+
+        self.api.close()
+        self.api = ZonaMobi(site_url, {'cache_dir': os.path.join(cache_dir, 'catalogue'),
+                                       'catalogue_sync': True,
+                                       'catalogue_workers': 4,
+                                       'catalogue_rate': 50,
+                                       })
+        self.assertTrue(self.api.sync_catalogue())
+
+        params = {'genre': 'genre-2',
+                  'year': '90s',
+                  'sort': 'rating'}
+
+        #Listing is made from the catalogue copy without requests
+        requests_count = stub.get_requests_count()
+        video_list = self.api.get_video_list('movies', params)
+        name_ids = [video['video_info']['name_id'] for video in video_list['list']]
+        self.assertEqual(stub.get_requests_count(), requests_count)
+
+        print('In local list %d movies:' % (video_list['count']))
+        for name_id in name_ids:
+            print('name_id: %s' % (name_id))
+
+        #Titles are the same and in the same order as on the site
+        api = ZonaMobi(site_url)
+        site_list = api.get_video_list('movies', params)
+        self.assertEqual(name_ids, [video['video_info']['name_id'] for video in site_list['list']])
+        api.close()
+
+    def test_browse_content_failed_item(self):
+        print('\n#test_browse_content_failed_item')
+
+        #Unexpected error of one document must reach the listing instead
+        #of leaving it waiting for the worker. The API is used in the
+        #thread which has created it
+        result = {}
+        def list_videos():
+            api = ZonaMobi(site_url, {'cache_dir': os.path.join(cache_dir, 'failed_item'),
+                                      'load_details': True,
+                                      })
+
+            get_item_details = api._get_item_details
+            def failing_get_item_details(item, *args, **kwargs):
+                if item['name_id'].endswith('-5'):
+                    raise RuntimeError('Truncated response')
+                return get_item_details(item, *args, **kwargs)
+            api._get_item_details = failing_get_item_details
+
+            try:
+                for video in api.get_video_list('movies', {'page': 2})['list']:
+                    pass
+            except RuntimeError as err:
+                result['error'] = err
+            finally:
+                api.close()
+
+        thread = threading.Thread(target=list_videos)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+
+        self.assertFalse(thread.is_alive())
+        self.assertIn('error', result)
+
+    def test_browse_content_bad_response(self):
+        print('\n#test_browse_content_bad_response')
+
+        import requests
+
+        api = ZonaMobi(site_url, {'cache_dir': os.path.join(cache_dir, 'bad_response'),
+                                  'load_details': True,
+                                  })
+
+        #Broken transfer of one document and a page which is not JSON of
+        #another are errors of the API, the items are listed without the
+        #details
+        get = api._transport.get
+        def failing_get(url, *args, **kwargs):
+            r = get(url, *args, **kwargs)
+            if url.endswith('-3'):
+                raise requests.exceptions.ChunkedEncodingError('Connection broken')
+            if url.endswith('-4'):
+                r._content = '<html>Bad gateway</html>'
+            return r
+        api._transport.get = failing_get
+
+        try:
+            self.assertRaises(ZonaMobiApiError, api._http_request, 'get_content_details', url_params={'#content': 'movies', '#name_id': 'movies-2-3'})
+            self.assertRaises(ZonaMobiApiError, api._http_request, 'get_content_details', url_params={'#content': 'movies', '#name_id': 'movies-2-4'})
+
+            video_list = api.get_video_list('movies', {'page': 2})
+            videos = list(video_list['list'])
+        finally:
+            api.close()
+
+        self.assertEqual(len(videos), video_list['count'])
+
     def test_browse_seasons(self):
         print('\n#test_browse_seasons')
 
@@ -98,6 +221,39 @@ class ZonaMobiTestCase(unittest.TestCase):
 
         self.assertTrue(has_video)
 
+        #Shared documents are not changed by the listing
+        for data in self.api._responses.itervalues():
+            self.assertEqual([key for key in data if key.startswith('_')], [])
+
+    def test_episodes_index(self):
+        print('\n#test_episodes_index')
+
+        def make_document(name_id, season):
+            episodes = [{'season': season, 'episode': i, 'episode_key': '%02d-%04d' % (season, i)} for i in [3, 1, 2]]
+            return {'serial': {'name_id': name_id},
+                    'episodes': {'items': episodes}}
+
+        #List of a shared document is not sorted in place
+        data = make_document('tvseries-index', 1)
+        index = self.api._get_episodes_index(data)
+        self.assertEqual([episode['episode'] for episode in index['list']], [1, 2, 3])
+        self.assertEqual([episode['episode'] for episode in data['episodes']['items']], [3, 1, 2])
+        self.assertIs(index['first_episode'], index['list'][0])
+
+        #Another document of the season gets the same index, documents are
+        #not kept by the index
+        self.assertIs(self.api._get_episodes_index(make_document('tvseries-index', 1)), index)
+        for value in self.api._episodes_indexes.itervalues():
+            self.assertNotIn(data, value.values())
+
+        #The last used indexes are kept
+        for season in xrange(2, self.api._episodes_indexes_size + 1):
+            self.api._get_episodes_index(make_document('tvseries-index', season))
+        self.api._get_episodes_index(data)
+        self.api._get_episodes_index(make_document('tvseries-index', 100))
+        self.assertIs(self.api._get_episodes_index(data), index)
+        self.assertNotIn(('tvseries-index', 2, 3), self.api._episodes_indexes)
+
     def test_search(self):
         print('\n#test_search')
 
@@ -116,6 +272,148 @@ class ZonaMobiTestCase(unittest.TestCase):
 
         self.assertTrue(has_video)
 
+    def test_search_local(self):
+        print('\n#test_search_local')
+
+        #Titles are indexed when their details are saved to the cache
+        video_list = self.api.get_video_list('movies')
+        video = list(video_list['list'])[0]
+        name_id = video['video_info']['name_id']
+        title = video['item_info'].video.title
+        self.api.close()
+
+        self.api = ZonaMobi(site_url, {'cache_dir': cache_dir,
+                                       'search_mode': 'local',
+                                       })
+
+        params = {'keyword': title.encode('utf-8')}
+
+        video_list = self.api.get_video_list('search', params)
+
+        name_ids = []
+        print('There are %d local results for "%s":' % (video_list['count'], video_list['title']))
+        for video in video_list['list']:
+            video_info = video['video_info']
+            print('name_id: %s, type: %s' % (video_info['name_id'], video_info['type']))
+            name_ids.append(video_info['name_id'])
+
+        self.assertEqual(name_ids[0], name_id)
+
+        #Next pages are made of the cached titles too
+        if stub is None:
+            return
+
+        params = {'keyword': title.encode('utf-8').rsplit('-', 1)[0]}
+        name_ids = [video['video_info']['name_id'] for video in self.api.get_video_list('search', params)['list']]
+        self.assertGreater(len(name_ids), 10)
+
+        self.api.close()
+        self.api = ZonaMobi(site_url, {'cache_dir': cache_dir,
+                                       'search_mode': 'local',
+                                       'page_size': 10,
+                                       })
+        stub.reset()
+        pages = []
+        for page in xrange(1, (len(name_ids) + 9) // 10 + 1):
+            video_list = self.api.get_video_list('search', dict(params, page=page))
+            self.assertEqual(video_list['total_pages'], (len(name_ids) + 9) // 10)
+            pages.extend([video['video_info']['name_id'] for video in video_list['list']])
+
+        self.assertEqual(pages, name_ids)
+        self.assertFalse(stub.requests.get('search'))
+
+    def _add_search_titles(self, cache):
+        documents = ZonaMobiStub()
+        items = []
+        for name_id, name_rus, name_eng, year in [('matrix', u'Матрица', 'The Matrix', 1999),
+                                                  ('matrix-reloaded', u'Матрица: Перезагрузка', 'The Matrix Reloaded', 2003),
+                                                  ('martin', u'Мартин', 'Martin', 1999),
+                                                  ]:
+            document = documents._make_document(name_id, False, 0)
+            document['movie'].update({'name_rus': name_rus,
+                                      'name_eng': name_eng,
+                                      'name_original': name_eng,
+                                      'year': year,
+                                      })
+            items.append({'name_id': name_id,
+                          'season': 0,
+                          'data': document,
+                          'time': time.time(),
+                          })
+        cache.set_details_list(items)
+        cache.flush()
+
+    def test_search_titles(self):
+        print('\n#test_search_titles')
+
+        cache = ZonaMobiCache(os.path.join(cache_dir, 'search_titles'))
+        self._add_search_titles(cache)
+
+        def search(keyword):
+            name_ids = [item['name_id'] for item in cache.search_titles(keyword)[0]]
+            print('%s: %s' % (keyword, ', '.join(name_ids)))
+            return name_ids
+
+        try:
+            #Latin query finds the Cyrillic names by their translit and
+            #the other way round, the name equal to the query goes first
+            self.assertEqual(search('matritsa'), ['matrix', 'matrix-reloaded'])
+            self.assertEqual(search(u'Матрица'), ['matrix', 'matrix-reloaded'])
+            self.assertEqual(search(u'Матрица перезагрузка'), ['matrix-reloaded'])
+            self.assertEqual(search('the matrix'), ['matrix', 'matrix-reloaded'])
+
+            #Year of the title is matched too
+            self.assertEqual(search(u'Матрица 1999'), ['matrix'])
+            self.assertEqual(search('matrix 2003'), ['matrix-reloaded'])
+            self.assertEqual(search('1999'), ['matrix', 'martin'])
+        finally:
+            cache.conn.close()
+
+    def test_search_hybrid(self):
+        print('\n#test_search_hybrid')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        hybrid_dir = os.path.join(cache_dir, 'search_hybrid')
+        site = ZonaMobiStub(latency=1)
+        url = site.start()
+
+        def search():
+            api = ZonaMobi(url, {'cache_dir': hybrid_dir,
+                                 'search_mode': 'hybrid',
+                                 'search_wait': 0.2,
+                                 })
+            try:
+                video_list = api.get_video_list('search', {'keyword': 'matrix'})
+                name_ids = [video['video_info']['name_id'] for video in video_list['list']]
+                api.run_background_tasks()
+            finally:
+                api.close()
+            print('%d results, %d pages' % (len(name_ids), video_list['total_pages']))
+            return name_ids, video_list['total_pages']
+
+        try:
+            api = ZonaMobi(url, {'cache_dir': hybrid_dir})
+            self._add_search_titles(api._cache)
+            api.close()
+
+            #Site is slower than search_wait, only local titles are shown
+            #and the late site page is saved
+            name_ids, total_pages = search()
+            self.assertEqual(name_ids, ['matrix', 'matrix-reloaded'])
+            self.assertEqual(total_pages, 1)
+            self.assertEqual(site.requests['search'], 1)
+
+            #Next search adds the saved site page after the local titles
+            name_ids, total_pages = search()
+            self.assertEqual(name_ids[:2], ['matrix', 'matrix-reloaded'])
+            self.assertEqual(name_ids[2:], ['matrix-1-%d' % i for i in xrange(site.page_size)])
+            self.assertEqual(total_pages, site.total_pages)
+            self.assertEqual(site.requests['search'], 1)
+        finally:
+            site.stop()
+
     def test_get_content_url_movies(self):
         print('\n#test_get_content_url_movies')
 
@@ -123,8 +421,8 @@ class ZonaMobiTestCase(unittest.TestCase):
                   'name_id': 'futurama-zver-s-milliardom-spin'}
 
         item_info = self.api.get_content_url(params)
-        print('For "%s" url is "%s":' % (item_info['info']['video']['title'], item_info['path']))
-        self.assertNotEqual(item_info['path'], '')
+        print('For "%s" url is "%s":' % (item_info.video.title, item_info.path))
+        self.assertNotEqual(item_info.path, '')
 
     def test_get_content_url_tvseries(self):
         print('\n#test_get_content_url_tvseries')
@@ -136,8 +434,94 @@ class ZonaMobiTestCase(unittest.TestCase):
                   }
 
         item_info = self.api.get_content_url(params)
-        print('For "%s" episode "%s" url is "%s":' % (item_info['info']['video']['tvshowtitle'], item_info['info']['video']['title'], item_info['path']))
-        self.assertNotEqual(item_info['path'], '')
+        print('For "%s" episode "%s" url is "%s":' % (item_info.video.tvshowtitle, item_info.video.title, item_info.path))
+        self.assertNotEqual(item_info.path, '')
+
+    def test_video_url_cache(self):
+        print('\n#test_video_url_cache')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        params = {'type': 'movies',
+                  'name_id': 'futurama-zver-s-milliardom-spin'}
+        api_params = {'cache_dir': os.path.join(cache_dir, 'video_url'),
+                      'video_url_ttl': 120,
+                      }
+
+        #Only a link from the cache is checked for playback
+        cached_paths = []
+        def get_content_url():
+            api = ZonaMobi(site_url, api_params)
+            try:
+                path = api.get_content_url(params).path
+                cached_paths.append(api.cached_video_url)
+                return path
+            finally:
+                api.close()
+
+        stub.reset()
+        path = get_content_url()
+        print('Link "%s"' % (path))
+
+        #Link expires by its expires param, before video_url_ttl
+        api = ZonaMobi(site_url, api_params)
+        c = api._cache.conn.cursor()
+        expires = c.execute('SELECT expires FROM video_urls').fetchone()['expires']
+        self.assertEqual(expires, int(path.split('expires=')[1]) - 30)
+
+        #Next plugin call takes the link from the cache
+        self.assertEqual(get_content_url(), path)
+        self.assertEqual(stub.requests['get_video_url'], 1)
+
+        #Link which has failed to play is loaded again
+        api.invalidate_video_url(path)
+        api.close()
+        get_content_url()
+        self.assertEqual(stub.requests['get_video_url'], 2)
+        self.assertEqual(cached_paths, ['', path, ''])
+
+    def test_video_url_ttl(self):
+        print('\n#test_video_url_ttl')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        params = {'type': 'movies',
+                  'name_id': 'futurama-zver-s-milliardom-spin'}
+        video_url_dir = os.path.join(cache_dir, 'video_url_ttl')
+
+        def get_content_url(video_url_ttl):
+            api = ZonaMobi(site_url, {'cache_dir': video_url_dir,
+                                      'video_url_ttl': video_url_ttl,
+                                      })
+            try:
+                return api.get_content_url(params).path
+            finally:
+                api.close()
+
+        #Link which expires later than video_url_ttl is kept for it
+        stub.reset()
+        start = time.time()
+        path = get_content_url(1)
+        cache = ZonaMobiCache(video_url_dir)
+        expires = cache.conn.execute('SELECT expires FROM video_urls').fetchone()['expires']
+        self.assertGreater(int(path.split('expires=')[1]) - 30, start + 60)
+        self.assertTrue(start + 60 <= expires <= time.time() + 60)
+
+        get_content_url(1)
+        self.assertEqual(stub.requests['get_video_url'], 1)
+
+        #Expired link is loaded again
+        cache.conn.execute('UPDATE video_urls SET expires = :time', {'time': time.time() - 1})
+        cache.conn.close()
+        get_content_url(1)
+        self.assertEqual(stub.requests['get_video_url'], 2)
+
+        #Links are not cached with video_url_ttl 0
+        get_content_url(0)
+        get_content_url(0)
+        self.assertEqual(stub.requests['get_video_url'], 4)
 
     def test_get_trailer_url_movies(self):
         print('\n#test_get_trailer_url_movies')
@@ -162,11 +546,934 @@ class ZonaMobiTestCase(unittest.TestCase):
         print(item_info['path'])
         self.assertNotEqual(item_info['path'], '')
 
+    def test_sync_catalogue(self):
+        print('\n#test_sync_catalogue')
+
+        if stub is None:
+            self.skipTest('walks the whole site')
+
+        self.api.close()
+        self.api = ZonaMobi(site_url, {'cache_dir': cache_dir,
+                                       'catalogue_workers': 4,
+                                       'catalogue_rate': 50,
+                                       })
+
+        #Interrupted walk is continued by the next call
+        self.assertFalse(self.api.sync_catalogue(0.05))
+        self.assertTrue(self.api.sync_catalogue())
+
+        #Between the walks only the first pages of the unfiltered listings
+        #are loaded while they bring new titles
+        self.api.catalogue_ttl = 0
+        stub.reset()
+        self.assertTrue(self.api.sync_catalogue())
+        self.assertEqual(stub.get_requests_count(), 2)
+
+        c = self.api._catalogue.conn.cursor()
+        c.row_factory = None
+        for content, count in c.execute('SELECT type, COUNT(*) FROM titles GROUP BY type'):
+            print('%s: %d titles' % (content, count))
+            self.assertEqual(count, stub.page_size * stub.total_pages)
+
+    def test_response_cache(self):
+        print('\n#test_response_cache')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        response_dir = os.path.join(cache_dir, 'responses')
+
+        def get_page(**params):
+            api = ZonaMobi(site_url, dict(params, cache_dir=response_dir))
+            try:
+                data = api._get_content_page('movies', {'page': 4})
+                return data, api.get_cache_stats()['browse_content']
+            finally:
+                api.close()
+
+        stub.reset()
+        data, stats = get_page()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stub.requests['browse_content'], 1)
+
+        #Next plugin call takes the page from the cache
+        cached_data, stats = get_page()
+        self.assertEqual(cached_data, data)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stub.requests['browse_content'], 1)
+
+        #Forced refresh loads it from the site
+        get_page(force_refresh=True)
+        self.assertEqual(stub.requests['browse_content'], 2)
+
+        #and so does the call after the page has expired
+        cache = ZonaMobiCache(response_dir)
+        cache.conn.execute('UPDATE responses SET expires = :time', {'time': time.time() - 1})
+        cache.conn.close()
+        data, stats = get_page()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stub.requests['browse_content'], 3)
+
+    def test_prefetch_page(self):
+        print('\n#test_prefetch_page')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        params = {'cache_dir': os.path.join(cache_dir, 'prefetch'),
+                  'load_details': True,
+                  'prefetch': True,
+                  }
+
+        api = ZonaMobi(site_url, params)
+        try:
+            for video in api.get_video_list('movies', {'page': 3})['list']:
+                pass
+            api.run_background_tasks()
+        finally:
+            api.close()
+
+        #Next page and details of its items are taken from the cache
+        stub.reset()
+        api = ZonaMobi(site_url, params)
+        try:
+            videos = list(api.get_video_list('movies', {'page': 4})['list'])
+        finally:
+            api.close()
+
+        self.assertEqual(len(videos), stub.page_size)
+        self.assertFalse(stub.requests.get('browse_content'))
+        self.assertFalse(stub.requests.get('get_content_details'))
+
+    def test_transport_reuse(self):
+        print('\n#test_transport_reuse')
+
+        #Sequential requests share one kept-alive connection
+        api = ZonaMobi(site_url)
+        try:
+            for page in xrange(1, 6):
+                api._get_content_page('movies', {'page': page})
+            stats = api.get_transport_stats()
+        finally:
+            api.close()
+
+        print(stats)
+        self.assertEqual(stats, {'requests': 5, 'opened': 1, 'reused': 4})
+
+    def test_single_flight(self):
+        print('\n#test_single_flight')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        #Identical requests made while the first one is going wait for
+        #its response, later ones get the memoized response
+        site = ZonaMobiStub(latency=0.3)
+        url = site.start()
+        api = ZonaMobi(url)
+
+        start = threading.Event()
+        results = []
+        def request():
+            start.wait()
+            results.append(api._http_request('get_filters'))
+
+        threads = [threading.Thread(target=request) for i in xrange(8)]
+        try:
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+            results.append(api._http_request('get_filters'))
+            stats = api.get_request_stats()['get_filters']
+        finally:
+            api.close()
+            site.stop()
+
+        print(stats)
+        self.assertEqual(site.requests['get_filters'], 1)
+        self.assertEqual(stats, {'network': 1, 'coalesced': 7, 'memoized': 1})
+        self.assertEqual(len(results), 9)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_hedged_request(self):
+        print('\n#test_hedged_request')
+
+        #First request of the link is slow, with hedged requests on the
+        #second one wins and the slow response is closed when it comes
+        def get_video_url(params):
+            api = ZonaMobi(site_url, params)
+            api._hedge_delay = 0.2
+
+            sent = []
+            closed = []
+            send_once = api._send_once
+            def slow_send_once(*args):
+                sent.append(time.time())
+                if len(sent) == 1:
+                    time.sleep(1)
+                r = send_once(*args)
+                r.close = lambda: closed.append(r)
+                return r
+            api._send_once = slow_send_once
+
+            start = time.time()
+            try:
+                api._http_request('get_video_url', url_params={'#mobi_link_id': 1})
+                elapsed = time.time() - start
+                time.sleep(1)
+            finally:
+                api.close()
+            return elapsed, len(sent), len(closed)
+
+        elapsed, sent, closed = get_video_url({'hedge': True})
+        print('Hedged: %.2f s, %d requests' % (elapsed, sent))
+        self.assertLess(elapsed, 1)
+        self.assertEqual((sent, closed), (2, 1))
+
+        #Hedged requests are off by default
+        elapsed, sent, closed = get_video_url({})
+        print('Not hedged: %.2f s, %d requests' % (elapsed, sent))
+        self.assertGreaterEqual(elapsed, 1)
+        self.assertEqual((sent, closed), (1, 0))
+
+    def test_retry_request(self):
+        print('\n#test_retry_request')
+
+        if stub is None:
+            self.skipTest('needs errors of the stub')
+
+        #Responses are memoized by the API, every check uses a new one
+        def update_filters():
+            api = ZonaMobi(site_url)
+            api._retry_delay = 0.01
+            try:
+                return api.update_filters()
+            finally:
+                api.close()
+
+        stub.reset()
+        try:
+            #Server error is retried
+            stub.errors['get_filters'] = [500]
+            catalogue = update_filters()
+            self.assertTrue(catalogue['genres'])
+            self.assertEqual(stub.requests['get_filters'], 2)
+
+            #Missing page is not
+            stub.errors['get_filters'] = [404, 404]
+            self.assertRaises(ZonaMobiApiError, update_filters)
+            self.assertEqual(stub.requests['get_filters'], 3)
+
+            #Background task which starts after the deadline of the
+            #invocation is retried too
+            api = ZonaMobi(site_url)
+            api._retry_delay = 0.01
+            api._deadline = time.time() - 1
+            results = []
+            api._add_background_task(lambda: results.append(api.update_filters()))
+            stub.errors['get_filters'] = [500]
+            try:
+                api.run_background_tasks()
+            finally:
+                api.close()
+            self.assertTrue(results)
+            self.assertEqual(stub.requests['get_filters'], 5)
+        finally:
+            stub.errors = {}
+
+    def test_request_timeout(self):
+        print('\n#test_request_timeout')
+
+        #Attempt does not run past the deadline
+        timeouts = []
+        get = self.api._transport.get
+        def get_with_timeout(url, *args, **kwargs):
+            timeouts.append(kwargs['timeout'])
+            return get(url, *args, **kwargs)
+        self.api._transport.get = get_with_timeout
+
+        self.api._deadline = time.time() + 3
+        self.api._http_request('main')
+        self.api._deadline = time.time() - 1
+        self.api._http_request('get_filters')
+
+        self.assertLessEqual(timeouts[0][1], 3)
+        self.assertEqual(timeouts[1], (self.api._min_timeout, self.api._min_timeout))
+
+    def test_stale_while_revalidate(self):
+        print('\n#test_stale_while_revalidate')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        params = {'cache_dir': os.path.join(cache_dir, 'stale'),
+                  'load_details': True,
+                  'stale_while_revalidate': True,
+                  }
+
+        #Returns plots of the listed items and the number of detail
+        #requests made before the background tasks
+        def list_movies( run_background_tasks=False ):
+            api = ZonaMobi(site_url, params)
+            try:
+                video_list = api.get_video_list('movies', {'page': 4})
+                plots = [video['item_info'].video.plot for video in video_list['list']]
+                listed = stub.requests.get('get_content_details', 0)
+                if run_background_tasks:
+                    api.run_background_tasks()
+            finally:
+                api.close()
+            return plots, listed
+
+        list_movies()
+
+        #Details are three days old, older than the cache time but still
+        #usable while they are loaded again
+        cache = ZonaMobiCache(params['cache_dir'])
+        cache.conn.execute('UPDATE details SET time = time - 3 * 86400')
+        cache.conn.close()
+
+        stub.reset()
+        plots, listed = list_movies(True)
+        self.assertEqual(len(plots), stub.page_size)
+        self.assertTrue(all(plots))
+        self.assertEqual(listed, 0)
+        self.assertEqual(stub.requests.get('get_content_details'), stub.page_size)
+
+        cache = ZonaMobiCache(params['cache_dir'])
+        c = cache.conn.cursor()
+        oldest = c.execute('SELECT MIN(time) AS time FROM details').fetchone()['time']
+        cache.conn.close()
+        self.assertGreater(oldest, time.time() - 3600)
+
+        #Refreshed details are used without requests
+        stub.reset()
+        plots, listed = list_movies()
+        self.assertEqual(listed, 0)
+
+    def test_browse_content_deadline(self):
+        print('\n#test_browse_content_deadline')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        #Details are not loaded after the deadline, items are listed with
+        #data of the page
+        api = ZonaMobi(site_url, {'load_details': True,
+                                  'deadline': 0,
+                                  })
+        stub.reset()
+        try:
+            titles = [video['item_info'].video.title for video in api.get_video_list('movies', {'page': 3})['list']]
+        finally:
+            api.close()
+
+        print('In list %d movies' % (len(titles)))
+        self.assertEqual(len(titles), stub.page_size)
+        self.assertTrue(all(titles))
+        self.assertFalse(stub.requests.get('get_content_details'))
+
+    def test_switch_mirror(self):
+        print('\n#test_switch_mirror')
+
+        if stub is None:
+            self.skipTest('needs stubs of the mirrors')
+
+        #site_url does not respond, the first mirror fails the probe and
+        #the listing is loaded from the second one
+        down = ZonaMobiStub()
+        down_url = down.start()
+        down.stop()
+
+        broken = ZonaMobiStub()
+        broken.failures.add('app_update_info')
+        mirror = ZonaMobiStub()
+        mirror_urls = [broken.start(), mirror.start()]
+
+        api = ZonaMobi(down_url, {'mirror_hosts': mirror_urls})
+        try:
+            video_list = api.get_video_list('movies')
+            count = len(list(video_list['list']))
+            host = api.get_mirror()['host']
+        finally:
+            api.close()
+            broken.stop()
+            mirror.stop()
+
+        print('Mirror %s, %d movies' % (host, count))
+        self.assertEqual(host, mirror_urls[1])
+        self.assertEqual(count, mirror.page_size)
+        self.assertFalse(broken.requests.get('browse_content'))
+
+    def test_mirror_probe(self):
+        print('\n#test_mirror_probe')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        #Without the cache the time of the last probe is not known, the
+        #mirrors are not probed on every call
+        api = ZonaMobi(site_url)
+        try:
+            self.assertFalse(api._mirrors.need_probe())
+            self.assertEqual(api._background_tasks, [])
+        finally:
+            api.close()
+
+        #Probes are not counted in the transport stats and not recorded
+        probe_dir = os.path.join(cache_dir, 'mirror_probe')
+        cassette = os.path.join(cache_dir, 'mirror_probe.jsonl')
+        api = ZonaMobi(site_url, {'cache_dir': probe_dir,
+                                  'cassette': cassette,
+                                  'cassette_mode': 'record',
+                                  })
+        stub.reset()
+        try:
+            self.assertTrue(api._mirrors.need_probe())
+            healthy = api._mirrors.probe(api._mirrors.get_hosts())
+            stats = api.get_transport_stats()
+        finally:
+            api.close()
+
+        print(healthy)
+        self.assertEqual([host for rtt, host in healthy], [site_url])
+        self.assertEqual(stub.requests['app_update_info'], 1)
+        self.assertEqual(stats['requests'], 0)
+        self.assertFalse(os.path.exists(cassette))
+
+    def test_stub_actions(self):
+        print('\n#test_stub_actions')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        #Host with a scheme is used as is and every action of the api
+        #is answered by the stub
+        url_params = {'#content': 'movies',
+                      '#filter': 'filter/genre-drama',
+                      '#name_id': 'serial-1',
+                      '#season': 1,
+                      '#mobi_link_id': 1,
+                      '#keyword': 'title',
+                      }
+
+        site = ZonaMobiStub()
+        url = site.start()
+        api = ZonaMobi(url)
+        try:
+            self.assertEqual(api.base_url, url)
+            self.assertEqual(api._mirrors.get_host(url + '/movies'), url)
+            self.assertIsNone(api._switch_mirror('http://mirror.invalid/movies'))
+
+            for action in api._actions:
+                result = api._http_request(action, url_params=url_params, memoize=False, read_cache=False)
+                self.assertIsInstance(result, dict, action)
+
+            site.failures.add('get_filters')
+            self.assertRaises(ZonaMobiApiError, api._http_request, 'get_filters', memoize=False)
+            requests = site.requests.copy()
+        finally:
+            api.close()
+            site.stop()
+
+        print(requests)
+        #browse_catalogue has the same path as browse_content
+        self.assertIsNone(requests.get(None))
+        self.assertEqual(requests['browse_content'], 2)
+        self.assertEqual(sum(requests.values()) - requests['get_filters'], len(api._actions) - 1)
+        self.assertEqual(requests['get_filters'], 1 + 1 + api._actions['get_filters']['retries'])
+
+    def test_update_cache_v1(self):
+        print('\n#test_update_cache_v1')
+
+        if stub is None:
+            self.skipTest('counts requests of the stub')
+
+        #Database of the first version kept the raw page text
+        name_id = 'futurama-zver-s-milliardom-spin'
+        document = stub.get_content_details({'content': 'movies', 'name_id': name_id})
+
+        v1_dir = os.path.join(cache_dir, 'v1')
+        os.makedirs(v1_dir)
+        conn = sqlite3.connect(os.path.join(v1_dir, 'cache.db'))
+        conn.execute('CREATE TABLE version (idVersion integer)')
+        conn.execute('CREATE TABLE details (name_id text, season integer, data text, time integer)')
+        conn.execute('CREATE UNIQUE INDEX details_idx ON details(name_id, season)')
+        conn.execute('INSERT INTO version (idVersion) VALUES (1)')
+        conn.execute('INSERT INTO details (name_id, season, data, time) VALUES (?, 0, ?, ?)', (name_id, json.dumps(document), int(time.time())))
+        conn.commit()
+        conn.close()
+
+        stub.reset()
+        api = ZonaMobi(site_url, {'cache_dir': v1_dir})
+        try:
+            item_info = api.get_content_url({'type': 'movies', 'name_id': name_id})
+        finally:
+            api.close()
+
+        #Details are taken from the updated cache
+        self.assertEqual(item_info.video.title, document['movie']['name_rus'])
+        self.assertFalse(stub.requests.get('get_content_details'))
+
+        cache = ZonaMobiCache(v1_dir)
+        cache.conn.close()
+
+        conn = sqlite3.connect(os.path.join(v1_dir, 'cache.db'))
+        version = conn.execute('SELECT idVersion FROM version').fetchone()[0]
+        auto_vacuum = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        titles = conn.execute('SELECT name_id FROM search_titles').fetchall()
+        conn.close()
+
+        self.assertEqual(version, cache._version)
+        self.assertEqual(auto_vacuum, 2)
+        self.assertEqual(titles, [(name_id,)])
+
+    def test_convert_auto_vacuum(self):
+        print('\n#test_convert_auto_vacuum')
+
+        db_dir = os.path.join(cache_dir, 'auto_vacuum')
+        os.makedirs(db_dir)
+        conn = sqlite3.connect(os.path.join(db_dir, 'cache.db'))
+        conn.execute('CREATE TABLE version (idVersion integer)')
+        conn.execute('CREATE TABLE details (name_id text, season integer, data text, time integer)')
+        conn.execute('CREATE UNIQUE INDEX details_idx ON details(name_id, season)')
+        conn.execute('INSERT INTO version (idVersion) VALUES (1)')
+        conn.commit()
+        conn.close()
+
+        def get_state():
+            conn = sqlite3.connect(os.path.join(db_dir, 'cache.db'))
+            try:
+                return (conn.execute('SELECT idVersion FROM version').fetchone()[0],
+                        conn.execute('PRAGMA auto_vacuum').fetchone()[0])
+            finally:
+                conn.close()
+
+        #Conversion which has failed is not done by the maintenance when
+        #the plugin exits, but on the next start
+        convert = ZonaMobiCache.__dict__['_convert_auto_vacuum_v9']
+        try:
+            ZonaMobiCache._convert_auto_vacuum_v9 = lambda self: None
+            cache = ZonaMobiCache(db_dir)
+        finally:
+            ZonaMobiCache._convert_auto_vacuum_v9 = convert
+        self.assertTrue(cache.maintain(True))
+        cache.conn.close()
+        self.assertEqual(get_state(), (8, 0))
+
+        cache = ZonaMobiCache(db_dir)
+        cache.conn.close()
+        self.assertEqual(get_state(), (cache._version, 2))
+
+    def test_remove_least_used(self):
+        print('\n#test_remove_least_used')
+
+        cache = ZonaMobiCache(os.path.join(cache_dir, 'lru'))
+
+        #Every next title is accessed later
+        now = int(time.time())
+        documents = ZonaMobiStub()
+        name_ids = ['movies-lru-%d' % i for i in xrange(200)]
+        items = []
+        for i, name_id in enumerate(name_ids):
+            items.append({'name_id': name_id,
+                          'season': 0,
+                          'data': documents._make_document(name_id, False, 0),
+                          'time': now - len(name_ids) + i,
+                          })
+        cache.set_details_list(items)
+        cache.flush()
+
+        size = cache.get_size()
+        cache._max_size = size / 2
+        cache.remove_least_used()
+
+        c = cache.conn.cursor()
+        kept = [row['name_id'] for row in c.execute('SELECT name_id FROM details ORDER BY last_access')]
+        titles = [row['name_id'] for row in c.execute('SELECT name_id FROM search_titles ORDER BY name_id')]
+        print('Size %d of %d, kept %d titles' % (cache.get_size(), size, len(kept)))
+        cache.conn.close()
+
+        self.assertLessEqual(len(kept), len(name_ids) / 2)
+        self.assertEqual(kept, name_ids[-len(kept):])
+        self.assertEqual(titles, sorted(kept))
+
+    def test_remove_least_used_responses(self):
+        print('\n#test_remove_least_used_responses')
+
+        cache = ZonaMobiCache(os.path.join(cache_dir, 'lru_responses'))
+
+        #Cached responses take most of the space
+        documents = ZonaMobiStub()
+        name_ids = ['movies-lru-%d' % i for i in xrange(20)]
+        cache.set_details_list([{'name_id': name_id,
+                                 'season': 0,
+                                 'data': documents._make_document(name_id, False, 0),
+                                 'time': time.time(),
+                                 } for name_id in name_ids])
+        keys = ['response-%d' % i for i in xrange(100)]
+        for i, key in enumerate(keys):
+            cache.set_response(key, 'browse_content', os.urandom(20000), 3600 + i)
+        cache.flush()
+
+        size = cache.get_size()
+        cache._max_size = size * 4 / 5
+        cache.remove_least_used()
+
+        c = cache.conn.cursor()
+        kept_details = c.execute('SELECT COUNT(*) AS count FROM details').fetchone()['count']
+        kept = [row['key'] for row in c.execute('SELECT key FROM responses ORDER BY expires')]
+        print('Size %d of %d, kept %d details and %d responses' % (cache.get_size(), size, kept_details, len(kept)))
+        self.assertLessEqual(cache.get_size(), cache._max_size)
+        cache.conn.close()
+
+        #Both lose the same share, responses which expire first go first
+        self.assertGreaterEqual(kept_details, len(name_ids) / 2)
+        self.assertLess(len(kept), len(keys))
+        self.assertEqual(kept, keys[-len(kept):])
+
+    def test_item_dict(self):
+        print('\n#test_item_dict')
+
+        documents = ZonaMobiStub()
+
+        def get_ratings(item):
+            return [{'type': 'imdb', 'rating': float(item['rating_imdb']), 'votes': item['rating_imdb_count'], 'defaultt': False},
+                    {'type': 'kinopoisk', 'rating': float(item['rating_kinopoisk']), 'votes': item['rating_kinopoisk_count'], 'defaultt': False},
+                    {'type': 'zona', 'rating': float(item['rating']), 'votes': item['rating_count'], 'defaultt': False}]
+
+        def http(url):
+            return url.replace('https://', 'http://')
+
+        #Movie of a listing without details, empty fields are passed too
+        item = documents._make_item('movies-dict-0', False)
+        result = self.api._get_item_info(None, item, False).get_dict()
+        self.assertEqual(result, {'cast': [],
+                                  'ratings': get_ratings(item),
+                                  'properties': {},
+                                  'info': {'video': {'date': '',
+                                                     'genre': [],
+                                                     'country': [],
+                                                     'year': item['year'],
+                                                     'sortepisode': None,
+                                                     'sortseason': None,
+                                                     'director': [],
+                                                     'plot': '',
+                                                     'title': item['name_rus'],
+                                                     'originaltitle': item['name_eng'],
+                                                     'sorttitle': item['name_rus'],
+                                                     'duration': 0,
+                                                     'writer': [],
+                                                     'premiered': '',
+                                                     'aired': '',
+                                                     'mediatype': 'movie',
+                                                     }},
+                                  'art': {'poster': http(item['cover'])},
+                                  'fanart': '',
+                                  'thumb': http(item['cover']),
+                                  })
+
+        #Tvshow with details
+        data = documents._make_document('tvseries-dict-0', True, 0)
+        item = data['serial']
+        persons = data['persons']
+        result = self.api._get_item_info(data, item).get_dict()
+        self.assertEqual(result, {'cast': [{'name': actor['name'], 'thumbnail': http(actor['cover'])} for actor in persons['actors']],
+                                  'ratings': get_ratings(item),
+                                  'properties': {'TotalSeasons': str(documents.seasons),
+                                                 'TotalEpisodes': str(documents.seasons * documents.episodes),
+                                                 'WatchedEpisodes': '0'},
+                                  'info': {'video': {'date': '02.01.2019',
+                                                     'genre': [genre['name'] for genre in data['genres']],
+                                                     'country': [country['name'] for country in data['countries']],
+                                                     'year': item['year'],
+                                                     'sortepisode': documents.seasons * documents.episodes,
+                                                     'sortseason': documents.seasons,
+                                                     'director': [person['name'] for person in persons['director']],
+                                                     'plot': item['description'],
+                                                     'title': item['name_rus'],
+                                                     'originaltitle': item['name_original'],
+                                                     'sorttitle': item['name_rus'],
+                                                     'duration': 0,
+                                                     'writer': [person['name'] for person in persons['scenarist']],
+                                                     'premiered': '%d-01-01' % item['year'],
+                                                     'aired': '',
+                                                     'mediatype': 'tvshow',
+                                                     'episode': documents.seasons * documents.episodes,
+                                                     'season': documents.seasons,
+                                                     'tvshowtitle': item['name_rus'],
+                                                     }},
+                                  'art': {'poster': http(item['image'])},
+                                  'fanart': http(data['backdrops']['image_1280']),
+                                  'thumb': http(item['image']),
+                                  })
+
+        #Episode has no ratings, its own title and thumb
+        data = documents._make_document('tvseries-dict-0', True, 2)
+        item = data['serial']
+        result = self.api._get_item_info(data, item, params={'season': 2, 'episode': 3}).get_dict()
+        video = result['info']['video']
+        self.assertEqual(sorted(result), ['art', 'cast', 'fanart', 'info', 'properties', 'ratings', 'thumb'])
+        self.assertEqual(sorted(video), ['aired', 'country', 'date', 'director', 'duration', 'episode', 'genre',
+                                         'mediatype', 'originaltitle', 'plot', 'premiered', 'season', 'sortepisode',
+                                         'sortseason', 'sorttitle', 'title', 'tvshowtitle', 'writer', 'year'])
+        self.assertEqual((result['ratings'], result['properties']), ([], {}))
+        self.assertEqual((video['mediatype'], video['season'], video['episode'], video['title'], video['originaltitle'], video['sorttitle'], video['aired']),
+                         ('episode', 2, 3, u'Серия 3', u'Серия 3', u'Серия 3', '2015-01-04'))
+        self.assertEqual(result['thumb'], http(data['images']['200003']))
+
+    def test_item_infos(self):
+        print('\n#test_item_infos')
+
+        cache = ZonaMobiCache(os.path.join(cache_dir, 'item_infos'))
+        name_id = 'movies-built-0'
+        details = {'name_id': name_id,
+                   'season': 0,
+                   'data': ZonaMobiStub()._make_document(name_id, False, 0),
+                   'time': time.time(),
+                   }
+        key = (name_id, 0, 0, True)
+
+        def save_item_info():
+            cache.set_item_infos([(key, ['video_info', 'item_info'])], 1)
+            cache.flush()
+
+        try:
+            cache.set_details_list([details])
+            save_item_info()
+            self.assertEqual(cache.get_item_infos([key], 1), {key: ['video_info', 'item_info']})
+
+            #Items of another version of the builders are not used
+            self.assertEqual(cache.get_item_infos([key], 2), {})
+
+            #and the version is another when the code of a builder changes
+            version = self.api._get_item_info_version()
+            get_rating = ZonaMobi.__dict__['_get_rating']
+            try:
+                ZonaMobi._item_info_version = None
+                ZonaMobi._get_rating = lambda self, *args: None
+                self.assertNotEqual(self.api._get_item_info_version(), version)
+            finally:
+                ZonaMobi._get_rating = get_rating
+                ZonaMobi._item_info_version = version
+
+            #Item is dropped with the details it has been built from
+            cache.set_details_list([details])
+            cache.flush()
+            self.assertEqual(cache.get_item_infos([key], 1), {})
+
+            #Stale details never give a built item
+            save_item_info()
+            cache.conn.execute('UPDATE details SET time = time - 3 * 86400')
+            self.assertEqual(cache.get_item_infos([key], 1), {})
+        finally:
+            cache.conn.close()
+
+    def test_get_details_many(self):
+        print('\n#test_get_details_many')
+
+        cache = ZonaMobiCache(os.path.join(cache_dir, 'details_many'))
+
+        #Movies and seasons of tvseries, the second season of each
+        #tvseries is not asked for
+        documents = ZonaMobiStub()
+        items = []
+        for i in xrange(5):
+            name_id = 'movies-many-%d' % i
+            items.append({'name_id': name_id,
+                          'season': 0,
+                          'data': documents._make_document(name_id, False, 0),
+                          'time': time.time(),
+                          })
+            name_id = 'tvseries-many-%d' % i
+            for season in [0, 1, 2]:
+                items.append({'name_id': name_id,
+                              'season': season,
+                              'data': documents._make_document(name_id, True, season),
+                              'time': time.time(),
+                              })
+        cache.set_details_list(items)
+        cache.flush()
+
+        keys = [(item['name_id'], item['season']) for item in items if item['season'] != 2]
+        keys.append(('movies-many-missing', 0))
+
+        try:
+            result = cache.get_details_many(keys)
+
+            #Same documents as the query per key gives
+            c = cache.conn.cursor()
+            c.row_factory = None
+            expected = {}
+            for name_id, season in keys:
+                row = c.execute('SELECT data FROM details WHERE name_id = ? AND season = ?', (name_id, season)).fetchone()
+                if row is not None:
+                    expected[(name_id, season)] = cache._decode(row[0])
+
+            self.assertEqual(len(result), len(keys) - 1)
+            self.assertEqual(result, expected)
+            for key in keys:
+                self.assertEqual(cache.get_details({'name_id': key[0], 'season': key[1]}), expected.get(key))
+        finally:
+            cache.conn.close()
+
+    def test_reset_metrics(self):
+        print('\n#test_reset_metrics')
+
+        self.api.get_video_list('movies')
+        self.api.close()
+
+        #Reset is seen by the next plugin call before this one is closed
+        self.api = ZonaMobi(site_url, {'cache_dir': cache_dir})
+        self.assertTrue(self.api.get_metrics())
+        self.api.reset_metrics()
+
+        api = ZonaMobi(site_url, {'cache_dir': cache_dir})
+        metrics = api.get_metrics()
+        api.close()
+        self.assertEqual(metrics, {})
+
+    def test_cassette(self):
+        print('\n#test_cassette')
+
+        if stub is None:
+            self.skipTest('records the stub')
+
+        site = ZonaMobiStub()
+        url = site.start()
+        cassette = os.path.join(cache_dir, 'cassette.jsonl')
+
+        api = ZonaMobi(url, {'cassette': cassette,
+                             'cassette_mode': 'record',
+                             })
+        try:
+            name_ids = [video['video_info']['name_id'] for video in api.get_video_list('movies')['list']]
+        finally:
+            api.close()
+            site.stop()
+
+        with open(cassette) as f:
+            records = [json.loads(line) for line in f]
+        for record in records:
+            self.assertEqual(record['headers'].keys(), ['Content-Type'])
+
+        #Listing is replayed with the site stopped, requests which are not
+        #recorded fail
+        api = ZonaMobi(url, {'cassette': cassette,
+                             'cassette_mode': 'replay',
+                             })
+        try:
+            replayed = [video['video_info']['name_id'] for video in api.get_video_list('movies')['list']]
+            self.assertEqual(replayed, name_ids)
+            self.assertRaises(ZonaMobiApiError, api.get_video_list, 'movies', {'page': 2})
+        finally:
+            api.close()
+
+        #Recording stops when the cassette is full
+        size = os.path.getsize(cassette)
+        api = ZonaMobi(site_url, {'cassette': cassette,
+                                  'cassette_mode': 'record',
+                                  'cassette_size': 0.001,
+                                  })
+        api.get_video_list('movies', {'page': 2})
+        api.close()
+        self.assertEqual(os.path.getsize(cassette), size)
+
+    def test_run_background_tasks(self):
+        print('\n#test_run_background_tasks')
+
+        #Failed task is logged and does not stop the next ones
+        done = []
+        def failing_task():
+            raise ValueError('No JSON object could be decoded')
+
+        self.api._add_background_task(failing_task)
+        self.api._add_background_task(done.append, True)
+
+        errors = []
+        self.api.run_background_tasks(errors.append)
+        print(errors[0])
+
+        self.assertEqual(done, [True])
+        self.assertEqual(len(errors), 1)
+        self.assertIn('failing_task', errors[0])
+
+    def test_rating_filter_field(self):
+        print('\n#test_rating_filter_field')
+
+        #Local listings filter and sort by the zona rating, the site must
+        #do the same. It is checked against the site given by
+        #ZONA_SITE_URL or a cassette of it in ZONA_CASSETTE, which is
+        #recorded when the file does not exist yet
+        params = {}
+        cassette = os.environ.get('ZONA_CASSETTE')
+        if cassette:
+            params = {'cassette': cassette,
+                      'cassette_mode': 'replay' if os.path.exists(cassette) else 'record',
+                      }
+
+        api = ZonaMobi(site_url, params)
+        try:
+            filtered = api._get_content_page('movies', {'rating': '7'})['items']
+            ordered = api._get_content_page('movies', {'sort': 'rating'})['items']
+        finally:
+            api.close()
+
+        self.assertTrue(filtered)
+        self.assertTrue(ordered)
+
+        matches = []
+        for field in ['rating', 'rating_imdb', 'rating_kinopoisk']:
+            filtered_ratings = [api._get_float(item.get(field)) or 0 for item in filtered]
+            ordered_ratings = [api._get_float(item.get(field)) or 0 for item in ordered]
+            if min(filtered_ratings) >= 7 \
+              and ordered_ratings == sorted(ordered_ratings, reverse=True):
+                matches.append(field)
+        print('Listings match %s' % (', '.join(matches) or 'no rating field'))
+
+        self.assertIn('rating', matches)
+
+    def test_update_catalogue(self):
+        print('\n#test_update_catalogue')
+
+        if stub is None:
+            self.skipTest('walks the whole site')
+
+        site = ZonaMobiStub()
+        url = site.start()
+        api = ZonaMobi(url, {'cache_dir': os.path.join(cache_dir, 'update'),
+                             'catalogue_sync': True,
+                             'catalogue_workers': 4,
+                             'catalogue_rate': 50,
+                             })
+        try:
+            self.assertTrue(api.sync_catalogue())
+
+            #New titles at the top push the others to the next pages
+            site.new_titles = 5
+            api.catalogue_ttl = 0
+            self.assertTrue(api.sync_catalogue())
+
+            site_api = ZonaMobi(url)
+            for page in xrange(1, site._get_total_pages() + 1):
+                local_list = api.get_video_list('movies', {'page': page})
+                site_list = site_api.get_video_list('movies', {'page': page})
+                name_ids = [video['video_info']['name_id'] for video in local_list['list']]
+                print('Page %d: %s' % (page, ', '.join(name_ids)))
+                self.assertEqual(name_ids, [video['video_info']['name_id'] for video in site_list['list']])
+            site_api.close()
+        finally:
+            api.close()
+            site.stop()
+
     def test_get_filters(self):
         print('\n#get_filters')
 
         has_filters = False
 
+        #Without a saved copy the catalogue is loaded by the first call
         filters = self.api.get_filters()
         for filter, values in filters.iteritems():
             has_filters = True
@@ -175,6 +1482,7 @@ class ZonaMobiTestCase(unittest.TestCase):
                 print('value: %s, name: %s' % (val['value'], val['name']))
 
         self.assertTrue(has_filters)
+        self.assertTrue(filters['genre'])
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file